@@ -1,7 +1,9 @@
 import json
 import os
+import time
 from msal import ConfidentialClientApplication
 import config
+from token_manager import TokenManager
 
 class AuthProvider:
     """Handles Microsoft authentication and token management"""
@@ -13,6 +15,7 @@ class AuthProvider:
             client_credential=config.CLIENT_SECRET,
         )
         self.token_cache = None
+        self.token_manager = TokenManager(self._refresh_access_token)
     
     def get_auth_url(self):
         """Generate authorization URL for user login"""
@@ -44,6 +47,18 @@ class AuthProvider:
         if not tokens:
             raise Exception('No tokens found. Please authenticate first.')
         
+        # Reuse the stored access token while it is still valid
+        self.token_manager.seed(tokens.get('access_token'), tokens.get('access_token_expires_at'))
+        return self.token_manager.get_token()
+    
+    def invalidate_access_token(self, access_token=None):
+        """Forget the cached access token (e.g. after Graph rejected it with 401)"""
+        self.token_manager.invalidate(access_token)
+    
+    def _refresh_access_token(self):
+        """Redeem the refresh token for a new access token"""
+        tokens = self.load_tokens()
+        
         # Try to get token silently using refresh token
         result = self.app.acquire_token_by_refresh_token(
             refresh_token=tokens.get('refresh_token'),
@@ -55,7 +70,7 @@ class AuthProvider:
         
         # Save updated tokens
         self.save_tokens(result)
-        return result['access_token']
+        return self.token_cache
     
     def save_tokens(self, token_response):
         """Save tokens to file"""
@@ -63,6 +78,7 @@ class AuthProvider:
             'access_token': token_response.get('access_token'),
             'refresh_token': token_response.get('refresh_token'),
             'expires_in': token_response.get('expires_in'),
+            'access_token_expires_at': self._expires_at(token_response),
             'id_token': token_response.get('id_token'),
         }
         
@@ -71,6 +87,12 @@ class AuthProvider:
         
         self.token_cache = tokens
     
+    def _expires_at(self, token_response):
+        """Absolute expiry (epoch seconds) of the access token in a token response"""
+        if not token_response.get('expires_in'):
+            return None
+        return int(time.time() + int(token_response['expires_in']))
+    
     def load_tokens(self):
         """Load tokens from file"""
         if self.token_cache:
@@ -1,22 +1,38 @@
 import json
 import os
-import boto3
-from msal import ConfidentialClientApplication
+import time
 import config
+from token_manager import TokenManager
 
 class AWSAuthProvider:
     """Handles Microsoft authentication using DynamoDB for token storage"""
     
     def __init__(self):
-        self.app = ConfidentialClientApplication(
-            config.CLIENT_ID,
-            authority=config.AUTHORITY,
-            client_credential=config.CLIENT_SECRET,
-        )
-        self.dynamodb = boto3.resource('dynamodb')
+        # The MSAL app (which runs authority discovery over the network) and the
+        # DynamoDB table are created on first use, keeping msal and boto3 out of cold starts
+        self._app = None
+        self._table = None
         self.table_name = os.environ.get('DYNAMODB_TABLE', 'EmailBot_Tokens')
-        self.table = self.dynamodb.Table(self.table_name)
         self.token_cache = None
+        self.token_manager = TokenManager(self._refresh_access_token)
+    
+    @property
+    def app(self):
+        if self._app is None:
+            from msal import ConfidentialClientApplication
+            self._app = ConfidentialClientApplication(
+                config.CLIENT_ID,
+                authority=config.AUTHORITY,
+                client_credential=config.CLIENT_SECRET,
+            )
+        return self._app
+    
+    @property
+    def table(self):
+        if self._table is None:
+            import boto3
+            self._table = boto3.resource('dynamodb').Table(self.table_name)
+        return self._table
     
     def get_access_token(self):
         """Get valid access token (refresh if needed)"""
@@ -25,8 +41,20 @@ class AWSAuthProvider:
         if not tokens:
             raise Exception('No tokens found in DynamoDB. Please run local setup first to generate tokens.')
         
+        # A warm (or freshly started) container reuses the token stored in
+        # DynamoDB until it gets close to expiry instead of refreshing on every call
+        self.token_manager.seed(tokens.get('access_token'), tokens.get('access_token_expires_at'))
+        return self.token_manager.get_token()
+    
+    def invalidate_access_token(self, access_token=None):
+        """Forget the cached access token (e.g. after Graph rejected it with 401)"""
+        self.token_manager.invalidate(access_token)
+    
+    def _refresh_access_token(self):
+        """Redeem the refresh token for a new access token"""
+        tokens = self.load_tokens()
+        
         # Try to get token silently using refresh token
-        # This automatically handles token refresh if expired
         result = self.app.acquire_token_by_refresh_token(
             refresh_token=tokens.get('refresh_token'),
             scopes=config.SCOPES
@@ -39,15 +67,19 @@ class AWSAuthProvider:
         if result.get('access_token') != tokens.get('access_token'):
             self.save_tokens(result)
             
-        return result['access_token']
+        return result
     
     def save_tokens(self, token_response):
-        """Save tokens to DynamoDB"""
+        """
+        Save tokens to DynamoDB. The access token's expiry is not called expires_at:
+        that is the table's TTL attribute, which would delete the refresh token with it
+        """
         tokens = {
             'token_id': 'default',  # Primary Key
             'access_token': token_response.get('access_token'),
             'refresh_token': token_response.get('refresh_token'),
             'expires_in': token_response.get('expires_in'),
+            'access_token_expires_at': self._expires_at(token_response),
             'id_token': token_response.get('id_token'),
             'scope': token_response.get('scope')
         }
@@ -59,6 +91,12 @@ class AWSAuthProvider:
         self.token_cache = tokens
         print("✓ Tokens updated in DynamoDB")
     
+    def _expires_at(self, token_response):
+        """Absolute expiry (epoch seconds) of the access token in a token response"""
+        if not token_response.get('expires_in'):
+            return None
+        return int(time.time() + int(token_response['expires_in']))
+    
     def load_tokens(self):
         """Load tokens from DynamoDB"""
         if self.token_cache:
@@ -0,0 +1,58 @@
+"""
+Micro-benchmark: html_text.html_to_text vs. the regex tag stripper it replaced.
+
+Runs every HTML body in benchmarks/fixtures/html (plus a 4x newsletter to
+mimic the multi-hundred-KB marketing mails we see) through both converters.
+
+Usage: python benchmarks/bench_html_to_text.py [--number N] [--budget CHARS]
+"""
+import argparse
+import glob
+import html
+import os
+import re
+import sys
+import timeit
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_text import html_to_text
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'html')
+
+def legacy_strip_html(html_content):
+    """The original EmailProcessor._strip_html"""
+    text = re.sub('<[^<]+?>', '', html_content)
+    return html.unescape(text)
+
+def load_corpus():
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            corpus[os.path.basename(path)] = f.read()
+    if 'newsletter.html' in corpus:
+        corpus['newsletter.html x4'] = corpus['newsletter.html'] * 4
+    return corpus
+
+def time_call(func, number):
+    """Best-of-3 microseconds per call"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=50, help='calls per timing run')
+    parser.add_argument('--budget', type=int, default=1000, help='character budget for the early-stop run')
+    args = parser.parse_args()
+    
+    print(f"{'fixture':<22}{'size':>9}{'regex us':>11}{'full us':>11}{'budget us':>11}"
+          f"{'regex chars':>13}{'text chars':>12}")
+    for name, body in load_corpus().items():
+        legacy = time_call(lambda: legacy_strip_html(body), args.number)
+        full = time_call(lambda: html_to_text(body), args.number)
+        budget = time_call(lambda: html_to_text(body, max_chars=args.budget), args.number)
+        print(f"{name:<22}{len(body) // 1024:>7}KB{legacy:>11.0f}{full:>11.0f}{budget:>11.0f}"
+              f"{len(legacy_strip_html(body)):>13}{len(html_to_text(body)):>12}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Per-stage benchmark of the email pipeline, offline.
+
+Times each stage separately against the recorded fixtures in
+benchmarks/fixtures (Graph conversations of depth 1 to 20, HTML bodies
+and webhook payloads of 1 to 50 notifications):
+
+  strip_html      EmailProcessor._strip_html on each HTML body
+  history         thread history building (_history_entry + _build_context)
+  create_prompt   LLMService._create_prompt with that history
+  notifications   the notification branch of lambda_handler (claiming and
+                  processing stubbed out)
+  process_email   the full process_email with a fixture-backed Graph client
+                  and the fake LLM provider (intent fast path off)
+
+For each stage and fixture it reports ops/sec, peak traced memory and
+the memory the call left allocated (tracemalloc). --save writes the
+results to benchmarks/baseline.json; later runs print the change against
+it, and --check exits non-zero when a stage got slower or bigger than
+--threshold allows. Baselines are only comparable on the same machine.
+
+Usage: python benchmarks/bench_pipeline.py [--stage NAME] [--min-time 0.2] [--save] [--check] [--threshold 0.25]
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import email_processor as email_processor_module
+import lambda_function
+from email_processor import EmailProcessor
+from graph_client import AsyncGraphClient
+from llm_providers import FakeProvider, LLMRouter
+from llm_service import llm_service
+from rate_limiter import RateLimiter
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(BENCHMARKS, 'fixtures')
+BASELINE = os.path.join(BENCHMARKS, 'baseline.json')
+
+def load_json(pattern):
+    """{fixture name: parsed JSON} for the files matching pattern"""
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, pattern))):
+        with open(path, encoding='utf-8') as f:
+            fixtures[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+    return fixtures
+
+class FixtureGraphClient:
+    """Answers the GraphClient calls process_email makes from the conversation fixtures"""
+    
+    def __init__(self, conversations):
+        self.messages = {}
+        self.threads = {}
+        for conversation in conversations.values():
+            for message in conversation['messages']:
+                self.messages[message['id']] = message
+            self.threads[conversation['messages'][0]['conversationId']] = conversation['messages']
+    
+    def get_message(self, message_id, select=None, text_body=False):
+        return self.messages[message_id]
+    
+    def get_conversation_threads(self, conversation_id, select=None, text_body=False, since=None):
+        return self.threads[conversation_id]
+    
+    def create_reply_draft(self, message_id, reply_content):
+        return {'id': f'draft-{message_id}'}
+
+def stage_strip_html(processor):
+    cases = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'html', '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+        cases[os.path.splitext(os.path.basename(path))[0]] = lambda content=content: processor._strip_html(content)
+    return cases
+
+def _history(processor, conversation):
+    messages = conversation['messages']
+    details = processor._extract_details(messages[-1])
+    entries = [processor._history_entry(message) for message in messages]
+    return details, processor._build_context(entries, messages[-1]['id'], details)
+
+def stage_history(processor):
+    return {name: lambda conversation=conversation: _history(processor, conversation)
+            for name, conversation in load_json('graph/*.json').items()}
+
+def stage_create_prompt(processor):
+    cases = {}
+    for name, conversation in load_json('graph/*.json').items():
+        details, (history, body) = _history(processor, conversation)
+        cases[name] = lambda details=details, history=history, body=body: llm_service._create_prompt(
+            details['subject'], body, details['sender'], history
+        )
+    return cases
+
+def _accepted(response):
+    # A handler error is fast too: do not let it pass as a timing
+    if response['statusCode'] != 202:
+        raise Exception(f"Webhook returned {response['statusCode']}: {response['body']}")
+    return response
+
+def stage_notifications(processor):
+    # Only the parsing: no idempotency store, no processing
+    lambda_function.claim_messages = lambda message_ids: message_ids
+    lambda_function.process_within_budget = lambda message_ids, context, messages=None: ([], [])
+    return {name: lambda event=event: _accepted(lambda_function.lambda_handler(event, None))
+            for name, event in load_json('webhooks/*.json').items()}
+
+def stage_process_email(processor):
+    conversations = load_json('graph/*.json')
+    email_processor_module.async_graph_client = AsyncGraphClient(FixtureGraphClient(conversations))
+    llm_service.router = LLMRouter([FakeProvider(sleep=False)])
+    llm_service.reply_cache = None
+    llm_service.rate_limiter = RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+    config.INTENT_FAST_PATH = False
+    return {name: lambda message_id=conversation['messages'][-1]['id']: processor.process_email(message_id)
+            for name, conversation in conversations.items()}
+
+STAGES = {
+    'strip_html': stage_strip_html,
+    'history': stage_history,
+    'create_prompt': stage_create_prompt,
+    'notifications': stage_notifications,
+    'process_email': stage_process_email,
+}
+
+def measure(func, min_time):
+    """ops/sec over at least min_time seconds, then peak and retained memory of one call"""
+    func()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+    
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    baseline_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = [stat for stat in after.compare_to(before, 'filename') if stat.size_diff > 0]
+    return {
+        'ops_per_sec': round(number / elapsed, 1),
+        'peak_kb': round((peak - baseline_bytes) / 1024, 1),
+        'retained_kb': round(sum(stat.size_diff for stat in retained) / 1024, 1),
+        'retained_blocks': sum(stat.count_diff for stat in retained if stat.count_diff > 0)
+    }
+
+def change(current, previous):
+    return (current - previous) / previous if previous else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--stage', choices=sorted(STAGES), action='append', help='only these stages')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds of timing per case')
+    parser.add_argument('--save', action='store_true', help=f'write the results to {os.path.relpath(BASELINE)}')
+    parser.add_argument('--check', action='store_true', help='exit 1 on a regression against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown / memory growth')
+    args = parser.parse_args()
+    
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)['results']
+    
+    processor = EmailProcessor()
+    results = {}
+    regressions = []
+    print(f"{'case':<42}{'ops/sec':>11}{'peak KB':>10}{'retained KB':>13}{'vs baseline':>13}")
+    for stage in args.stage or STAGES:
+        # The pipeline prints as it goes; keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            cases = STAGES[stage](processor)
+        for name, func in cases.items():
+            key = f'{stage}/{name}'
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = measure(func, args.min_time)
+            results[key] = result
+            
+            comparison = ''
+            if key in baseline:
+                speed = change(result['ops_per_sec'], baseline[key]['ops_per_sec'])
+                memory = change(result['peak_kb'], baseline[key]['peak_kb'])
+                comparison = f"{speed:+.0%}"
+                if speed < -args.threshold or memory > args.threshold:
+                    regressions.append(f"{key}: ops/sec {speed:+.0%}, peak memory {memory:+.0%}")
+                    comparison += ' !'
+            print(f"{key:<42}{result['ops_per_sec']:>11,.1f}{result['peak_kb']:>10,.1f}"
+                  f"{result['retained_kb']:>13,.1f}{comparison:>13}")
+    
+    if args.save:
+        # Merge so a partial run (--stage) only replaces its own stages
+        with open(BASELINE, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': {**baseline, **results}
+            }, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {os.path.relpath(BASELINE)}")
+    
+    if regressions:
+        print(f"\n{len(regressions)} regressions beyond {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        if args.check:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Reply latency with and without streaming cut-off.
+
+LLMService is run against fake_llm.FakeModel (no network, no API key),
+once blocking on the full response and once streaming with LLM_STREAMING
+on, which stops at the reply's sign-off instead of waiting for what the
+model writes after it. Reports time to first token, total generation
+time and characters generated.
+
+Usage: python benchmarks/bench_streaming.py [--runs 5] [--ttft 0.4] [--rate 1500]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from fake_llm import FakeModel
+from llm_providers import FakeProvider, LLMRouter
+from llm_service import LLMService
+
+def run(streaming, runs, model):
+    config.LLM_STREAMING = streaming
+    service = LLMService()
+    service.router = LLMRouter([FakeProvider(model)])
+    timings = []
+    for _ in range(runs):
+        metadata = {}
+        # LLMService prints the full prompt; keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            reply = service.generate_reply('Where is my order?', 'My package has not arrived yet.',
+                                           'customer@example.com', metadata=metadata)
+        timings.append(metadata)
+    return reply, timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--ttft', type=float, default=0.4, help='simulated seconds to first token')
+    parser.add_argument('--rate', type=int, default=1500, help='simulated characters generated per second')
+    args = parser.parse_args()
+    
+    print(f"{'mode':<12}{'ttft ms':>10}{'total ms':>10}{'chars kept':>12}{'generated':>11}  cutoff")
+    for streaming in (False, True):
+        model = FakeModel(first_token_seconds=args.ttft, chars_per_second=args.rate)
+        reply, timings = run(streaming, args.runs, model)
+        print(f"{'streaming' if streaming else 'blocking':<12}"
+              f"{statistics.median(t['ttft_ms'] for t in timings):>10.0f}"
+              f"{statistics.median(t['generation_ms'] for t in timings):>10.0f}"
+              f"{len(reply):>12}{model.chars_generated // args.runs:>11}  {timings[-1]['cutoff']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Prompt size before and after quoted-reply and signature elimination.
+
+Every thread in benchmarks/fixtures/threads is run through the same history
+building as EmailProcessor (the last message is the one being answered), once
+with STRIP_QUOTED_REPLIES off and once with it on, and the resulting
+prompt is measured (with no token budget, so nothing is dropped).
+
+Usage: python benchmarks/bench_thread_dedup.py [--show]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from email_processor import EmailProcessor
+from prompt_builder import PromptBuilder, estimate_tokens
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'threads')
+
+def graph_message(message):
+    """Fixture message in the shape Graph returns with text bodies"""
+    return {
+        'id': message['id'],
+        'receivedDateTime': message['received'],
+        'from': {'emailAddress': {'name': message['sender'], 'address': message['address']}},
+        'body': {'contentType': 'text', 'content': message['body']}
+    }
+
+def build_prompt(processor, thread):
+    messages = [graph_message(message) for message in thread['messages']]
+    current = messages[-1]
+    details = processor._extract_details(current)
+    entries = [processor._history_entry(message) for message in messages]
+    thread_history, body = processor._build_context(entries, current['id'], details)
+    prompt, _ = PromptBuilder(budget_tokens=10 ** 6).build(thread['subject'], body, details['sender'], thread_history)
+    return prompt
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--show', action='store_true', help='print the deduplicated prompts')
+    args = parser.parse_args()
+    
+    processor = EmailProcessor()
+    print(f"{'thread':<30}{'msgs':>5}{'before chars':>14}{'after chars':>13}"
+          f"{'before tok':>12}{'after tok':>11}{'saved':>8}")
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            thread = json.load(f)
+        
+        config.STRIP_QUOTED_REPLIES = False
+        before = build_prompt(processor, thread)
+        config.STRIP_QUOTED_REPLIES = True
+        after = build_prompt(processor, thread)
+        
+        saved = 1 - len(after) / len(before)
+        print(f"{os.path.basename(path):<30}{len(thread['messages']):>5}{len(before):>14}{len(after):>13}"
+              f"{estimate_tokens(before):>12}{estimate_tokens(after):>11}{saved:>8.0%}")
+        if args.show:
+            print(after)
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,174 @@ SCOPES = [
     'Mail.Send'
 ]
 
+# Microsoft Graph HTTP connection pool
+GRAPH_POOL_CONNECTIONS = int(os.getenv('GRAPH_POOL_CONNECTIONS', 4))
+GRAPH_POOL_MAXSIZE = int(os.getenv('GRAPH_POOL_MAXSIZE', 10))
+GRAPH_CONNECT_RETRIES = int(os.getenv('GRAPH_CONNECT_RETRIES', 2))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv('GRAPH_CONNECT_TIMEOUT', 3.05))
+# Read timeouts (seconds) per Graph operation, overridable with GRAPH_TIMEOUT_<OPERATION>
+GRAPH_TIMEOUTS = {
+    name: float(os.getenv(f'GRAPH_TIMEOUT_{name.upper()}', default))
+    for name, default in {
+        'default': 15,
+        'get_message': 10,
+        'list_messages': 15,
+        'create_reply': 20,
+        'update_draft': 20,
+        'subscription': 30,
+        'batch': 60,
+        'delta': 30,
+    }.items()
+}
+# JSON $batch: requests per envelope (Graph allows at most 20) and the
+# longest Retry-After we are willing to wait before retrying throttled requests
+GRAPH_BATCH_MAX_REQUESTS = int(os.getenv('GRAPH_BATCH_MAX_REQUESTS', 20))
+GRAPH_BATCH_MAX_RETRY_AFTER = int(os.getenv('GRAPH_BATCH_MAX_RETRY_AFTER', 5))
+
+# Message fetches: only the fields EmailProcessor reads, with bodies
+# converted to plain text by Graph instead of being stripped locally.
+# Add internetMessageHeaders to skip newsletters on their List-Unsubscribe
+# header too, not only on bulk sender addresses (see intent_classifier)
+MESSAGE_SELECT_FIELDS = os.getenv('MESSAGE_SELECT_FIELDS', 'id,subject,from,body,conversationId,receivedDateTime')
+GRAPH_TEXT_BODIES = os.getenv('GRAPH_TEXT_BODIES', 'true').lower() == 'true'
+
+# Conversation history cache: cleaned thread entries per conversationId
+CONVERSATION_CACHE_TTL_SECONDS = int(os.getenv('CONVERSATION_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv('CONVERSATION_CACHE_MAX_ENTRIES', 50))
+CONVERSATION_CACHE_MAX_CONVERSATIONS = int(os.getenv('CONVERSATION_CACHE_MAX_CONVERSATIONS', 1000))
+CONVERSATION_CACHE_DB = os.getenv('CONVERSATION_CACHE_DB', 'conversation_cache.db')
+
+# Drop quoted replies, repeated paragraphs and signatures from thread history
+STRIP_QUOTED_REPLIES = os.getenv('STRIP_QUOTED_REPLIES', 'true').lower() == 'true'
+
+# Notifications of one webhook payload processed at the same time
+PROCESS_CONCURRENCY = int(os.getenv('PROCESS_CONCURRENCY', 5))
+
+# Local work queue drained by worker threads (scripts/server.py)
+WORK_QUEUE_DB = os.getenv('WORK_QUEUE_DB', 'work_queue.db')
+WORK_QUEUE_WORKERS = int(os.getenv('WORK_QUEUE_WORKERS', 2))
+WORK_QUEUE_BATCH_SIZE = int(os.getenv('WORK_QUEUE_BATCH_SIZE', 10))
+WORK_QUEUE_VISIBILITY_TIMEOUT = int(os.getenv('WORK_QUEUE_VISIBILITY_TIMEOUT', 300))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv('WORK_QUEUE_MAX_ATTEMPTS', 5))
+WORK_QUEUE_POLL_INTERVAL = float(os.getenv('WORK_QUEUE_POLL_INTERVAL', 1.0))
+
+# Lambda time budget: stop starting new messages when the estimated cost
+# (EWMA of recent per-message timings) would run into the safety margin
+LAMBDA_SAFETY_MARGIN_MS = int(os.getenv('LAMBDA_SAFETY_MARGIN_MS', 5000))
+MESSAGE_COST_INITIAL_SECONDS = float(os.getenv('MESSAGE_COST_INITIAL_SECONDS', 15))
+MESSAGE_COST_EWMA_ALPHA = float(os.getenv('MESSAGE_COST_EWMA_ALPHA', 0.3))
+# Where unfinished notifications go: 'sqs' (DEFERRAL_QUEUE_URL), 'sqlite' or 'memory'.
+# The Lambda always uses SQS and defers nothing without DEFERRAL_QUEUE_URL
+DEFERRAL_QUEUE_URL = os.getenv('DEFERRAL_QUEUE_URL')
+DEFERRAL_BACKEND = os.getenv('DEFERRAL_BACKEND', 'sqs' if DEFERRAL_QUEUE_URL else 'memory')
+DEFERRAL_QUEUE_DB = os.getenv('DEFERRAL_QUEUE_DB', 'deferred.db')
+# Re-invoke the function asynchronously to drain deferred messages
+# (not needed when the SQS queue is an event source of the function)
+DEFERRAL_SELF_INVOKE = os.getenv('DEFERRAL_SELF_INVOKE', 'true').lower() == 'true'
+
+# Idempotency markers for notified messages (in-process LRU in front of DynamoDB/SQLite)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 3 * 24 * 3600))
+IDEMPOTENCY_LRU_SIZE = int(os.getenv('IDEMPOTENCY_LRU_SIZE', 1024))
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', 'idempotency.db')
+# Also skip copies of an email already drafted (same internetMessageId, different message ID)
+DEDUP_BY_INTERNET_MESSAGE_ID = os.getenv('DEDUP_BY_INTERNET_MESSAGE_ID', 'false').lower() == 'true'
+
+# Generated replies cached by a hash of their normalised inputs; the backend
+# defaults to DynamoDB in the Lambda and SQLite for scripts/server.py
+REPLY_CACHE_BACKEND = os.getenv('REPLY_CACHE_BACKEND')
+REPLY_CACHE_TTL_SECONDS = int(os.getenv('REPLY_CACHE_TTL_SECONDS', 24 * 3600))
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv('REPLY_CACHE_MAX_ENTRIES', 500))
+REPLY_CACHE_DB = os.getenv('REPLY_CACHE_DB', 'reply_cache.db')
+
+# Local intent classifier: confidently recognised formulaic mail gets a templated
+# reply (prompts/intent_replies.py) or none, without calling the LLM
+INTENT_FAST_PATH = os.getenv('INTENT_FAST_PATH', 'true').lower() == 'true'
+# Minimum confidence per intent, overridable with INTENT_THRESHOLD_<INTENT>
+INTENT_THRESHOLDS = {
+    name: float(os.getenv(f'INTENT_THRESHOLD_{name.upper()}', default))
+    for name, default in {
+        'shipping_delay': 0.85,
+        'order_status': 0.9,
+        'return_address': 0.85,
+        'out_of_office': 0.85,
+        'newsletter': 0.8,
+    }.items()
+}
+
+# Client-side Gemini rate limits (free tier: 15 requests/minute). Callers over
+# the limit wait their turn; one that would wait longer than the maximum fails
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', 15))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', 1000000))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv('RATE_LIMIT_MAX_WAIT_SECONDS', 60))
+# Also count requests per minute across Lambda containers: 'dynamodb', 'memory' or 'none'
+RATE_LIMIT_SHARED_BACKEND = os.getenv('RATE_LIMIT_SHARED_BACKEND', 'none')
+
+# Stream replies from Gemini and stop once the sign-off is complete or the
+# reply reaches LLM_STREAM_MAX_CHARS, instead of waiting for the full response
+LLM_STREAMING = os.getenv('LLM_STREAMING', 'false').lower() == 'true'
+LLM_STREAM_MAX_CHARS = int(os.getenv('LLM_STREAM_MAX_CHARS', 4000))
+
+# LLM providers, preferred first (gemini, openai, anthropic, fake). With more
+# than one, a request the first is slow on (past its rolling p95) is hedged with
+# the second, and the first answer wins
+LLM_PROVIDERS = [name.strip() for name in os.getenv('LLM_PROVIDERS', 'gemini').split(',') if name.strip()]
+LLM_HEDGING = os.getenv('LLM_HEDGING', 'true').lower() == 'true'
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+# Hedge delay until a provider has LLM_HEDGE_MIN_SAMPLES latencies
+LLM_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY_SECONDS', 10))
+LLM_LATENCY_WINDOW = int(os.getenv('LLM_LATENCY_WINDOW', 200))
+# A provider failing more often than this goes to the back of the list
+LLM_MAX_ERROR_RATE = float(os.getenv('LLM_MAX_ERROR_RATE', 0.5))
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 60))
+
+# Per-stage metrics in CloudWatch Embedded Metric Format. The sink defaults to
+# stdout (EMF log lines) in the Lambda and a local file for scripts/server.py
+METRICS_SINK = os.getenv('METRICS_SINK')
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.jsonl')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'EmailBot')
+METRICS_SERVICE = os.getenv('METRICS_SERVICE', 'email-automation')
+
+# Structured JSON logs: level, per-level sampling (LOG_SAMPLE_<LEVEL>) and size caps
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'info').lower()
+LOG_SAMPLE_RATES = {
+    level: float(os.getenv(f'LOG_SAMPLE_{level.upper()}', 1.0))
+    for level in ('debug', 'info', 'warning', 'error')
+}
+LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', 300))
+LOG_MAX_LINE_CHARS = int(os.getenv('LOG_MAX_LINE_CHARS', 8000))
+# Opt-in: fraction of prompts logged in full (unredacted) for debugging
+LOG_CAPTURE_PROMPTS_RATE = float(os.getenv('LOG_CAPTURE_PROMPTS_RATE', 0))
+LOG_CAPTURE_MAX_CHARS = int(os.getenv('LOG_CAPTURE_MAX_CHARS', 20000))
+
+# Inbox delta sync: catches up on messages whose notification never arrived.
+# The deltaLink is kept in DynamoDB in the Lambda and in a JSON file locally;
+# the first sync (or one after the link expired) looks back DELTA_SYNC_LOOKBACK_HOURS
+DELTA_SYNC_ENABLED = os.getenv('DELTA_SYNC_ENABLED', 'true').lower() == 'true'
+DELTA_SYNC_BACKEND = os.getenv('DELTA_SYNC_BACKEND')
+DELTA_SYNC_STATE_FILE = os.getenv('DELTA_SYNC_STATE_FILE', 'delta_link.json')
+DELTA_SYNC_PAGE_SIZE = int(os.getenv('DELTA_SYNC_PAGE_SIZE', 50))
+DELTA_SYNC_LOOKBACK_HOURS = float(os.getenv('DELTA_SYNC_LOOKBACK_HOURS', 24))
+
+# Rich notifications: the subscription includes the new message, encrypted with
+# our certificate, so processing skips get_message. PEMs come from the environment
+# (Lambda) or files; scripts/create_notification_cert.py creates them
+RICH_NOTIFICATIONS = os.getenv('RICH_NOTIFICATIONS', 'false').lower() == 'true'
+NOTIFICATION_CERTIFICATE_ID = os.getenv('NOTIFICATION_CERTIFICATE_ID', 'emailbot-notifications')
+NOTIFICATION_CERTIFICATE = os.getenv('NOTIFICATION_CERTIFICATE')
+NOTIFICATION_PRIVATE_KEY = os.getenv('NOTIFICATION_PRIVATE_KEY')
+NOTIFICATION_CERTIFICATE_FILE = os.getenv('NOTIFICATION_CERTIFICATE_FILE', 'notification_cert.pem')
+NOTIFICATION_PRIVATE_KEY_FILE = os.getenv('NOTIFICATION_PRIVATE_KEY_FILE', 'notification_key.pem')
+
+# Inbox subscription: its ID and expiry are kept (DynamoDB in the Lambda,
+# subscription.json locally) so scheduled runs only call Graph to renew it
+# once it expires within SUBSCRIPTION_RENEWAL_WINDOW_HOURS. Lifecycle
+# notifications go to the notification URL unless LIFECYCLE_NOTIFICATION_URL is set
+SUBSCRIPTION_STATE_BACKEND = os.getenv('SUBSCRIPTION_STATE_BACKEND')
+SUBSCRIPTION_STATE_FILE = os.getenv('SUBSCRIPTION_STATE_FILE', 'subscription.json')
+SUBSCRIPTION_LIFETIME_DAYS = float(os.getenv('SUBSCRIPTION_LIFETIME_DAYS', 2))
+SUBSCRIPTION_RENEWAL_WINDOW_HOURS = float(os.getenv('SUBSCRIPTION_RENEWAL_WINDOW_HOURS', 12))
+LIFECYCLE_NOTIFICATION_URL = os.getenv('LIFECYCLE_NOTIFICATION_URL')
+
 # Webhook Configuration
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 5000))
@@ -25,9 +193,34 @@ PORT = int(os.getenv('PORT', 5000))
 # LLM Configuration - Google Gemini
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
+ANTHROPIC_MODEL = os.getenv('ANTHROPIC_MODEL', 'claude-3-haiku-20240307')
+
+# Prompt size limit (estimated input tokens) per model. The same prompt can go to
+# any provider in LLM_PROVIDERS (hedging, failover), so it is sized for the
+# smallest budget among their models; PROMPT_TOKEN_BUDGET overrides it
+PROMPT_TOKEN_BUDGETS = {
+    'gemini-1.5-flash': 6000,
+    'gemini-1.5-pro': 12000,
+    'gemini-2.0-flash': 6000,
+    'gpt-4o-mini': 6000,
+    'gpt-4o': 12000,
+    'claude-3-haiku-20240307': 6000,
+    'claude-3-5-sonnet-20241022': 12000,
+    'fake': 6000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 4000
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 0)) or None
+# Characters of each thread message kept in the history (the prompt budget bounds the total)
+HISTORY_ENTRY_MAX_CHARS = int(os.getenv('HISTORY_ENTRY_MAX_CHARS', 4000))
 
 # User Configuration
 USER_EMAIL = os.getenv('USER_EMAIL')
 
 # Token storage
 TOKEN_FILE = 'tokens.json'
+
+# Refresh access tokens this many seconds before they actually expire
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv('TOKEN_REFRESH_MARGIN_SECONDS', 300))
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+import threading
+import time
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+class ConversationCache:
+    """
+    Remembers the cleaned history entries of each conversation plus the newest
+    receivedDateTime seen (the high-water mark), so later thread fetches only
+    need messages received after it.
+    """
+    
+    def __init__(self, ttl_seconds=None, max_entries=None):
+        self.ttl_seconds = ttl_seconds or config.CONVERSATION_CACHE_TTL_SECONDS
+        self.max_entries = max_entries or config.CONVERSATION_CACHE_MAX_ENTRIES
+    
+    def get(self, conversation_id):
+        """Return {'entries': [...], 'high_water': str} or None if missing/expired"""
+        raise NotImplementedError
+    
+    def put(self, conversation_id, entries, high_water):
+        raise NotImplementedError
+    
+    def merge(self, cached, new_entries):
+        """Append newly fetched entries to the cached ones (oldest first, no duplicates)"""
+        entries = list(cached['entries']) if cached else []
+        seen = {entry.get('id') for entry in entries}
+        for entry in new_entries:
+            if entry.get('id') not in seen:
+                entries.append(entry)
+                seen.add(entry.get('id'))
+        
+        entries.sort(key=lambda entry: entry.get('received', ''))
+        # Size eviction: keep only the most recent messages of long threads
+        return entries[-self.max_entries:]
+    
+    def _expires_at(self):
+        return int(time.time() + self.ttl_seconds)
+
+class SQLiteConversationCache(ConversationCache):
+    """Conversation cache in a local SQLite file (used by scripts/server.py)"""
+    
+    def __init__(self, db_path=None, max_conversations=None, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path or config.CONVERSATION_CACHE_DB
+        self.max_conversations = max_conversations or config.CONVERSATION_CACHE_MAX_CONVERSATIONS
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                ' conversation_id TEXT PRIMARY KEY,'
+                ' entries TEXT NOT NULL,'
+                ' high_water TEXT,'
+                ' expires_at INTEGER NOT NULL,'
+                ' updated_at REAL NOT NULL)'
+            )
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def get(self, conversation_id):
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                'SELECT entries, high_water, expires_at FROM conversations WHERE conversation_id = ?',
+                (conversation_id,)
+            ).fetchone()
+        
+        if not row or row[2] < time.time():
+            return None
+        return {'entries': json.loads(row[0]), 'high_water': row[1]}
+    
+    def put(self, conversation_id, entries, high_water):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)',
+                (conversation_id, json.dumps(entries, ensure_ascii=False), high_water,
+                 self._expires_at(), now)
+            )
+            # TTL and size eviction: drop expired rows, then least recently updated ones
+            conn.execute('DELETE FROM conversations WHERE expires_at < ?', (now,))
+            conn.execute(
+                'DELETE FROM conversations WHERE conversation_id NOT IN ('
+                ' SELECT conversation_id FROM conversations ORDER BY updated_at DESC LIMIT ?)',
+                (self.max_conversations,)
+            )
+
+class DynamoDBConversationCache(ConversationCache):
+    """
+    Conversation cache in the bot's DynamoDB table (used by the Lambda).
+    Items are stored as conversation_<id> with an expires_at TTL attribute.
+    """
+    
+    # DynamoDB items are capped at 400 KB; stay well below that
+    MAX_ITEM_BYTES = 300 * 1024
+    
+    def __init__(self, table, **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+    
+    def _key(self, conversation_id):
+        return {'token_id': f'conversation_{conversation_id}'}
+    
+    def get(self, conversation_id):
+        try:
+            response = self.table.get_item(Key=self._key(conversation_id))
+        except Exception as e:
+            log.warning("Failed to read conversation cache", error=str(e))
+            return None
+        
+        item = response.get('Item')
+        # DynamoDB TTL deletes lazily, so check expiry ourselves as well
+        if not item or int(item.get('expires_at', 0)) < time.time():
+            return None
+        return {'entries': json.loads(item['entries']), 'high_water': item.get('high_water')}
+    
+    def put(self, conversation_id, entries, high_water):
+        serialized = json.dumps(entries, ensure_ascii=False)
+        while len(serialized.encode('utf-8')) > self.MAX_ITEM_BYTES and entries:
+            entries = entries[1:]
+            serialized = json.dumps(entries, ensure_ascii=False)
+        
+        item = {
+            **self._key(conversation_id),
+            'entries': serialized,
+            'expires_at': self._expires_at()
+        }
+        if high_water:
+            item['high_water'] = high_water
+        
+        try:
+            self.table.put_item(Item=item)
+        except Exception as e:
+            log.warning("Failed to write conversation cache", error=str(e))
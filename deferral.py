@@ -0,0 +1,120 @@
+"""
+Deferred notifications: message IDs a Lambda invocation had no time left
+to process. The interface follows SQS (send / receive / delete by receipt),
+so the production backend is a plain SQS queue and tests or local runs can
+use the in-memory or SQLite implementations.
+"""
+import itertools
+import json
+import threading
+
+import config
+
+class DeferralQueue:
+    """SQS-style queue of deferred message IDs"""
+    
+    def send(self, message_ids):
+        raise NotImplementedError
+    
+    def receive(self, max_messages=10):
+        """Return up to max_messages [{'receipt': ..., 'message_id': ...}]"""
+        raise NotImplementedError
+    
+    def delete(self, receipts):
+        raise NotImplementedError
+
+class InMemoryDeferralQueue(DeferralQueue):
+    """Deferral queue for tests; contents only live as long as the container"""
+    
+    def __init__(self):
+        self._items = {}
+        self._receipts = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def send(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._items[next(self._receipts)] = message_id
+    
+    def receive(self, max_messages=10):
+        with self._lock:
+            receipts = list(self._items)[:max_messages]
+            return [{'receipt': receipt, 'message_id': self._items[receipt]} for receipt in receipts]
+    
+    def delete(self, receipts):
+        with self._lock:
+            for receipt in receipts:
+                self._items.pop(receipt, None)
+
+class SQLiteDeferralQueue(DeferralQueue):
+    """Deferral queue on top of the local WorkQueue (visibility timeout included)"""
+    
+    def __init__(self, db_path=None):
+        from work_queue import WorkQueue
+        self.queue = WorkQueue(db_path or config.DEFERRAL_QUEUE_DB)
+    
+    def send(self, message_ids):
+        self.queue.enqueue(message_ids)
+    
+    def receive(self, max_messages=10):
+        return [{'receipt': job['id'], 'message_id': job['message_id']}
+                for job in self.queue.claim(max_messages)]
+    
+    def delete(self, receipts):
+        self.queue.ack(receipts)
+
+class SQSDeferralQueue(DeferralQueue):
+    """Deferral queue backed by Amazon SQS"""
+    
+    # SQS batch calls take at most 10 entries
+    BATCH_SIZE = 10
+    
+    def __init__(self, queue_url=None, client=None):
+        self.queue_url = queue_url or config.DEFERRAL_QUEUE_URL
+        self._client = client
+    
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('sqs')
+        return self._client
+    
+    def send(self, message_ids):
+        message_ids = list(message_ids)
+        for start in range(0, len(message_ids), self.BATCH_SIZE):
+            chunk = message_ids[start:start + self.BATCH_SIZE]
+            response = self.client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'MessageBody': json.dumps({'message_id': message_id})}
+                         for index, message_id in enumerate(chunk)]
+            )
+            if response.get('Failed'):
+                raise Exception(f"Failed to defer {len(response['Failed'])} messages: {response['Failed']}")
+    
+    def receive(self, max_messages=10):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_messages, self.BATCH_SIZE)
+        )
+        return [{'receipt': message['ReceiptHandle'], 'message_id': json.loads(message['Body'])['message_id']}
+                for message in response.get('Messages', [])]
+    
+    def delete(self, receipts):
+        receipts = list(receipts)
+        for start in range(0, len(receipts), self.BATCH_SIZE):
+            chunk = receipts[start:start + self.BATCH_SIZE]
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(chunk)]
+            )
+
+def create_deferral_queue(backend=None):
+    """Deferral queue for DEFERRAL_BACKEND ('sqs', 'sqlite' or 'memory')"""
+    backend = backend or config.DEFERRAL_BACKEND
+    if backend == 'sqs':
+        return SQSDeferralQueue()
+    if backend == 'sqlite':
+        return SQLiteDeferralQueue()
+    if backend == 'memory':
+        return InMemoryDeferralQueue()
+    raise Exception(f"Unknown deferral backend: {backend}")
@@ -0,0 +1,153 @@
+"""
+Catch-up sync of the inbox with a Graph delta query.
+
+Notifications get lost (a lapsed subscription, a webhook outage), so the
+inbox is also synced with /me/mailFolders/inbox/messages/delta. The
+deltaLink of the last sync is persisted (DynamoDB for the Lambda, a JSON
+file for local runs) and the next sync only sees messages created since.
+Each page of message IDs goes to the caller's process function as soon as
+it arrives, which takes it through the usual idempotent path (claim, then
+process), so messages already handled from a notification are skipped
+and the inbox is never held in memory.
+"""
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import config
+from metrics import metrics
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+class DeltaLinkStore:
+    """Where the deltaLink of the last completed sync is kept"""
+    
+    def load(self):
+        raise NotImplementedError
+    
+    def save(self, delta_link):
+        raise NotImplementedError
+    
+    def clear(self):
+        raise NotImplementedError
+
+class MemoryDeltaLinkStore(DeltaLinkStore):
+    """deltaLink for tests; lost with the process"""
+    
+    def __init__(self):
+        self.delta_link = None
+    
+    def load(self):
+        return self.delta_link
+    
+    def save(self, delta_link):
+        self.delta_link = delta_link
+    
+    def clear(self):
+        self.delta_link = None
+
+class FileDeltaLinkStore(DeltaLinkStore):
+    """deltaLink in a local JSON file (used by scripts/server.py)"""
+    
+    def __init__(self, path=None):
+        self.path = path or config.DELTA_SYNC_STATE_FILE
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f).get('delta_link')
+    
+    def save(self, delta_link):
+        # Write then rename, so a crash never leaves half a link behind
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'delta_link': delta_link, 'updated_at': time.time()}, f)
+        os.replace(temp_path, self.path)
+    
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DynamoDBDeltaLinkStore(DeltaLinkStore):
+    """deltalink_inbox item in the bot's DynamoDB table"""
+    
+    KEY = {'token_id': 'deltalink_inbox'}
+    
+    def __init__(self, table):
+        self.table = table
+    
+    def load(self):
+        return self.table.get_item(Key=self.KEY).get('Item', {}).get('delta_link')
+    
+    def save(self, delta_link):
+        self.table.put_item(Item={**self.KEY, 'delta_link': delta_link, 'updated_at': int(time.time())})
+    
+    def clear(self):
+        self.table.delete_item(Key=self.KEY)
+
+def create_delta_link_store(default_backend, table=None):
+    """deltaLink store for DELTA_SYNC_BACKEND ('memory', 'file' or 'dynamodb'), else default_backend"""
+    backend = config.DELTA_SYNC_BACKEND or default_backend
+    if backend == 'memory':
+        return MemoryDeltaLinkStore()
+    if backend == 'file':
+        return FileDeltaLinkStore()
+    if backend == 'dynamodb':
+        return DynamoDBDeltaLinkStore(table)
+    raise Exception(f"Unknown delta sync backend: {backend}")
+
+class DeltaSync:
+    """Streams new inbox messages since the last sync to a process function"""
+    
+    def __init__(self, graph_client, store, lookback_hours=None, page_size=None):
+        self.graph_client = graph_client
+        self.store = store
+        self.lookback_hours = lookback_hours if lookback_hours is not None else config.DELTA_SYNC_LOOKBACK_HOURS
+        self.page_size = page_size or config.DELTA_SYNC_PAGE_SIZE
+    
+    def run(self, process):
+        """
+        Call process(message_ids) once per page of messages created since the
+        last sync, then save the new deltaLink. process returns False when it
+        could not keep the page (deferred without a durable queue): the sync then
+        stops and keeps the old deltaLink, so the next one sees those messages
+        again. Returns counts of the sync.
+        """
+        delta_link = self.store.load()
+        try:
+            return self._sync(delta_link, process)
+        except Exception as e:
+            # Graph answers 410 Gone once a delta token has expired: start over
+            if not delta_link or getattr(getattr(e, 'response', None), 'status_code', None) != 410:
+                raise
+            log.warning("Delta link expired, starting a new sync", error=str(e))
+            self.store.clear()
+            return self._sync(None, process, restarted=True)
+    
+    def _sync(self, delta_link, process, restarted=False):
+        received_since = None
+        if not delta_link:
+            # Without a link the delta query would walk the whole inbox
+            since = datetime.now(timezone.utc) - timedelta(hours=self.lookback_hours)
+            received_since = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+        
+        stats = {'pages': 0, 'messages': 0, 'restarted': restarted, 'complete': True}
+        next_delta_link = None
+        with metrics.span('delta_sync.run'):
+            pages = self.graph_client.iter_inbox_delta(delta_link, received_since=received_since,
+                                                       page_size=self.page_size)
+            for messages, next_delta_link in pages:
+                stats['pages'] += 1
+                stats['messages'] += len(messages)
+                if messages and process([message['id'] for message in messages]) is False:
+                    stats['complete'] = False
+                    break
+        
+        if next_delta_link and stats['complete']:
+            self.store.save(next_delta_link)
+        metrics.record('delta_sync.messages', stats['messages'])
+        log.info("Delta sync finished", initial=delta_link is None, **stats)
+        return stats
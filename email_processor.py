@@ -1,99 +1,463 @@
+import asyncio
 import html
-from graph_client import graph_client
+
+import config
+from graph_client import async_graph_client
+from html_text import html_to_text
+from intent_classifier import BULK_ONLY_INTENTS, intent_classifier, is_bulk_mail, reply_language
 from llm_service import llm_service
+from metrics import metrics
+from prompts.intent_replies import INTENT_REPLIES_BY_LANGUAGE, UNKNOWN_SENDER_NAME
+from structured_log import get_logger
+from thread_dedup import dedupe_conversation, strip_quoted
+
+log = get_logger(__name__)
 
 class EmailProcessor:
     """Processes incoming emails and generates draft replies"""
     
-    def process_email(self, message_id):
+    def __init__(self, conversation_cache=None, idempotency=None):
+        # Optional ConversationCache; without one every reply refetches the whole thread
+        self.conversation_cache = conversation_cache
+        # Optional Idempotency, used to skip copies of one email (DEDUP_BY_INTERNET_MESSAGE_ID)
+        self.idempotency = idempotency
+    
+    def process_email(self, message_id, message=None):
+        """Process one incoming email (sync wrapper around process_email_async)"""
+        return asyncio.run(self.process_email_async(message_id, message=message))
+    
+    def process_emails(self, message_ids, messages=None):
+        """Process several emails (sync wrapper around process_emails_async)"""
+        return asyncio.run(self.process_emails_async(message_ids, messages=messages))
+    
+    async def process_email_async(self, message_id, semaphore=None, message=None):
         """
         Process an incoming email:
-        1. Fetch email details
+        1. Fetch email details (unless a rich notification brought the message)
         2. Generate reply using LLM
         3. Create draft in Outlook
         """
+        with metrics.span('email.process'):
+            result = await self._process_email(message_id, semaphore, message)
+        self._count_result(result)
+        return result
+    
+    async def _process_email(self, message_id, semaphore, message=None):
+        claimed = {}
         try:
-            print(f"Processing email: {message_id}")
+            log.info("Processing email", message_id=message_id)
             
             # Get the email message
-            message = graph_client.get_message(message_id)
-            conversation_id = message.get('conversationId')
-            
-            # Extract email details
-            subject = message.get('subject', 'No Subject')
-            sender = message.get('from', {}).get('emailAddress', {}).get('address', 'Unknown')
-            body_content = message.get('body', {}).get('content', '')
-            body_type = message.get('body', {}).get('contentType', 'Text')
-            
-            # Convert HTML to plain text
-            if body_type == 'HTML':
-                plain_body = self._strip_html(body_content)
+            if message is None:
+                message = await async_graph_client.get_message(message_id, **self._fetch_options())
             else:
-                plain_body = body_content
+                metrics.increment('email.prefetched')
+            details = self._extract_details(message)
+            conversation_id = details['conversation_id']
+            
+            claimed, duplicates = await asyncio.to_thread(self._claim_copies, {message_id: details})
+            if duplicates:
+                return self._duplicate_result(message_id, details)
             
             # Fetch thread history
-            thread_history = ""
+            thread_history = []
+            body = details['body']
             if conversation_id:
                 try:
-                    print(f"Fetching thread history for conversation: {conversation_id}")
-                    threads = graph_client.get_conversation_threads(conversation_id)
-                    
-                    # Format threads for LLM
-                    history_list = []
-                    for msg in threads:
-                        # Skip the current message to avoid duplication in history
-                        if msg.get('id') == message_id:
-                            continue
-                            
-                        msg_sender = msg.get('from', {}).get('emailAddress', {}).get('name', 'Unknown')
-                        msg_content = msg.get('body', {}).get('content', '')
-                        clean_content = self._strip_html(msg_content)
-                        # Truncate very long messages
-                        if len(clean_content) > 1000:
-                            clean_content = clean_content[:1000] + "..."
-                            
-                        date = msg.get('receivedDateTime', '').split('T')[0]
-                        history_list.append(f"--- Message from {msg_sender} on {date} ---\n{clean_content}")
-                    
-                    thread_history = "\n\n".join(history_list)
+                    log.debug("Fetching thread history", message_id=message_id, conversation_id=conversation_id)
+                    cached = await asyncio.to_thread(self._cached_history, conversation_id)
+                    threads = await async_graph_client.get_conversation_threads(
+                        conversation_id, since=cached['high_water'] if cached else None, **self._fetch_options()
+                    )
+                    entries = await asyncio.to_thread(self._update_history, conversation_id, cached, threads)
+                    thread_history, body = self._build_context(entries, message_id, details)
                 except Exception as e:
-                    print(f"Warning: Failed to fetch thread history: {e}")
+                    log.warning("Failed to fetch thread history", message_id=message_id, error=str(e))
             
-            print(f"Email from: {sender}")
-            print(f"Subject: {subject}")
+            log.info("Email details", message_id=message_id, sender=details['sender'],
+                     subject=details['subject'], body=body, history_messages=len(thread_history))
+            
+            # Formulaic intents get a templated reply (or none) without the LLM
+            prompt_metadata = {}
+            reply_content = self._fast_path(details, body, thread_history)
+            if details.get('intent') and reply_content is None:
+                return self._skipped_result(message_id, details)
             
             # Generate reply using LLM
-            print("Generating reply with LLM...")
-            reply_content = llm_service.generate_reply(subject, plain_body, sender, thread_history)
+            if reply_content is None:
+                log.debug("Generating reply with LLM", message_id=message_id)
+                async with semaphore or asyncio.Semaphore(1):
+                    reply_content = await llm_service.generate_reply_async(
+                        details['subject'], body, details['sender'], thread_history,
+                        metadata=prompt_metadata, sender_name=details['sender_name']
+                    )
             
             # Create draft reply in Outlook
-            print("Creating draft reply in Outlook...")
-            draft = graph_client.create_reply_draft(message_id, reply_content)
-            
-            print(f"✓ Draft created successfully! Draft ID: {draft['id']}")
+            log.debug("Creating draft reply in Outlook", message_id=message_id)
+            draft = await async_graph_client.create_reply_draft(message_id, reply_content)
             
-            return {
-                'success': True,
-                'message_id': message_id,
-                'draft_id': draft['id'],
-                'subject': subject,
-                'sender': sender
-            }
+            log.info("Draft created", message_id=message_id, draft_id=draft['id'])
             
+            return self._success_result(message_id, details, draft, prompt_metadata)
+        
         except Exception as e:
-            print(f"✗ Error processing email: {str(e)}")
-            return {
-                'success': False,
-                'message_id': message_id,
-                'error': str(e)
-            }
-    
-    def _strip_html(self, html_content):
-        """Strip HTML tags from content"""
-        # Simple HTML stripping (you might want to use BeautifulSoup for better results)
-        import re
-        text = re.sub('<[^<]+?>', '', html_content)
-        return html.unescape(text)
+            await asyncio.to_thread(self._release_copy, claimed, message_id)
+            return self._failure_result(message_id, e)
+    
+    async def process_emails_async(self, message_ids, concurrency=None, messages=None):
+        """
+        Process several emails, sharing Graph round trips through $batch:
+        one batch fetches the messages, one their threads and two create the drafts.
+        Replies are generated concurrently, at most PROCESS_CONCURRENCY at a time.
+        messages optionally maps message IDs to messages already at hand (from rich
+        notifications), which are not fetched again.
+        Returns one result dict per message ID, in the same order.
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        messages = messages or {}
+        semaphore = asyncio.Semaphore(concurrency or config.PROCESS_CONCURRENCY)
+        if len(message_ids) <= 1:
+            return [await self.process_email_async(message_id, semaphore, messages.get(message_id))
+                    for message_id in message_ids]
+        
+        with metrics.span('email.batch'):
+            results = await self._process_batch(message_ids, semaphore, messages)
+        metrics.record('email.batch_size', len(message_ids))
+        for result in results:
+            self._count_result(result)
+        return results
+    
+    async def _process_batch(self, message_ids, semaphore, prefetched=None):
+        log.info("Processing emails in batch", count=len(message_ids))
+        results = {}
+        
+        # 1. Fetch all messages not delivered with their notification
+        prefetched = prefetched or {}
+        messages = {message_id: prefetched[message_id] for message_id in message_ids if message_id in prefetched}
+        missing = [message_id for message_id in message_ids if message_id not in messages]
+        if messages:
+            metrics.increment('email.prefetched', len(messages))
+        if missing:
+            try:
+                messages.update(await async_graph_client.get_messages(missing, **self._fetch_options()))
+            except Exception as e:
+                return [self._failure_result(message_id, e) for message_id in message_ids]
+        
+        details = {}
+        for message_id in message_ids:
+            message = messages.get(message_id)
+            if isinstance(message, Exception):
+                results[message_id] = self._failure_result(message_id, message)
+            else:
+                details[message_id] = self._extract_details(message)
+        
+        claimed, duplicates = await asyncio.to_thread(self._claim_copies, details)
+        for message_id in duplicates:
+            results[message_id] = self._duplicate_result(message_id, details.pop(message_id))
+        
+        # 2. Fetch the thread of every conversation involved (only messages newer than the cache)
+        conversation_ids = {d['conversation_id'] for d in details.values() if d['conversation_id']}
+        histories = {}
+        if conversation_ids:
+            try:
+                cached = {conversation_id: await asyncio.to_thread(self._cached_history, conversation_id)
+                          for conversation_id in conversation_ids}
+                threads = await async_graph_client.get_conversation_threads_batch(
+                    conversation_ids,
+                    since={key: value['high_water'] for key, value in cached.items() if value},
+                    **self._fetch_options()
+                )
+                for conversation_id, conversation_threads in threads.items():
+                    if isinstance(conversation_threads, Exception):
+                        log.warning("Failed to fetch thread history", conversation_id=conversation_id,
+                                    error=str(conversation_threads))
+                        continue
+                    histories[conversation_id] = await asyncio.to_thread(
+                        self._update_history, conversation_id, cached[conversation_id], conversation_threads
+                    )
+            except Exception as e:
+                log.warning("Failed to fetch thread histories", error=str(e))
+        
+        # 3. Generate replies concurrently
+        prompt_metadata = {message_id: {} for message_id in details}
+        
+        async def generate(message_id, message_details):
+            thread_history = []
+            body = message_details['body']
+            entries = histories.get(message_details['conversation_id'])
+            if entries:
+                thread_history, body = self._build_context(entries, message_id, message_details)
+            
+            reply_content = self._fast_path(message_details, body, thread_history)
+            if reply_content is not None or message_details.get('intent'):
+                return reply_content
+            
+            async with semaphore:
+                log.debug("Generating reply with LLM", message_id=message_id)
+                return await llm_service.generate_reply_async(
+                    message_details['subject'], body,
+                    message_details['sender'], thread_history,
+                    metadata=prompt_metadata[message_id], sender_name=message_details['sender_name']
+                )
+        
+        generated = await asyncio.gather(
+            *(generate(message_id, message_details) for message_id, message_details in details.items()),
+            return_exceptions=True
+        )
+        replies = {}
+        for message_id, reply in zip(details, generated):
+            if isinstance(reply, Exception):
+                await asyncio.to_thread(self._release_copy, claimed, message_id)
+                results[message_id] = self._failure_result(message_id, reply)
+            elif reply is None:
+                results[message_id] = self._skipped_result(message_id, details[message_id])
+            else:
+                replies[message_id] = reply
+        
+        # 4. Create all drafts
+        if replies:
+            try:
+                drafts = await async_graph_client.create_reply_drafts(replies)
+            except Exception as e:
+                drafts = {message_id: e for message_id in replies}
+            
+            for message_id, draft in drafts.items():
+                if isinstance(draft, Exception):
+                    await asyncio.to_thread(self._release_copy, claimed, message_id)
+                    results[message_id] = self._failure_result(message_id, draft)
+                else:
+                    log.info("Draft created", message_id=message_id, draft_id=draft['id'])
+                    results[message_id] = self._success_result(
+                        message_id, details[message_id], draft, prompt_metadata[message_id]
+                    )
+        
+        return [results[message_id] for message_id in message_ids]
+    
+    def _count_result(self, result):
+        """Count a processed message by outcome (drafted, skipped, duplicate or failed)"""
+        metrics.add('email.processed', 1)
+        if not result['success']:
+            metrics.increment('email.failed')
+        elif result.get('duplicate'):
+            metrics.increment('email.duplicates')
+        elif result.get('skipped'):
+            metrics.increment('email.skipped')
+        else:
+            metrics.increment('email.drafted')
+    
+    def _fetch_options(self):
+        """Projection used for every message fetch (see MESSAGE_SELECT_FIELDS)"""
+        select = config.MESSAGE_SELECT_FIELDS
+        if config.DEDUP_BY_INTERNET_MESSAGE_ID and 'internetMessageId' not in select:
+            select += ',internetMessageId'
+        return {
+            'select': select,
+            'text_body': config.GRAPH_TEXT_BODIES
+        }
+    
+    def _extract_details(self, message):
+        """Pull the fields we need out of a Graph message"""
+        subject = message.get('subject', 'No Subject')
+        sender = message.get('from', {}).get('emailAddress', {}).get('address', 'Unknown')
+        sender_name = message.get('from', {}).get('emailAddress', {}).get('name', 'Unknown')
+        plain_body = self._plain_body(message)
+        metrics.record('email.body_bytes', len(plain_body.encode('utf-8')), 'Bytes')
+        
+        return {
+            'conversation_id': message.get('conversationId'),
+            'subject': subject,
+            'sender': sender,
+            'sender_name': sender_name,
+            'internet_message_id': message.get('internetMessageId'),
+            # Needed before skipping mail as a newsletter (intent_classifier.BULK_ONLY_INTENTS)
+            'bulk': is_bulk_mail(sender, message.get('internetMessageHeaders')),
+            'body': plain_body
+        }
+    
+    def _claim_copies(self, details):
+        """
+        With DEDUP_BY_INTERNET_MESSAGE_ID, claim the internetMessageId of each message
+        so a copy of the same email in another mailbox or folder is not drafted twice.
+        Returns ({message_id: claimed key}, {message_ids of duplicate copies})
+        """
+        if not (config.DEDUP_BY_INTERNET_MESSAGE_ID and self.idempotency):
+            return {}, set()
+        
+        keys = {message_id: f"imid_{message_details['internet_message_id']}"
+                for message_id, message_details in details.items()
+                if message_details.get('internet_message_id')}
+        available = set(self.idempotency.claim(keys.values()))
+        claimed, duplicates = {}, set()
+        for message_id, key in keys.items():
+            if key in available:
+                claimed[message_id] = key
+                # A second copy within the same payload is a duplicate as well
+                available.discard(key)
+            else:
+                duplicates.add(message_id)
+        return claimed, duplicates
+    
+    def _release_copy(self, claimed, message_id):
+        """Let a message that failed be retried under its internetMessageId"""
+        if message_id in claimed:
+            self.idempotency.release([claimed.pop(message_id)])
+    
+    def _history_cache_key(self, conversation_id):
+        """
+        Conversation cache key: entries cleaned with other settings (entry length
+        limit, quote stripping) are a different cache, not stale hits
+        """
+        return f"{conversation_id}:{config.HISTORY_ENTRY_MAX_CHARS}:{int(config.STRIP_QUOTED_REPLIES)}"
+    
+    def _cached_history(self, conversation_id):
+        """Cached history of a conversation, or None"""
+        if not self.conversation_cache:
+            return None
+        return self.conversation_cache.get(self._history_cache_key(conversation_id))
+    
+    def _update_history(self, conversation_id, cached, threads):
+        """Combine cached entries with newly fetched messages and store the result"""
+        new_entries = [self._history_entry(msg) for msg in threads]
+        if not self.conversation_cache:
+            return new_entries
+        
+        entries = self.conversation_cache.merge(cached, new_entries)
+        received = [entry['received'] for entry in entries if entry['received']]
+        if cached and cached.get('high_water'):
+            received.append(cached['high_water'])
+        self.conversation_cache.put(self._history_cache_key(conversation_id), entries,
+                                    max(received) if received else None)
+        return entries
+    
+    def _history_entry(self, msg):
+        """Clean a thread message once, in the form we cache and format"""
+        # Only convert as much of the body as we keep (one extra char tells us it was cut)
+        max_chars = config.HISTORY_ENTRY_MAX_CHARS
+        clean_content = self._plain_body(msg, max_chars=max_chars + 1)
+        if config.STRIP_QUOTED_REPLIES:
+            # Keep only what this message added; the quoted part is its own entry
+            clean_content = strip_quoted(clean_content)
+        # Truncate very long messages
+        if len(clean_content) > max_chars:
+            clean_content = clean_content[:max_chars] + "..."
+        
+        return {
+            'id': msg.get('id'),
+            'sender': msg.get('from', {}).get('emailAddress', {}).get('name', 'Unknown'),
+            'received': msg.get('receivedDateTime', ''),
+            'content': clean_content
+        }
+    
+    def _fast_path(self, details, body, thread_history):
+        """
+        Classify the message locally (INTENT_FAST_PATH). For a confident known intent,
+        record it in details['intent'] and return its templated reply HTML, or None
+        for intents that get no reply at all. Returns None without setting an intent
+        when the LLM should answer.
+        """
+        if not config.INTENT_FAST_PATH:
+            return None
+        
+        intent, confidence = intent_classifier.classify(details['subject'], body)
+        language = reply_language(details['subject'], body)
+        replies = INTENT_REPLIES_BY_LANGUAGE[language]
+        if intent not in replies:
+            return None
+        # "Please unsubscribe me" from a customer reads like a newsletter too
+        if intent in BULK_ONLY_INTENTS and not details.get('bulk'):
+            log.info("Intent without bulk mail evidence, using the LLM", intent=intent, confidence=confidence)
+            return None
+        template = replies[intent]
+        # A templated answer only suits the first message of a conversation; replies
+        # within an ongoing thread need its context
+        if template is not None and thread_history:
+            log.info("Intent in an ongoing thread, using the LLM", intent=intent, confidence=confidence)
+            return None
+        
+        log.info("Intent fast path", intent=intent, confidence=confidence, language=language)
+        metrics.increment('email.fast_path')
+        details['intent'] = intent
+        if template is None:
+            return None
+        name = details['sender_name'] if details['sender_name'] != 'Unknown' else UNKNOWN_SENDER_NAME[language]
+        return template.format(sender_name=html.escape(name))
+    
+    def _build_context(self, entries, message_id, details):
+        """
+        Thread history entries (oldest first, current message excluded) and current
+        body for the prompt; LLMService fits them into its token budget. With
+        STRIP_QUOTED_REPLIES the quotes, repeated paragraphs and signatures already
+        present elsewhere in the conversation are removed, so each piece of content
+        appears once.
+        """
+        history = [entry for entry in entries if entry['id'] != message_id]
+        body = details['body']
+        if config.STRIP_QUOTED_REPLIES and history:
+            texts = dedupe_conversation(
+                [(entry['sender'], entry['content']) for entry in history] +
+                [(details['sender_name'], strip_quoted(body))]
+            )
+            history = [dict(entry, content=text) for entry, text in zip(history, texts)]
+            body = texts[-1]
+        
+        metrics.record('email.history_messages', len(history))
+        return history, body
+    
+    def _plain_body(self, message, max_chars=None):
+        """Message body as plain text (Graph already converts it when GRAPH_TEXT_BODIES is on)"""
+        body_content = message.get('body', {}).get('content', '')
+        body_type = message.get('body', {}).get('contentType', 'Text')
+        
+        # Convert HTML to plain text
+        if body_type.lower() == 'html':
+            return self._strip_html(body_content, max_chars)
+        return body_content if max_chars is None else body_content[:max_chars]
+    
+    def _success_result(self, message_id, details, draft, prompt_metadata=None):
+        return {
+            'success': True,
+            'message_id': message_id,
+            'draft_id': draft['id'],
+            'subject': details['subject'],
+            'sender': details['sender'],
+            'prompt': prompt_metadata or {},
+            'intent': details.get('intent')
+        }
+    
+    def _skipped_result(self, message_id, details):
+        log.info("Skipping message that needs no reply", message_id=message_id, intent=details['intent'])
+        return {
+            'success': True,
+            'message_id': message_id,
+            'draft_id': None,
+            'subject': details['subject'],
+            'sender': details['sender'],
+            'intent': details['intent'],
+            'skipped': True
+        }
+    
+    def _duplicate_result(self, message_id, details):
+        log.info("Skipping copy of an email already processed", message_id=message_id)
+        return {
+            'success': True,
+            'message_id': message_id,
+            'draft_id': None,
+            'subject': details['subject'],
+            'sender': details['sender'],
+            'duplicate': True
+        }
+    
+    def _failure_result(self, message_id, error):
+        log.error("Error processing email", message_id=message_id, error=str(error))
+        return {
+            'success': False,
+            'message_id': message_id,
+            'error': str(error)
+        }
+    
+    def _strip_html(self, html_content, max_chars=None):
+        """Convert HTML content to plain text, stopping after max_chars if given"""
+        return html_to_text(html_content, max_chars=max_chars)
 
 # Singleton instance
 email_processor = EmailProcessor()
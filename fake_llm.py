@@ -0,0 +1,96 @@
+"""
+Stand-in for a Gemini GenerativeModel, for measuring the reply pipeline
+without network calls or an API key.
+
+FakeModel.generate_content answers with a canned reply after a simulated
+time to first token, then "generates" it at a fixed rate; with stream=True
+the reply arrives in chunks as it is generated, like the real SDK. A
+reply can be followed by filler the model keeps producing after its
+sign-off, which is what streaming cut-off saves.
+"""
+import time
+
+DEFAULT_REPLY = """<p>Dear Customer,</p>
+<p>Thank you for contacting K Glowing. We are sorry to hear that your order has not arrived yet.</p>
+<p>Please contact your local DHL office with the tracking number we sent you when your order shipped.
+We will also let the brand know so they can follow up on their side.</p>
+<p>Best regards,<br>K Glowing Customer Support</p>
+"""
+
+DEFAULT_TRAILER = """<p>P.S. If you have any other questions about our products, shipping times,
+wholesale pricing or returns, please do not hesitate to reach out. We are always happy to help,
+and you can also find answers to common questions on our website.</p>
+"""
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    """Response of generate_content; iterating a streamed one yields FakeChunks as they are generated"""
+    
+    def __init__(self, model, prompt, text, stream):
+        self._model = model
+        self._prompt = prompt
+        self._text = text
+        self._stream = stream
+        self.usage_metadata = None
+        if not stream:
+            model._wait(model.first_token_seconds + len(text) / model.chars_per_second)
+            self._finish(text)
+    
+    @property
+    def text(self):
+        return self._text
+    
+    def __iter__(self):
+        if not self._stream:
+            yield FakeChunk(self._text)
+            return
+        self._model._wait(self._model.first_token_seconds)
+        for start in range(0, len(self._text), self._model.chunk_chars):
+            chunk = self._text[start:start + self._model.chunk_chars]
+            if start:
+                self._model._wait(len(chunk) / self._model.chars_per_second)
+            self._model.chars_generated += len(chunk)
+            yield FakeChunk(chunk)
+        self._finish(self._text)
+    
+    def _finish(self, text):
+        if not self._stream:
+            self._model.chars_generated += len(text)
+        # Same rough 4 characters per token as prompt_builder.estimate_tokens
+        self.usage_metadata = FakeUsage(len(self._prompt) // 4, len(text) // 4)
+
+class FakeModel:
+    """
+    Fake GenerativeModel: replies with reply + trailer after first_token_seconds,
+    generating chars_per_second and streaming chunk_chars at a time. chars_generated
+    counts what was actually produced, so an early cut-off shows up there.
+    """
+    
+    def __init__(self, reply=DEFAULT_REPLY, trailer=DEFAULT_TRAILER, first_token_seconds=0.4,
+                 chars_per_second=1500, chunk_chars=60, sleep=True):
+        self.reply = reply
+        self.trailer = trailer
+        self.first_token_seconds = first_token_seconds
+        self.chars_per_second = chars_per_second
+        self.chunk_chars = chunk_chars
+        # With sleep=False replies come back at once (functional checks only)
+        self.sleep = sleep
+        self.calls = 0
+        self.chars_generated = 0
+    
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        self.calls += 1
+        return FakeResponse(self, prompt, self.reply + self.trailer, stream)
+    
+    def _wait(self, seconds):
+        if self.sleep:
+            time.sleep(seconds)
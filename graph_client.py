@@ -1,4 +1,189 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import config
+from metrics import metrics
+
+# Subscriptions with includeResourceData on messages must expire within a day
+RICH_SUBSCRIPTION_MAX_MINUTES = 1439
+
+class ConnectionStats:
+    """
+    Process-wide totals of Graph requests and the TCP+TLS handshakes they needed
+    (for /health); each handshake is also recorded as graph.handshakes/graph.handshake_ms metrics
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.handshakes = 0
+        self.handshake_seconds = 0.0
+    
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+    
+    def record_handshake(self, seconds):
+        with self._lock:
+            self.handshakes += 1
+            self.handshake_seconds += seconds
+    
+    def snapshot(self):
+        """Current counters as a dict"""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'handshakes': self.handshakes,
+                'handshake_ms': round(self.handshake_seconds * 1000, 1),
+            }
+
+connection_stats = ConnectionStats()
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that reports how long each new connection took to set up"""
+    
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        seconds = time.perf_counter() - start
+        connection_stats.record_handshake(seconds)
+        metrics.increment('graph.handshakes')
+        metrics.record('graph.handshake_ms', round(seconds * 1000, 2), 'Milliseconds')
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _GraphHTTPAdapter(HTTPAdapter):
+    """Keep-alive adapter whose pools use the timed connection class"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            self.poolmanager.pool_classes_by_scheme,
+            https=_TimedHTTPSConnectionPool
+        )
+
+class GraphBatch:
+    """
+    Queues independent Graph requests and sends them as JSON $batch envelopes.
+    
+    Requests linked through depends_on are always sent in the same envelope
+    (Graph only honours dependsOn within one batch), so a dependency chain
+    may not be longer than MAX_REQUESTS.
+    """
+    
+    MAX_REQUESTS = 20
+    
+    def __init__(self, client, max_requests=None):
+        self.client = client
+        self.max_requests = min(max_requests or config.GRAPH_BATCH_MAX_REQUESTS, self.MAX_REQUESTS)
+        self._requests = []
+    
+    def __len__(self):
+        return len(self._requests)
+    
+    def add(self, method, url, body=None, headers=None, depends_on=None):
+        """
+        Queue a request. url is relative to the API version, e.g. '/me/messages/{id}'.
+        Returns the request id used to look up the response after execute().
+        """
+        request_id = str(len(self._requests) + 1)
+        request = {'id': request_id, 'method': method, 'url': url}
+        
+        if body is not None:
+            request['body'] = body
+            headers = dict(headers or {})
+            headers.setdefault('Content-Type', 'application/json')
+        if headers:
+            request['headers'] = headers
+        if depends_on:
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            request['dependsOn'] = list(depends_on)
+        
+        self._requests.append(request)
+        return request_id
+    
+    def _chunks(self):
+        """Split queued requests into envelopes, keeping dependency chains together"""
+        # Union requests that depend on each other into groups
+        parent = {request['id']: request['id'] for request in self._requests}
+        
+        def find(request_id):
+            while parent[request_id] != request_id:
+                parent[request_id] = parent[parent[request_id]]
+                request_id = parent[request_id]
+            return request_id
+        
+        for request in self._requests:
+            for dependency in request.get('dependsOn', []):
+                if dependency not in parent:
+                    raise Exception(f"Batch request {request['id']} depends on unknown request {dependency}")
+                parent[find(request['id'])] = find(dependency)
+        
+        groups = {}
+        for request in self._requests:
+            groups.setdefault(find(request['id']), []).append(request)
+        
+        # Pack whole groups into envelopes in submission order
+        chunks = [[]]
+        for group in groups.values():
+            if len(group) > self.max_requests:
+                raise Exception(f"Dependency chain of {len(group)} requests does not fit in one batch")
+            if len(chunks[-1]) + len(group) > self.max_requests:
+                chunks.append([])
+            chunks[-1].extend(group)
+        return [chunk for chunk in chunks if chunk]
+    
+    def execute(self):
+        """
+        Send every queued request and return {request_id: response}, where each
+        response is a dict with 'status', 'headers' and 'body'.
+        """
+        url = f'{self.client.BASE_URL}/$batch'
+        responses = {}
+        
+        for chunk in self._chunks():
+            response = self.client._request('POST', url, operation='batch', json={'requests': chunk})
+            for item in response.json().get('responses', []):
+                responses[item['id']] = item
+            
+            # Retry throttled requests once, after the longest Retry-After Graph asked for
+            throttled = [request for request in chunk
+                         if responses.get(request['id'], {}).get('status') == 429
+                         and not request.get('dependsOn')]
+            if throttled:
+                delay = max(int((responses[request['id']].get('headers') or {}).get('Retry-After', 1))
+                            for request in throttled)
+                time.sleep(min(delay, config.GRAPH_BATCH_MAX_RETRY_AFTER))
+                response = self.client._request('POST', url, operation='batch', json={'requests': throttled})
+                for item in response.json().get('responses', []):
+                    responses[item['id']] = item
+        
+        self._requests = []
+        return responses
+    
+    @staticmethod
+    def result(response):
+        """Return the body of a batch response, raising if the request failed"""
+        if response is None:
+            raise Exception("No response returned for batch request")
+        
+        status = response.get('status', 500)
+        body = response.get('body')
+        if status >= 400:
+            error = body.get('error', {}) if isinstance(body, dict) else {}
+            raise Exception(f"Graph batch request failed ({status}): {error.get('message', body)}")
+        return body
 
 class GraphClient:
     """Microsoft Graph API client for email operations"""
@@ -8,31 +193,93 @@ class GraphClient:
     def __init__(self):
         self.access_token = None
         self.auth_provider = None
+        # One pooled session per client, reused across warm Lambda invocations
+        # and Flask requests so Graph calls skip the TCP+TLS handshake
+        self.session = self._create_session()
+        self.connection_stats = connection_stats
     
-    def _get_headers(self):
-        """Get authorization headers"""
-        # Lazy load auth provider if not injected
+    def _create_session(self):
+        """Create a keep-alive session with a sized connection pool"""
+        adapter = _GraphHTTPAdapter(
+            pool_connections=config.GRAPH_POOL_CONNECTIONS,
+            pool_maxsize=config.GRAPH_POOL_MAXSIZE,
+            max_retries=Retry(total=config.GRAPH_CONNECT_RETRIES, connect=config.GRAPH_CONNECT_RETRIES,
+                              read=0, status=0, backoff_factor=0.2)
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        return session
+    
+    def _timeout(self, operation):
+        """(connect, read) timeout tuple for a Graph operation"""
+        read_timeout = config.GRAPH_TIMEOUTS.get(operation, config.GRAPH_TIMEOUTS['default'])
+        return (config.GRAPH_CONNECT_TIMEOUT, read_timeout)
+    
+    def _get_auth_provider(self):
+        """Lazy load auth provider if not injected"""
         if not self.auth_provider:
             try:
                 from auth_provider import auth_provider
                 self.auth_provider = auth_provider
             except ImportError:
                 raise Exception("Auth provider not configured. Inject it or ensure auth_provider.py exists.")
+        return self.auth_provider
 
-        if not self.access_token:
-            self.access_token = self.auth_provider.get_access_token()
+    def _get_headers(self):
+        """Get authorization headers"""
+        # The auth provider caches the token until shortly before it expires
+        self.access_token = self._get_auth_provider().get_access_token()
         
         return {
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
+
+    def _request(self, method, url, operation='default', headers=None, **kwargs):
+        """Send a Graph request, retrying once with a fresh token on 401"""
+        kwargs.setdefault('timeout', self._timeout(operation))
+        extra_headers = headers or {}
+        headers = {**self._get_headers(), **extra_headers}
+        with metrics.span(f'graph.{operation}'):
+            self.connection_stats.record_request()
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            
+            if response.status_code == 401:
+                # Token was revoked or expired early - drop it and try once more
+                metrics.increment('graph.auth_retries')
+                self._get_auth_provider().invalidate_access_token(self.access_token)
+                headers = {**self._get_headers(), **extra_headers}
+                self.connection_stats.record_request()
+                response = self.session.request(method, url, headers=headers, **kwargs)
+        
+        metrics.record('graph.response_bytes', len(response.content), 'Bytes')
+        response.raise_for_status()
+        return response
     
-    def get_message(self, message_id):
-        """Get email message by ID"""
+    def get_message(self, message_id, select=None, text_body=False):
+        """
+        Get email message by ID.
+        select limits the fields returned (comma separated), text_body asks Graph
+        to convert the body to plain text server-side.
+        """
         url = f'{self.BASE_URL}/me/messages/{message_id}'
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request('GET', url, operation='get_message',
+                                 params=self._select_params(select),
+                                 **self._body_type_kwargs(text_body))
         return response.json()
+    
+    def _select_params(self, select):
+        return {'$select': select} if select else None
+    
+    def _body_type_kwargs(self, text_body):
+        """Extra request kwargs asking Graph for plain-text bodies"""
+        if not text_body:
+            return {}
+        return {'headers': self._prefer_text_headers()}
+    
+    def _prefer_text_headers(self):
+        return {'Prefer': 'outlook.body-content-type="text"'}
 
     def get_latest_message(self):
         """Get the most recent email message from inbox"""
@@ -41,27 +288,77 @@ class GraphClient:
             '$top': 1,
             '$orderby': 'receivedDateTime desc'
         }
-        response = requests.get(url, headers=self._get_headers(), params=params)
-        response.raise_for_status()
+        response = self._request('GET', url, operation='list_messages', params=params)
         messages = response.json().get('value', [])
         return messages[0] if messages else None
     
+    def iter_inbox_messages(self, filter=None, select=None, page_size=None):
+        """
+        Page through inbox messages matching the OData filter, oldest first,
+        following @odata.nextLink. Yields (messages, total) a page at a time,
+        total being Graph's count of all matching messages.
+        """
+        url = f'{self.BASE_URL}/me/mailFolders/inbox/messages'
+        params = {
+            '$select': select or 'id,conversationId,subject,from,receivedDateTime',
+            '$orderby': 'receivedDateTime asc',
+            '$top': page_size or 50,
+            '$count': 'true'
+        }
+        if filter:
+            params['$filter'] = filter
+        
+        total = None
+        while url:
+            page = self._request('GET', url, operation='list_messages', params=params).json()
+            total = page.get('@odata.count', total)
+            url, params = page.get('@odata.nextLink'), None
+            yield page.get('value', []), total
+    
+    def iter_inbox_delta(self, delta_link=None, received_since=None, page_size=None):
+        """
+        Page through messages created in the inbox since delta_link (or, without
+        one, those received since the ISO timestamp received_since). Yields
+        (messages, delta_link) a page at a time, following @odata.nextLink;
+        delta_link is None until the last page, whose link resumes the next sync.
+        """
+        if delta_link:
+            url, params = delta_link, None
+        else:
+            url = f'{self.BASE_URL}/me/mailFolders/inbox/messages/delta'
+            # Only new messages: read/flag updates and moves out of the inbox are of no use here
+            params = {'changeType': 'created', '$select': 'id,receivedDateTime'}
+            if received_since:
+                params['$filter'] = f'receivedDateTime ge {received_since}'
+        headers = {'Prefer': f'odata.maxpagesize={page_size or config.DELTA_SYNC_PAGE_SIZE}'}
+        
+        while url:
+            page = self._request('GET', url, operation='delta', headers=headers, params=params).json()
+            # nextLink and deltaLink already carry the query
+            url, params = page.get('@odata.nextLink'), None
+            yield [message for message in page.get('value', []) if '@removed' not in message], \
+                page.get('@odata.deltaLink')
+    
     def create_reply_draft(self, message_id, reply_content):
         """Create a reply draft for a message"""
         # First, create the reply
         url = f'{self.BASE_URL}/me/messages/{message_id}/createReply'
-        response = requests.post(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request('POST', url, operation='create_reply')
         draft = response.json()
         
         # Update the draft with our content
         draft_id = draft['id']
         update_url = f'{self.BASE_URL}/me/messages/{draft_id}'
         
-        # Force the correct sender address
-        import config
+        response = self._request('PATCH', update_url, operation='update_draft',
+                                 json=self._draft_update_data(reply_content))
         
-        update_data = {
+        return response.json()
+    
+    def _draft_update_data(self, reply_content):
+        """PATCH body that fills a reply draft with our content"""
+        # Force the correct sender address
+        return {
             'from': {
                 'emailAddress': {
                     'address': config.USER_EMAIL
@@ -72,14 +369,26 @@ class GraphClient:
                 'content': reply_content
             }
         }
-        
-        response = requests.patch(update_url, headers=self._get_headers(), json=update_data)
-        response.raise_for_status()
-        
-        return response.json()
     
-    def subscribe_to_inbox(self, notification_url, expiration_datetime):
-        """Create a subscription to inbox changes"""
+    def subscription_expiration(self, days):
+        """
+        expirationDateTime days from now, capped below a day for rich
+        notifications (Graph rejects longer ones for messages with resource data)
+        """
+        lifetime = timedelta(days=days)
+        if config.RICH_NOTIFICATIONS:
+            lifetime = min(lifetime, timedelta(minutes=RICH_SUBSCRIPTION_MAX_MINUTES))
+        return (datetime.utcnow() + lifetime).strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+    
+    def subscribe_to_inbox(self, notification_url, expiration_datetime, lifecycle_notification_url=None):
+        """
+        Create a subscription to inbox changes. With RICH_NOTIFICATIONS (and a
+        certificate configured) notifications carry the message, encrypted.
+        Lifecycle events (reauthorizationRequired, subscriptionRemoved, missed)
+        go to lifecycle_notification_url, which can only be set here
+        """
+        from notification_crypto import load_notification_keys
+        
         url = f'{self.BASE_URL}/subscriptions'
         
         subscription_data = {
@@ -89,9 +398,23 @@ class GraphClient:
             'expirationDateTime': expiration_datetime,
             'clientState': 'SecretClientState'  # Used to verify notifications
         }
+        if lifecycle_notification_url:
+            subscription_data['lifecycleNotificationUrl'] = lifecycle_notification_url
         
-        response = requests.post(url, headers=self._get_headers(), json=subscription_data)
-        response.raise_for_status()
+        keys = load_notification_keys()
+        if keys:
+            select = config.MESSAGE_SELECT_FIELDS
+            if config.DEDUP_BY_INTERNET_MESSAGE_ID and 'internetMessageId' not in select:
+                select += ',internetMessageId'
+            subscription_data.update({
+                # Resource data only includes the fields named in $select
+                'resource': f'/me/mailFolders/inbox/messages?$select={select}',
+                'includeResourceData': True,
+                'encryptionCertificate': keys.encryption_certificate,
+                'encryptionCertificateId': keys.certificate_id
+            })
+        
+        response = self._request('POST', url, operation='subscription', json=subscription_data)
         
         return response.json()
     
@@ -103,36 +426,169 @@ class GraphClient:
             'expirationDateTime': expiration_datetime
         }
         
-        response = requests.patch(url, headers=self._get_headers(), json=update_data)
-        response.raise_for_status()
+        response = self._request('PATCH', url, operation='subscription', json=update_data)
         
         return response.json()
     
     def delete_subscription(self, subscription_id):
         """Delete a subscription"""
         url = f'{self.BASE_URL}/subscriptions/{subscription_id}'
-        response = requests.delete(url, headers=self._get_headers())
-        response.raise_for_status()
+        self._request('DELETE', url, operation='subscription')
         return True
 
     def list_subscriptions(self):
         """List all active subscriptions"""
         url = f'{self.BASE_URL}/subscriptions'
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request('GET', url, operation='subscription')
         return response.json().get('value', [])
 
-    def get_conversation_threads(self, conversation_id):
-        """Get all messages in a conversation thread"""
+    def get_conversation_threads(self, conversation_id, select=None, text_body=False, since=None):
+        """
+        Get all messages in a conversation thread
+        (only those received after the ISO timestamp since, if given)
+        """
         url = f'{self.BASE_URL}/me/messages'
-        params = {
-            '$filter': f"conversationId eq '{conversation_id}'",
+        params = self._conversation_params(conversation_id, select, since)
+        response = self._request('GET', url, operation='list_messages', params=params,
+                                 **self._body_type_kwargs(text_body))
+        return response.json().get('value', [])
+    
+    def _conversation_params(self, conversation_id, select=None, since=None):
+        conversation_filter = f"conversationId eq '{conversation_id}'"
+        if since:
+            # receivedDateTime goes first because Graph wants $orderby properties to lead the $filter
+            conversation_filter = f"receivedDateTime gt {since} and {conversation_filter}"
+        
+        return {
+            '$filter': conversation_filter,
             '$orderby': 'receivedDateTime asc', # Oldest first for chronological context
-            '$select': 'sender,subject,body,receivedDateTime,from'
+            '$select': select or 'sender,subject,body,receivedDateTime,from'
         }
-        response = requests.get(url, headers=self._get_headers(), params=params)
-        response.raise_for_status()
-        return response.json().get('value', [])
+    
+    def batch(self):
+        """Start a new $batch request queue"""
+        return GraphBatch(self)
+    
+    def _relative_url(self, path, params=None):
+        """Build a batch request URL (relative to BASE_URL) with encoded query params"""
+        if not params:
+            return path
+        return f"{path}?{urlencode(params, quote_via=quote, safe='$,')}"
+    
+    def _run_batched(self, keys, build_request):
+        """
+        Queue one request per key (build_request returns (method, url, body, headers))
+        and return {key: body or Exception}, sending as few $batch envelopes as possible.
+        """
+        batch = self.batch()
+        request_ids = {}
+        for key in keys:
+            method, url, body, headers = build_request(key)
+            request_ids[key] = batch.add(method, url, body=body, headers=headers)
+        
+        responses = batch.execute() if request_ids else {}
+        
+        results = {}
+        for key, request_id in request_ids.items():
+            try:
+                results[key] = GraphBatch.result(responses.get(request_id))
+            except Exception as e:
+                results[key] = e
+        return results
+    
+    def get_messages(self, message_ids, select=None, text_body=False):
+        """Get several messages at once. Returns {message_id: message or Exception}"""
+        headers = self._prefer_text_headers() if text_body else None
+        return self._run_batched(
+            dict.fromkeys(message_ids),
+            lambda message_id: (
+                'GET', self._relative_url(f'/me/messages/{message_id}', self._select_params(select)),
+                None, headers
+            )
+        )
+    
+    def get_conversation_threads_batch(self, conversation_ids, select=None, text_body=False, since=None):
+        """
+        Get several conversation threads at once. since optionally maps
+        conversation_id -> ISO timestamp to fetch only newer messages.
+        Returns {conversation_id: [messages] or Exception}
+        """
+        headers = self._prefer_text_headers() if text_body else None
+        since = since or {}
+        results = self._run_batched(
+            dict.fromkeys(conversation_ids),
+            lambda conversation_id: (
+                'GET', self._relative_url('/me/messages', self._conversation_params(
+                    conversation_id, select, since.get(conversation_id))),
+                None, headers
+            )
+        )
+        return {key: value if isinstance(value, Exception) else value.get('value', [])
+                for key, value in results.items()}
+    
+    def create_reply_drafts(self, replies):
+        """
+        Create reply drafts for several messages at once.
+        replies maps message_id -> reply HTML. Returns {message_id: draft or Exception}
+        """
+        # createReply must finish before we know each draft's ID, so this takes two batches
+        drafts = self._run_batched(
+            replies,
+            lambda message_id: ('POST', f'/me/messages/{message_id}/createReply', None, None)
+        )
+        
+        created = {message_id: draft for message_id, draft in drafts.items()
+                   if not isinstance(draft, Exception)}
+        updated = self._run_batched(
+            created,
+            lambda message_id: ('PATCH', f"/me/messages/{created[message_id]['id']}",
+                                self._draft_update_data(replies[message_id]), None)
+        )
+        drafts.update(updated)
+        return drafts
+
+class AsyncGraphClient:
+    """
+    asyncio front end for GraphClient. Each call runs on a small thread pool
+    that shares the client's pooled session, so many requests can be in
+    flight from one event loop while still reusing keep-alive connections.
+    """
+    
+    def __init__(self, client, max_workers=None):
+        self.client = client
+        # More workers than pooled connections would only queue on the pool
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or config.GRAPH_POOL_MAXSIZE, thread_name_prefix='graph'
+        )
+    
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def get_message(self, message_id, select=None, text_body=False):
+        return await self._call(self.client.get_message, message_id, select=select, text_body=text_body)
+    
+    async def get_conversation_threads(self, conversation_id, select=None, text_body=False, since=None):
+        return await self._call(
+            self.client.get_conversation_threads, conversation_id,
+            select=select, text_body=text_body, since=since
+        )
+    
+    async def create_reply_draft(self, message_id, reply_content):
+        return await self._call(self.client.create_reply_draft, message_id, reply_content)
+    
+    async def get_messages(self, message_ids, select=None, text_body=False):
+        return await self._call(self.client.get_messages, message_ids, select=select, text_body=text_body)
+    
+    async def get_conversation_threads_batch(self, conversation_ids, select=None, text_body=False, since=None):
+        return await self._call(
+            self.client.get_conversation_threads_batch, conversation_ids,
+            select=select, text_body=text_body, since=since
+        )
+    
+    async def create_reply_drafts(self, replies):
+        return await self._call(self.client.create_reply_drafts, replies)
 
-# Singleton instance
+# Singleton instances
 graph_client = GraphClient()
+async_graph_client = AsyncGraphClient(graph_client)
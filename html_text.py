@@ -0,0 +1,139 @@
+"""
+Streaming HTML to plain text conversion for email bodies.
+
+The markup is walked front to back in windows that never split a tag, a
+comment or a skipped element. Each window is converted with a handful of
+compiled regexes (so the per-tag work stays in C), non-content elements
+(<style>, <script>, <head>, Outlook's conditional <xml> blocks ...) are
+dropped and block elements become line and paragraph breaks. Callers with
+a character budget stop pulling windows once it is filled, so a 300 KB
+newsletter costs no more than the part we actually keep.
+"""
+import html
+import re
+
+# Elements whose content is never shown to the reader
+SKIP_TAGS = ('head', 'style', 'script', 'title', 'noscript', 'template', 'xml', 'svg', 'object')
+
+# Markup is converted this many characters at a time
+WINDOW_SIZE = 16 * 1024
+
+_SKIP_OPEN_RE = re.compile(r'<!--|<(%s)\b' % '|'.join(SKIP_TAGS), re.I)
+_SKIP_RE = re.compile(r'<!--.*?-->|<(%s)\b[^>]*>.*?</\1\s*>' % '|'.join(SKIP_TAGS), re.I | re.S)
+
+# Breaks are first written as placeholders and resolved once per run:
+# \x02 = paragraph, \x01 = line (block element), \n = explicit <br>
+_PARAGRAPH_RE = re.compile(r'<(?:/?(?:p|table|blockquote|ul|ol|dl|pre|h[1-6])|hr)\b[^>]*>', re.I)
+_LINE_RE = re.compile(r'</?(?:div|tr|dt|dd|section|article|header|footer|center)\b[^>]*>|</li\s*>', re.I)
+_BR_RE = re.compile(r'<br\b[^>]*>', re.I)
+_LIST_ITEM_RE = re.compile(r'<li\b[^>]*>', re.I)
+_CELL_RE = re.compile(r'</t[dh]\s*>', re.I)
+_TAG_RE = re.compile(r'<[a-zA-Z/!?][^>]*>')
+_BREAK_RUN_RE = re.compile(r'[ \x01\x02\n]*[\x01\x02\n][ \x01\x02\n]*')
+# Non-breaking, zero-width and BOM characters that newsletters use as padding
+_SPACES_RE = re.compile(r'[ \xa0\u200b\u200c\ufeff]+')
+# What collapses away: break placeholders, whitespace and padding (not counted against max_chars)
+_FILLER_RE = re.compile(r'[\s\x01\x02\xa0\u200b\u200c\ufeff]+')
+
+def _window_end(markup, start):
+    """End of the next window: just after a tag, never inside a comment or skipped element"""
+    length = len(markup)
+    end = start + WINDOW_SIZE
+    if end >= length:
+        return length
+    
+    cut = markup.rfind('>', start, end) + 1
+    if cut <= start:
+        cut = markup.find('>', end) + 1 or length
+    
+    # Extend the window past any comment or skipped element that straddles the cut
+    pos = start
+    while True:
+        match = _SKIP_OPEN_RE.search(markup, pos, cut)
+        if not match:
+            return cut
+        if match.group(1):
+            closer = re.compile(r'</%s\s*>' % match.group(1), re.I).search(markup, match.end())
+            close_end = closer.end() if closer else length
+        else:
+            close_end = markup.find('-->', match.end())
+            close_end = close_end + 3 if close_end != -1 else length
+        if close_end > cut:
+            return close_end
+        pos = close_end
+
+def _collapse_whitespace(fragment):
+    """Collapse source whitespace to single spaces, keeping a space at either edge"""
+    if not fragment:
+        return fragment
+    collapsed = ' '.join(fragment.split())
+    if fragment[0].isspace():
+        collapsed = ' ' + collapsed
+    if fragment[-1].isspace() and collapsed != ' ':
+        collapsed += ' '
+    return collapsed
+
+def _resolve_breaks(match):
+    """Turn a run of break placeholders into at most one blank line"""
+    run = match.group(0)
+    newlines = run.count('\n')
+    first_br = run.find('\n')
+    if first_br > 0 and ('\x01' in run[:first_br] or '\x02' in run[:first_br]):
+        # a <br> that opens a new block (e.g. <div><br></div>) is an empty line
+        newlines += 1
+    if '\x02' in run:
+        newlines = max(newlines, 2)
+    elif '\x01' in run:
+        newlines = max(newlines, 1)
+    return '\n' * min(newlines, 2)
+
+def _convert(fragment):
+    """Convert a self-contained piece of markup to text with break placeholders"""
+    fragment = _SKIP_RE.sub('', fragment)
+    fragment = _collapse_whitespace(fragment)
+    fragment = _PARAGRAPH_RE.sub('\x02', fragment)
+    fragment = _LINE_RE.sub('\x01', fragment)
+    fragment = _BR_RE.sub('\n', fragment)
+    fragment = _LIST_ITEM_RE.sub('\x01- ', fragment)
+    fragment = _CELL_RE.sub(' ', fragment)
+    fragment = _TAG_RE.sub('', fragment)
+    if '&' in fragment:
+        fragment = html.unescape(fragment)
+    return fragment
+
+def iter_text(markup):
+    """
+    Yield the text of an HTML document window by window (with break
+    placeholders still in place; see html_to_text). Stops scanning as soon
+    as the consumer stops iterating.
+    """
+    pos = 0
+    length = len(markup)
+    while pos < length:
+        end = _window_end(markup, pos)
+        yield _convert(markup[pos:end])
+        pos = end
+
+def html_to_text(markup, max_chars=None):
+    """
+    Convert HTML to readable plain text, keeping paragraph and line breaks.
+    With max_chars the conversion stops once that many characters of text are
+    produced; breaks and whitespace do not count, as they mostly collapse away
+    (markup full of empty blocks would otherwise fill the budget with nothing).
+    """
+    if not markup:
+        return ''
+    
+    parts = []
+    size = 0
+    for chunk in iter_text(markup):
+        parts.append(chunk)
+        size += len(_FILLER_RE.sub('', chunk))
+        if max_chars is not None and size >= max_chars:
+            break
+    
+    text = _SPACES_RE.sub(' ', ''.join(parts))
+    text = _BREAK_RUN_RE.sub(_resolve_breaks, text).strip()
+    if max_chars is not None:
+        text = text[:max_chars]
+    return text
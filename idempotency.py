@@ -0,0 +1,202 @@
+"""
+Idempotency markers for notified messages.
+
+Lookups go through an in-process LRU first (Graph often redelivers a
+notification to the same warm container) and then to a shared store:
+DynamoDB for the Lambda, SQLite for the Flask server. Markers carry an
+expires_at timestamp so they age out instead of accumulating forever.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import config
+
+class IdempotencyStore:
+    """Shared marker store; claim() is atomic per key"""
+    
+    def __init__(self, ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds or config.IDEMPOTENCY_TTL_SECONDS
+    
+    def claim(self, keys):
+        """Create markers for keys; return the set of keys that did not exist yet"""
+        raise NotImplementedError
+    
+    def release(self, keys):
+        raise NotImplementedError
+    
+    def _expires_at(self, now):
+        return int(now + self.ttl_seconds)
+
+class DynamoDBIdempotencyStore(IdempotencyStore):
+    """
+    processed_<key> items in the bot's DynamoDB table. Several keys are
+    claimed with one TransactWriteItems call; a cancelled transaction tells
+    us which conditions failed, and the rest are retried without them.
+    """
+    
+    # TransactWriteItems accepts at most 100 actions
+    MAX_TRANSACTION_ITEMS = 100
+    
+    def __init__(self, table, **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+    
+    def _key(self, key):
+        return f'processed_{key}'
+    
+    def claim(self, keys):
+        keys = list(keys)
+        claimed = set()
+        for start in range(0, len(keys), self.MAX_TRANSACTION_ITEMS):
+            claimed |= self._claim_chunk(keys[start:start + self.MAX_TRANSACTION_ITEMS])
+        return claimed
+    
+    def _claim_chunk(self, keys):
+        from botocore.exceptions import ClientError
+        
+        while keys:
+            now = time.time()
+            try:
+                self.table.meta.client.transact_write_items(
+                    TransactItems=[{'Put': self._put_request(key, now)} for key in keys]
+                )
+                return set(keys)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    raise
+                reasons = e.response.get('CancellationReasons') or []
+                duplicates = {key for key, reason in zip(keys, reasons)
+                              if reason.get('Code') == 'ConditionalCheckFailed'}
+                if not duplicates:
+                    # Cancelled for another reason (e.g. a concurrent transaction): go one by one
+                    return {key for key in keys if self._claim_one(key)}
+                keys = [key for key in keys if key not in duplicates]
+        return set()
+    
+    def _put_request(self, key, now):
+        return {
+            'TableName': self.table.name,
+            'Item': {
+                'token_id': {'S': self._key(key)},
+                'created_at': {'S': datetime.utcnow().isoformat()},
+                'expires_at': {'N': str(self._expires_at(now))}
+            },
+            # An expired marker DynamoDB has not deleted yet does not count
+            'ConditionExpression': 'attribute_not_exists(token_id) OR expires_at < :now',
+            'ExpressionAttributeValues': {':now': {'N': str(int(now))}}
+        }
+    
+    def _claim_one(self, key):
+        from botocore.exceptions import ClientError
+        
+        now = time.time()
+        try:
+            self.table.put_item(
+                Item={
+                    'token_id': self._key(key),
+                    'created_at': datetime.utcnow().isoformat(),
+                    'expires_at': self._expires_at(now)
+                },
+                ConditionExpression='attribute_not_exists(token_id) OR expires_at < :now',
+                ExpressionAttributeValues={':now': int(now)}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+    
+    def release(self, keys):
+        with self.table.batch_writer() as batch:
+            for key in keys:
+                batch.delete_item(Key={'token_id': self._key(key)})
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """Markers in a local SQLite file (used by scripts/server.py)"""
+    
+    def __init__(self, db_path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path or config.IDEMPOTENCY_DB
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS processed ('
+                ' key TEXT PRIMARY KEY,'
+                ' expires_at INTEGER NOT NULL)'
+            )
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def claim(self, keys):
+        now = time.time()
+        claimed = set()
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM processed WHERE expires_at < ?', (now,))
+            for key in keys:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO processed VALUES (?, ?)', (key, self._expires_at(now))
+                )
+                if cursor.rowcount:
+                    claimed.add(key)
+        return claimed
+    
+    def release(self, keys):
+        with self._lock, self._connect() as conn:
+            conn.executemany('DELETE FROM processed WHERE key = ?', [(key,) for key in keys])
+
+class Idempotency:
+    """In-process LRU of recently seen keys in front of an optional IdempotencyStore"""
+    
+    def __init__(self, store=None, lru_size=None, ttl_seconds=None):
+        self.store = store
+        self.lru_size = lru_size or config.IDEMPOTENCY_LRU_SIZE
+        self.ttl_seconds = ttl_seconds or config.IDEMPOTENCY_TTL_SECONDS
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'claimed': 0, 'lru_hits': 0, 'store_duplicates': 0}
+    
+    def claim(self, keys):
+        """Return the keys not seen before (in order), marking all of them as seen"""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            fresh = [key for key in keys if not self._seen(key, now)]
+        self.stats['lru_hits'] += len(keys) - len(fresh)
+        
+        claimed = self.store.claim(fresh) if self.store and fresh else set(fresh)
+        self.stats['store_duplicates'] += len(fresh) - len(claimed)
+        self.stats['claimed'] += len(claimed)
+        
+        with self._lock:
+            for key in fresh:
+                self._recent[key] = now + self.ttl_seconds
+                self._recent.move_to_end(key)
+            while len(self._recent) > self.lru_size:
+                self._recent.popitem(last=False)
+        return [key for key in fresh if key in claimed]
+    
+    def _seen(self, key, now):
+        expires_at = self._recent.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self._recent[key]
+            return False
+        self._recent.move_to_end(key)
+        return True
+    
+    def is_duplicate(self, key):
+        return not self.claim([key])
+    
+    def release(self, keys):
+        """Forget keys so they can be claimed again (e.g. deferred messages)"""
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._recent.pop(key, None)
+        if self.store and keys:
+            self.store.release(keys)
@@ -0,0 +1,144 @@
+"""
+Local intent classifier for formulaic inquiries.
+
+Each intent is a set of weighted regex cues. The confidence is the noisy-OR
+of the cues that match (1 - product of (1 - weight)), so one strong cue or
+several weak ones are needed; veto cues (e.g. "damaged" for a shipping
+delay) rule an intent out. Patterns are compiled once per container and a
+message is classified in well under a millisecond, without network calls.
+
+Wording alone cannot tell a newsletter from a customer asking to be
+unsubscribed, so intents in BULK_ONLY_INTENTS (which get no reply at all)
+also need evidence that the mail was sent in bulk: a List-Unsubscribe,
+List-Id or Precedence header, or a sender like noreply@ or newsletter@.
+"""
+import re
+
+import config
+
+# intent -> {'cues': [(pattern, weight)], 'veto': [pattern]}; matched against subject + body
+INTENT_RULES = {
+    'shipping_delay': {
+        'cues': [
+            (r"(hasn'?t|has not|have not|haven'?t|not yet|never|still not|didn'?t|did not) (been )?(arrived?|received?|delivered)", 0.7),
+            (r'\b(package|parcel|shipment|order|delivery)\b.{0,40}\b(delay|delayed|late|stuck|missing)', 0.6),
+            (r'\btracking\b.{0,60}\b(not|no|hasn.?t|doesn.?t|isn.?t)\b.{0,20}\b(update|change|move)', 0.5),
+            (r'\bwhere is my (order|package|parcel|shipment)\b', 0.6),
+            (r'\b(dhl|ups|fedex|ems|courier|customs)\b', 0.25),
+            (r'(배송|택배|물건|주문).{0,20}(안\s*(와|옴|왔)|오지\s*않|도착하지\s*않|지연|늦)', 0.75),
+            (r'(언제\s*도착|아직\s*(못|안)\s*받)', 0.6),
+        ],
+        'veto': [r'\b(damaged|broken|wrong item|refund|cancel)', r'(파손|환불|취소|오배송)'],
+    },
+    'order_status': {
+        'cues': [
+            (r'\b(status|update) (of|on) (my|our) (order|purchase)\b', 0.7),
+            (r'\b(has|have) (my|our) order(s)? (been )?(shipped|dispatched|processed)\b', 0.75),
+            (r'\bwhen will (my|our) order (ship|be shipped|be dispatched)\b', 0.7),
+            (r'\border (number|no\.?|#)\s*[:#]?\s*[A-Z0-9-]{4,}', 0.3),
+            (r'(주문|발송).{0,10}(상태|현황|확인|되었나요|됐나요)', 0.7),
+        ],
+        'veto': [r"(hasn'?t|has not|not yet|never|still not) (been )?(arrived?|received?|delivered)",
+                 r'\b(damaged|refund|cancel)', r'(파손|환불|취소)'],
+    },
+    'return_address': {
+        'cues': [
+            (r'\b(return|returns|send back|ship back)\b.{0,40}\baddress\b', 0.85),
+            (r'\baddress\b.{0,40}\b(return|send (it|them) back)\b', 0.75),
+            (r'(반품|반송).{0,15}(주소|어디로)', 0.85),
+        ],
+        'veto': [],
+    },
+    'out_of_office': {
+        'cues': [
+            (r'^\s*(automatic reply|auto(matic)?[- ]?reply|out of (the )?office)\b', 0.9),
+            (r'\b(i am|i\'m) (currently )?(out of (the )?office|on (annual )?leave|away from the office|on vacation)\b', 0.8),
+            (r'\bwill (be back|return) (on|after)\b', 0.3),
+            (r'(자동\s*회신|부재\s*중|휴가\s*중)', 0.85),
+        ],
+        'veto': [],
+    },
+    'newsletter': {
+        'cues': [
+            (r'\bunsubscribe\b', 0.6),
+            (r'\b(view (this email )?in (your )?browser|newsletter)\b', 0.5),
+            (r'\b(manage (your )?(email )?preferences|you are receiving this (email )?because)\b', 0.5),
+            (r'(수신\s*거부|뉴스레터)', 0.6),
+            (r'^\s*\(광고\)', 0.6),
+        ],
+        'veto': [],
+    },
+}
+
+# Skip intents only trusted for mail that was sent in bulk (see is_bulk_mail)
+BULK_ONLY_INTENTS = {'newsletter'}
+
+_BULK_SENDER = re.compile(
+    r'^(no-?reply|do-?not-?reply|newsletters?|news|marketing|mailer|mailer-daemon|promo(tions)?|notifications?)'
+    r'[@+.]|@(newsletter|news|mkt|marketing|promo)\d*\.', re.I
+)
+_BULK_HEADERS = {'list-unsubscribe', 'list-id'}
+_HANGUL = re.compile('[\uac00-\ud7a3]')
+
+def is_bulk_mail(sender, headers=None):
+    """
+    Whether a message shows it was sent in bulk: a bulk sender address, or (when
+    internetMessageHeaders were fetched) list headers or Precedence: bulk/list
+    """
+    if _BULK_SENDER.search(sender or ''):
+        return True
+    for header in headers or []:
+        name = (header.get('name') or '').lower()
+        if name in _BULK_HEADERS:
+            return True
+        if name == 'precedence' and (header.get('value') or '').strip().lower() in ('bulk', 'list', 'junk'):
+            return True
+    return False
+
+def reply_language(subject, body):
+    """'ko' for mail written in Korean, else 'en': the language of the templated reply"""
+    return 'ko' if _HANGUL.search(f"{subject or ''}\n{body or ''}") else 'en'
+
+class IntentClassifier:
+    """Scores a message against INTENT_RULES and applies per-intent thresholds"""
+
+    def __init__(self, rules=None, thresholds=None):
+        rules = rules or INTENT_RULES
+        self.thresholds = thresholds or config.INTENT_THRESHOLDS
+        self._rules = {
+            intent: (
+                [(re.compile(pattern, re.I | re.M), weight) for pattern, weight in rule['cues']],
+                [re.compile(pattern, re.I | re.M) for pattern in rule['veto']]
+            )
+            for intent, rule in rules.items()
+        }
+
+    def scores(self, subject, body):
+        """Confidence per intent, from 0 to 1"""
+        text = f"{subject or ''}\n{body or ''}"
+        result = {}
+        for intent, (cues, vetoes) in self._rules.items():
+            if any(veto.search(text) for veto in vetoes):
+                result[intent] = 0.0
+                continue
+            miss = 1.0
+            for pattern, weight in cues:
+                if pattern.search(text):
+                    miss *= 1 - weight
+            result[intent] = round(1 - miss, 3)
+        return result
+
+    def classify(self, subject, body):
+        """
+        Return (intent, confidence). intent is None unless the best-scoring
+        intent clears its threshold.
+        """
+        scores = self.scores(subject, body)
+        intent = max(scores, key=scores.get)
+        confidence = scores[intent]
+        if confidence < self.thresholds.get(intent, 1.0) or confidence == 0:
+            return None, confidence
+        return intent, confidence
+
+# Singleton instance
+intent_classifier = IntentClassifier()
@@ -1,103 +1,304 @@
+import functools
 import json
 import os
-import logging
-from auth_provider_aws import aws_auth_provider
-from graph_client import GraphClient
-from email_processor import EmailProcessor
-
-# Configure logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Initialize services with AWS auth provider
-import graph_client as graph_client_module
-graph_client = graph_client_module.graph_client
-# Inject AWS auth provider
-graph_client.auth_provider = aws_auth_provider
-
-# Initialize email processor
-email_processor = EmailProcessor()
-# Ensure email processor uses the configured graph client
-email_processor.graph_client = graph_client
-
-# Initialize DynamoDB for idempotency check
-import boto3
-from botocore.exceptions import ClientError
-from datetime import datetime
-dynamodb = boto3.resource('dynamodb', region_name='ap-northeast-2')
-table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE', 'EmailBot_Tokens'))
-
-def is_duplicate_request(message_id):
-    """Check if message is already processed using DynamoDB"""
+
+import config
+from metrics import create_metrics_sink, metrics
+from structured_log import get_logger, record_log_volume
+from time_budget import TimeBudget
+
+# One JSON line per log call, with message content redacted (see structured_log)
+logger = get_logger(__name__)
+
+# EMF lines on stdout become CloudWatch metrics; the first invocation of a container is its cold start
+metrics.sink = create_metrics_sink('stdout')
+_cold_start = True
+
+# Services are created on first use by the code path that needs them, so
+# their heavy dependencies (boto3, msal, requests, google.generativeai) stay
+# out of the cold start: webhook validation imports none of them and the
+# subscription renewal skips the LLM stack
+
+@functools.lru_cache(maxsize=None)
+def get_table():
+    """DynamoDB table holding tokens, idempotency markers and cached conversations"""
+    import boto3
+    dynamodb = boto3.resource('dynamodb', region_name='ap-northeast-2')
+    return dynamodb.Table(os.environ.get('DYNAMODB_TABLE', 'EmailBot_Tokens'))
+
+@functools.lru_cache(maxsize=None)
+def get_graph_client():
+    """Graph client using the AWS auth provider"""
+    from auth_provider_aws import aws_auth_provider
+    from graph_client import graph_client
+    # Inject AWS auth provider
+    graph_client.auth_provider = aws_auth_provider
+    return graph_client
+
+@functools.lru_cache(maxsize=None)
+def get_idempotency():
+    """processed_<id> markers (with an expires_at TTL) behind a warm-container LRU"""
+    from idempotency import DynamoDBIdempotencyStore, Idempotency
+    return Idempotency(DynamoDBIdempotencyStore(get_table()))
+
+@functools.lru_cache(maxsize=None)
+def get_email_processor():
+    """Email processor wired to the AWS-backed graph client and caches"""
+    from conversation_cache import DynamoDBConversationCache
+    from email_processor import EmailProcessor
+    from llm_service import llm_service
+    from rate_limiter import create_rate_counter
+    from reply_cache import create_reply_cache
+    
+    email_processor = EmailProcessor()
+    # Ensure email processor uses the configured graph client
+    email_processor.graph_client = get_graph_client()
+    email_processor.idempotency = get_idempotency()
+    # Cache cleaned thread history in the same table so replies only fetch new messages
+    email_processor.conversation_cache = DynamoDBConversationCache(get_table())
+    # Repeated inquiries are answered from cached replies in the same table
+    llm_service.reply_cache = create_reply_cache('dynamodb', table=get_table())
+    # Optionally share the Gemini per-minute budget with the other containers
+    llm_service.rate_limiter.shared = create_rate_counter(table=get_table())
+    return email_processor
+
+@functools.lru_cache(maxsize=None)
+def get_deferral_queue():
+    """
+    Messages an invocation has no time left for are deferred here and drained
+    later. Only SQS outlives the container, so without DEFERRAL_QUEUE_URL there
+    is no queue (None) and nothing is deferred
+    """
+    from deferral import SQSDeferralQueue
+    if not config.DEFERRAL_QUEUE_URL:
+        logger.warning("DEFERRAL_QUEUE_URL is not set, messages cannot be deferred")
+        return None
+    return SQSDeferralQueue()
+
+@functools.lru_cache(maxsize=None)
+def get_delta_sync():
+    """Inbox delta sync with its deltaLink in the bot's DynamoDB table"""
+    from delta_sync import DeltaSync, create_delta_link_store
+    return DeltaSync(get_graph_client(), create_delta_link_store('dynamodb', table=get_table()))
+
+@functools.lru_cache(maxsize=None)
+def get_subscription_manager():
+    """Inbox subscription for WEBHOOK_URL, its state kept in the bot's DynamoDB table"""
+    from subscription_manager import SubscriptionManager, create_subscription_store
+    notification_url = os.environ.get('WEBHOOK_URL')
+    if not notification_url:
+        raise Exception("WEBHOOK_URL environment variable is missing")
+    store = create_subscription_store('dynamodb', table=get_table())
+    return SubscriptionManager(get_graph_client(), store, notification_url)
+
+DRAIN_EVENT_SOURCE = 'emailbot.deferred'
+
+def claim_messages(message_ids):
+    """Return the message IDs not processed before, taking their locks (one transaction)"""
+    claimed = get_idempotency().claim(message_ids)
+    for message_id in message_ids:
+        if message_id not in claimed:
+            logger.info("Duplicate request, ignoring", message_id=message_id)
+    return claimed
+
+def release_locks(message_ids):
+    """Remove the processed_ markers so deferred messages can be picked up again"""
+    try:
+        get_idempotency().release(message_ids)
+    except Exception as e:
+        logger.error("Failed to release locks", message_ids=message_ids, error=str(e))
+
+def process_within_budget(message_ids, context, messages=None, drain=True):
+    """
+    Process message IDs a chunk at a time while the invocation has time left
+    for another chunk; defer the rest. messages holds those that came with their
+    notification (rich notifications); drain=False leaves triggering the drain
+    to the caller. Returns (results, deferred_ids)
+    """
+    budget = TimeBudget(context)
+    results = []
+    chunk_size = config.PROCESS_CONCURRENCY
+    for start in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[start:start + chunk_size]
+        if not budget.can_start(len(chunk)):
+            deferred = message_ids[start:]
+            defer(deferred, context, drain=drain)
+            return results, deferred
+        
+        with budget.timed(len(chunk)):
+            results.extend(get_email_processor().process_emails(chunk, messages=messages))
+    
+    log_llm_stats()
+    return results, []
+
+def log_llm_stats():
+    """Log the rate limiter's counters and per-provider latencies for this container"""
+    from llm_service import llm_service
+    logger.info("Rate limiter", **llm_service.rate_limiter.stats())
+    logger.info("LLM providers", **llm_service.router.stats())
+
+def defer(message_ids, context, drain=True):
+    """
+    Hand unprocessed message IDs to the deferral queue and release their locks.
+    Without a queue they are only released, for the next delta sync to pick up
+    """
+    queue = get_deferral_queue()
+    if queue is None:
+        logger.error("Time budget low and no deferral queue, leaving messages to the delta sync",
+                     message_ids=message_ids)
+        release_locks(message_ids)
+        return
+    
+    logger.warning("Time budget low, deferring messages", count=len(message_ids))
+    try:
+        queue.send(message_ids)
+    except Exception as e:
+        logger.error("Failed to defer messages", message_ids=message_ids, error=str(e))
+    
+    release_locks(message_ids)
+    
+    if drain and config.DEFERRAL_SELF_INVOKE and context is not None:
+        trigger_drain(context)
+
+def trigger_drain(context):
+    """Invoke this function again asynchronously to work through deferred messages"""
     try:
-        # Try to create a lock item
-        # We use the same table but prefix the key with 'processed_'
-        table.put_item(
-            Item={
-                'token_id': f'processed_{message_id}', 
-                'created_at': datetime.utcnow().isoformat(),
-                # TTL is optional, but good practice. DynamoDB needs TTL enabled on a field to work.
-                # For now, we just store it.
-            },
-            ConditionExpression='attribute_not_exists(token_id)'
+        import boto3
+        lambda_client = boto3.client('lambda', region_name='ap-northeast-2')
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'source': DRAIN_EVENT_SOURCE})
         )
-        return False # Successfully locked, not a duplicate
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            return True # Already exists
-        raise e
+    except Exception as e:
+        logger.error("Failed to trigger deferred drain", error=str(e))
+
+def drain_deferred(context):
+    """Process deferred messages until the queue is empty or the time budget runs out"""
+    queue = get_deferral_queue()
+    if queue is None:
+        return {'statusCode': 200, 'body': "Drained: 0 (no deferral queue)"}
+    budget = TimeBudget(context)
+    processed = 0
+    while True:
+        # Check before receiving: received messages stay invisible for the queue's
+        # visibility timeout, so the drain triggered here would find them gone
+        if not budget.can_start(config.PROCESS_CONCURRENCY):
+            # Leave them queued and continue in a fresh invocation
+            if config.DEFERRAL_SELF_INVOKE and context is not None:
+                trigger_drain(context)
+            break
+        items = queue.receive(config.PROCESS_CONCURRENCY)
+        if not items:
+            break
+        
+        # Re-take the locks released when these were deferred
+        message_ids = claim_messages([item['message_id'] for item in items])
+        with budget.timed(len(message_ids)):
+            for result in get_email_processor().process_emails(message_ids):
+                logger.info("Process result", **result)
+        queue.delete([item['receipt'] for item in items])
+        processed += len(message_ids)
+    
+    log_llm_stats()
+    logger.info("Drained deferred messages", count=processed)
+    return {'statusCode': 200, 'body': f"Drained: {processed}"}
+
+def renew_subscription():
+    """Renew the inbox subscription if it expires within the renewal window, or recreate it"""
+    logger.info("Handling scheduled event: Checking subscription")
+    try:
+        action, state = get_subscription_manager().ensure()
+        return {'statusCode': 200, 'body': f"{action.capitalize()}: {state['id']}"}
+    except Exception as e:
+        logger.error("Failed to renew subscription", error=str(e))
+        return {'statusCode': 500, 'body': str(e)}
+
+def handle_lifecycle(notifications, context):
+    """Renew or recreate the subscription as Graph asks, and catch up when it missed notifications"""
+    manager = get_subscription_manager()
+    events = [manager.handle_lifecycle(notification) for notification in notifications]
+    if 'missed' in events:
+        logger.info("Subscription missed notifications", result=sync_inbox(context))
+
+def sync_inbox(context):
+    """
+    Process inbox messages created since the last delta sync that no notification
+    brought in, a page at a time, through the same claim/budget path as notifications
+    """
+    counts = {'processed': 0, 'deferred': 0}
+    durable = get_deferral_queue() is not None
+    
+    def process(message_ids):
+        # One drain for the whole sync, triggered below
+        results, deferred = process_within_budget(claim_messages(message_ids), context, drain=False)
+        counts['processed'] += len(results)
+        counts['deferred'] += len(deferred)
+        # Messages released without a queue are only safe while the old deltaLink is kept
+        return durable or not deferred
+    
+    stats = get_delta_sync().run(process)
+    if counts['deferred'] and durable and config.DEFERRAL_SELF_INVOKE and context is not None:
+        trigger_drain(context)
+    return (f"Synced: {stats['messages']} new, {counts['processed']} processed, {counts['deferred']} deferred"
+            + ('' if stats['complete'] else ", stopped early"))
+
+def payload_bytes(event):
+    """Size of the request body as received; a direct invocation may pass it already parsed"""
+    body = event.get('body') or ''
+    if not isinstance(body, str):
+        body = json.dumps(body)
+    return len(body.encode('utf-8'))
 
 def lambda_handler(event, context):
     """
     AWS Lambda Handler
     Handles:
     1. Webhook validation (GET)
-    2. Email notifications (POST)
-    3. Scheduled subscription renewal (EventBridge)
+    2. Email and subscription lifecycle notifications (POST)
+    3. Scheduled subscription renewal and inbox delta sync (EventBridge)
+    4. Deferred messages (self re-invocation or SQS event source)
+    Per-stage metrics of the invocation are flushed as EMF when it ends.
     """
-    logger.info(f"Received event: {json.dumps(event)}")
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    metrics.record('lambda.cold_start', int(cold_start))
+    metrics.record('lambda.payload_bytes', payload_bytes(event), 'Bytes')
+    try:
+        with metrics.span('lambda.invocation'):
+            return handle_event(event, context)
+    finally:
+        record_log_volume()
+        metrics.flush(ColdStart=cold_start, RequestId=getattr(context, 'aws_request_id', None))
+
+def handle_event(event, context):
+    """Route one Lambda event to its handler"""
+    # A summary only: the full event holds message IDs and, with rich notifications, content
+    logger.info("Received event", source=event.get('source') or event.get('requestContext', {}).get('http', {}).get('method')
+                or event.get('httpMethod') or (event.get('Records') or [{}])[0].get('eventSource'),
+                payload_bytes=payload_bytes(event), records=len(event.get('Records') or []), event=event)
+    
+    # 0. Drain messages deferred by an earlier invocation
+    if event.get('source') == DRAIN_EVENT_SOURCE:
+        return drain_deferred(context)
+    
+    if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs':
+        message_ids = [json.loads(record['body'])['message_id'] for record in event['Records']]
+        message_ids = claim_messages(message_ids)
+        results, deferred = process_within_budget(message_ids, context)
+        for result in results:
+            logger.info("Process result", **result)
+        return {'statusCode': 200, 'body': f"Processed: {len(results)}, deferred: {len(deferred)}"}
     
-    # 1. Handle Scheduled Event (EventBridge) -> Renew Subscription
+    # 1. Handle Scheduled Event (EventBridge) -> Renew Subscription, then catch up on missed mail
     if event.get('source') == 'aws.events':
-        logger.info("Handling scheduled event: Renewing subscription")
-        try:
-            from datetime import datetime, timedelta
-            import config
-            
-            expiration = datetime.utcnow() + timedelta(days=2) # Renew for 2 days
-            expiration_str = expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
-            notification_url = os.environ.get('WEBHOOK_URL') # Get from env var
-            
-            if not notification_url:
-                raise Exception("WEBHOOK_URL environment variable is missing")
-                
-            # Smart Renewal Logic
-            # 1. List existing subscriptions
-            existing_subs = graph_client.list_subscriptions()
-            target_sub = None
-            
-            # 2. Find subscription with matching URL
-            for sub in existing_subs:
-                if sub.get('notificationUrl') == notification_url:
-                    target_sub = sub
-                    break
-            
-            if target_sub:
-                # 3a. Renew existing
-                logger.info(f"Found existing subscription {target_sub['id']}, renewing...")
-                sub = graph_client.renew_subscription(target_sub['id'], expiration_str)
-                logger.info(f"Subscription renewed: {sub['id']}")
-                return {'statusCode': 200, 'body': f"Renewed: {sub['id']}"}
-            else:
-                # 3b. Create new
-                logger.info("No existing subscription found, creating new...")
-                sub = graph_client.subscribe_to_inbox(notification_url, expiration_str)
-                logger.info(f"Subscription created: {sub['id']}")
-                return {'statusCode': 200, 'body': f"Created: {sub['id']}"}
-            
-        except Exception as e:
-            logger.error(f"Failed to renew subscription: {str(e)}")
-            return {'statusCode': 500, 'body': str(e)}
+        response = renew_subscription()
+        if config.DELTA_SYNC_ENABLED:
+            try:
+                response['body'] += f", {sync_inbox(context)}"
+            except Exception as e:
+                logger.error("Delta sync failed", error=str(e))
+        return response
 
     # 2. Handle HTTP Requests (API Gateway)
     # Support both API Gateway V1 and V2 formats
@@ -111,7 +312,7 @@ def lambda_handler(event, context):
     # 2a. Webhook Validation (GET or POST with validationToken)
     validation_token = query_params.get('validationToken')
     if validation_token:
-        logger.info(f"Handling validation request: {validation_token}")
+        logger.info("Handling validation request")
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'text/plain'},
@@ -127,29 +328,53 @@ def lambda_handler(event, context):
             data = json.loads(body) if isinstance(body, str) else body
             
             if data.get('value'):
+                from notification_crypto import notification_messages
+                
+                message_ids = []
+                message_notifications = []
+                lifecycle_notifications = []
                 for notification in data['value']:
                     # Verify client state
                     if notification.get('clientState') != 'SecretClientState':
                         logger.warning("Invalid client state")
                         continue
+                    
+                    # Lifecycle events (reauthorizationRequired, subscriptionRemoved, missed) come here too
+                    if notification.get('lifecycleEvent'):
+                        lifecycle_notifications.append(notification)
+                        continue
                         
                     resource_data = notification.get('resourceData', {})
                     message_id = resource_data.get('id')
                     
                     if message_id:
-                        # 🛡️ DUPLICATE CHECK
-                        if is_duplicate_request(message_id):
-                            logger.info(f"Duplicate request for {message_id}, ignoring.")
-                            continue
-
-                        logger.info(f"Processing email: {message_id}")
-                        result = email_processor.process_email(message_id)
-                        logger.info(f"Process result: {result}")
+                        logger.debug("Queued email", message_id=message_id)
+                        message_ids.append(message_id)
+                        message_notifications.append(notification)
+                
+                # Rich notifications carry the message itself (no get_message needed),
+                # used only when the payload's validation tokens prove Graph sent it
+                messages = notification_messages(data, message_notifications)
+                
+                # 🛡️ DUPLICATE CHECK (LRU, then one DynamoDB transaction for the whole payload)
+                message_ids = claim_messages(message_ids)
+                
+                # Process the notifications in chunks: Graph calls share $batch requests,
+                # replies are generated concurrently (PROCESS_CONCURRENCY), and whatever
+                # would not finish before the timeout is deferred
+                results, deferred = process_within_budget(message_ids, context, messages)
+                logger.info("Notifications handled", notifications=len(data['value']),
+                            processed=len(results), deferred=len(deferred), with_content=len(messages))
+                for result in results:
+                    logger.info("Process result", **result)
+                
+                if lifecycle_notifications:
+                    handle_lifecycle(lifecycle_notifications, context)
             
             return {'statusCode': 202, 'body': 'Accepted'}
             
         except Exception as e:
-            logger.error(f"Error processing webhook: {str(e)}")
+            logger.error("Error processing webhook", error=str(e))
             return {'statusCode': 500, 'body': str(e)}
             
     return {'statusCode': 400, 'body': 'Invalid request'}
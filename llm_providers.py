@@ -0,0 +1,446 @@
+"""
+LLM providers and a latency-aware router in front of them.
+
+Each provider adapts one SDK (Gemini, OpenAI, Anthropic, or the local
+fake) to the same two calls: generate() for a whole reply and stream()
+for its chunks. LLMRouter sends a request to the preferred healthy
+provider and tracks rolling latency and error rate per provider. When
+the primary takes longer than its own p95, a hedged request goes to the
+next provider; whichever answers first wins and the other is cancelled.
+
+Rate limits are per provider: the caller passes limiter_for(name), and
+each attempt (first try, hedge or failover) waits on, and settles, the
+limiter of the provider it goes to. Providers without one are not limited.
+"""
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# A sign-off on a line (or in an HTML block) of its own; the signature follows it
+_SIGN_OFF_RE = re.compile(
+    r'(?:^|>)[ \t]*(?:best regards|kind regards|warm regards|regards|yours sincerely|sincerely|best wishes)'
+    r'[ \t]*[,.!]?[ \t]*(?=<|\n|$)', re.I | re.M
+)
+_BLOCK_END_RE = re.compile(r'</(p|div)>', re.I)
+
+def reply_cutoff(text, max_chars):
+    """
+    Where a streamed reply can stop: (text to keep, reason) once the reply has
+    a complete sign-off block or reaches max_chars, else (text, None). The
+    sign-off block ends with the HTML block that contains the signature, or,
+    in plain text, with the first non-empty line after the sign-off.
+    """
+    match = _SIGN_OFF_RE.search(text)
+    if match:
+        end = None
+        for block_end in _BLOCK_END_RE.finditer(text, match.end()):
+            # "<p>Best regards,</p><p>Name</p>": the name is in the next block
+            if re.sub(r'<[^>]+>|\W', '', text[match.end():block_end.start()]):
+                end = block_end.end()
+                break
+        if end is None and '<' not in text[match.end():]:
+            lines = text[match.end():].split('\n')
+            if any(line.strip() for line in lines[:-1]):
+                end = len(text) - len(lines[-1])
+        if end is not None:
+            return _close_fence(text[:end]), 'closing'
+    if len(text) >= max_chars:
+        # Break at a tag or word boundary rather than mid-word
+        end = max(text.rfind('>', 0, max_chars) + 1, text.rfind(' ', 0, max_chars))
+        return _close_fence(text[:end if end > 0 else max_chars]), 'length'
+    return text, None
+
+def _close_fence(text):
+    """Close a ```html fence the model opened but did not get to close"""
+    return text + '\n```' if text.count('```') % 2 else text
+
+class RequestCancelled(Exception):
+    """Raised inside a request that lost a hedge race"""
+
+def is_throttling_error(error):
+    """Whether a provider error is the API's own rate limit (HTTP 429)"""
+    return '429' in str(error) or type(error).__name__ in ('ResourceExhausted', 'RateLimitError')
+
+class LLMProvider:
+    """Base class: one model behind one SDK"""
+    
+    name = None
+    
+    def __init__(self, model):
+        self.model = model
+    
+    def generate(self, prompt, temperature, max_output_tokens):
+        """Return (text, used tokens or None)"""
+        raise NotImplementedError
+    
+    def stream(self, prompt, temperature, max_output_tokens, usage):
+        """Yield text chunks; set usage['total_tokens'] at the end if the API reports it"""
+        raise NotImplementedError
+    
+    def complete(self, prompt, temperature, max_output_tokens, stream=False, cancel=None):
+        """
+        Run one request; returns (text, used tokens, timing). A streamed request
+        stops at the reply's sign-off (see reply_cutoff), or when cancel is set.
+        """
+        started = time.perf_counter()
+        if not stream:
+            text, used_tokens = self.generate(prompt, temperature, max_output_tokens)
+            # Without streaming the first token arrives with the last one
+            elapsed_ms = round((time.perf_counter() - started) * 1000)
+            return text, used_tokens, {'ttft_ms': elapsed_ms, 'generation_ms': elapsed_ms, 'cutoff': None}
+        
+        usage = {}
+        chunks = self.stream(prompt, temperature, max_output_tokens, usage)
+        text = ''
+        first_token_at = None
+        cutoff = None
+        try:
+            for chunk in chunks:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled(f"{self.name} request cancelled")
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                text += chunk
+                text, cutoff = reply_cutoff(text, config.LLM_STREAM_MAX_CHARS)
+                if cutoff:
+                    break
+        finally:
+            # Closing the generator closes the underlying stream
+            chunks.close()
+        finished_at = time.perf_counter()
+        
+        timing = {
+            'ttft_ms': round(((first_token_at or finished_at) - started) * 1000),
+            'generation_ms': round((finished_at - started) * 1000),
+            'cutoff': cutoff
+        }
+        # Token usage only arrives with the last chunk, so a cut-off request has none
+        return text, usage.get('total_tokens'), timing
+
+class GeminiProvider(LLMProvider):
+    name = 'gemini'
+    
+    def __init__(self, model=None, api_key=None):
+        super().__init__(model or config.GEMINI_MODEL)
+        self.api_key = api_key or config.GEMINI_API_KEY
+        self._client = None
+        self._lock = threading.Lock()
+    
+    @property
+    def client(self):
+        """GenerativeModel, configured on first use (google.generativeai is slow to import)"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import google.generativeai as genai
+                    
+                    genai.configure(api_key=self.api_key)
+                    self._client = genai.GenerativeModel(self.model)
+        return self._client
+    
+    def _config(self, temperature, max_output_tokens):
+        return {'temperature': temperature, 'max_output_tokens': max_output_tokens}
+    
+    def generate(self, prompt, temperature, max_output_tokens):
+        response = self.client.generate_content(prompt, generation_config=self._config(temperature, max_output_tokens))
+        usage = getattr(response, 'usage_metadata', None)
+        return response.text, getattr(usage, 'total_token_count', None)
+    
+    def stream(self, prompt, temperature, max_output_tokens, usage):
+        response = self.client.generate_content(
+            prompt, generation_config=self._config(temperature, max_output_tokens), stream=True
+        )
+        for chunk in response:
+            yield chunk.text
+        total = getattr(getattr(response, 'usage_metadata', None), 'total_token_count', None)
+        if total:
+            usage['total_tokens'] = total
+
+class FakeProvider(GeminiProvider):
+    """Deterministic local model (fake_llm.FakeModel) for tests and benchmarks"""
+    
+    name = 'fake'
+    
+    def __init__(self, fake_model=None, **kwargs):
+        super().__init__(model='fake')
+        if fake_model is None:
+            from fake_llm import FakeModel
+            fake_model = FakeModel(**kwargs)
+        self._client = fake_model
+
+class OpenAIProvider(LLMProvider):
+    name = 'openai'
+    
+    def __init__(self, model=None, api_key=None):
+        super().__init__(model or config.OPENAI_MODEL)
+        self.api_key = api_key or config.OPENAI_API_KEY
+        self._client = None
+        self._lock = threading.Lock()
+    
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    self._client = OpenAI(api_key=self.api_key, timeout=config.LLM_REQUEST_TIMEOUT)
+        return self._client
+    
+    def _create(self, prompt, temperature, max_output_tokens, stream):
+        return self.client.chat.completions.create(
+            model=self.model,
+            messages=[{'role': 'user', 'content': prompt}],
+            temperature=temperature,
+            max_tokens=max_output_tokens,
+            stream=stream
+        )
+    
+    def generate(self, prompt, temperature, max_output_tokens):
+        response = self._create(prompt, temperature, max_output_tokens, stream=False)
+        return response.choices[0].message.content, response.usage.total_tokens if response.usage else None
+    
+    def stream(self, prompt, temperature, max_output_tokens, usage):
+        response = self._create(prompt, temperature, max_output_tokens, stream=True)
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            response.response.close()
+
+class AnthropicProvider(LLMProvider):
+    name = 'anthropic'
+    
+    def __init__(self, model=None, api_key=None):
+        super().__init__(model or config.ANTHROPIC_MODEL)
+        self.api_key = api_key or config.ANTHROPIC_API_KEY
+        self._client = None
+        self._lock = threading.Lock()
+    
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from anthropic import Anthropic
+                    self._client = Anthropic(api_key=self.api_key, timeout=config.LLM_REQUEST_TIMEOUT)
+        return self._client
+    
+    def _create(self, prompt, temperature, max_output_tokens, stream):
+        # Older SDKs (such as the pinned 0.8.x) only have the Messages API under beta
+        messages = getattr(self.client, 'messages', None) or self.client.beta.messages
+        return messages.create(
+            model=self.model,
+            messages=[{'role': 'user', 'content': prompt}],
+            temperature=temperature,
+            max_tokens=max_output_tokens,
+            stream=stream
+        )
+    
+    def generate(self, prompt, temperature, max_output_tokens):
+        response = self._create(prompt, temperature, max_output_tokens, stream=False)
+        text = ''.join(block.text for block in response.content if getattr(block, 'text', None))
+        return text, response.usage.input_tokens + response.usage.output_tokens
+    
+    def stream(self, prompt, temperature, max_output_tokens, usage):
+        response = self._create(prompt, temperature, max_output_tokens, stream=True)
+        input_tokens = 0
+        try:
+            for event in response:
+                if event.type == 'message_start':
+                    input_tokens = event.message.usage.input_tokens
+                elif event.type == 'content_block_delta' and getattr(event.delta, 'text', None):
+                    yield event.delta.text
+                elif event.type == 'message_delta':
+                    usage['total_tokens'] = input_tokens + event.usage.output_tokens
+        finally:
+            response.response.close()
+
+PROVIDERS = {
+    'gemini': GeminiProvider,
+    'openai': OpenAIProvider,
+    'anthropic': AnthropicProvider,
+    'fake': FakeProvider,
+}
+
+class LatencyTracker:
+    """Rolling latency percentiles and error rate over the last `window` requests"""
+    
+    def __init__(self, window=None):
+        self._samples = deque(maxlen=window or config.LLM_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds, ok):
+        with self._lock:
+            self._samples.append((seconds, ok))
+    
+    def snapshot(self):
+        with self._lock:
+            samples = list(self._samples)
+        latencies = sorted(seconds for seconds, ok in samples if ok)
+        
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else None
+        
+        return {
+            'requests': len(samples),
+            'error_rate': round(sum(1 for _, ok in samples if not ok) / len(samples), 3) if samples else 0,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+        }
+
+class LLMRouter:
+    """Sends each request to the preferred healthy provider, hedging slow ones with the next"""
+    
+    def __init__(self, providers, hedging=None):
+        if not providers:
+            raise Exception("No LLM providers configured")
+        self.providers = providers
+        self.hedging = config.LLM_HEDGING if hedging is None else hedging
+        self.trackers = {provider.name: LatencyTracker() for provider in providers}
+        self._executor = ThreadPoolExecutor(max_workers=2 * config.PROCESS_CONCURRENCY, thread_name_prefix='llm-hedge')
+        self._stats_lock = threading.Lock()
+        self.hedge_stats = {'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+    
+    @property
+    def primary(self):
+        return self.providers[0]
+    
+    def _ranked(self):
+        """Providers in configured order, with ones failing too often moved to the back"""
+        def unhealthy(provider):
+            stats = self.trackers[provider.name].snapshot()
+            return stats['requests'] >= config.LLM_HEDGE_MIN_SAMPLES and stats['error_rate'] > config.LLM_MAX_ERROR_RATE
+        return sorted(self.providers, key=unhealthy)
+    
+    def _hedge_delay(self, provider):
+        """Seconds to wait for provider before hedging: its p95, once there are enough samples"""
+        stats = self.trackers[provider.name].snapshot()
+        if stats['requests'] < config.LLM_HEDGE_MIN_SAMPLES or stats['p95'] is None:
+            return config.LLM_HEDGE_DEFAULT_DELAY_SECONDS
+        return stats['p95']
+    
+    def first_choice(self):
+        """The provider a request would be sent to first"""
+        return self._ranked()[0]
+    
+    def _attempt(self, provider, prompt, temperature, max_output_tokens, stream, cancel=None, limits=None):
+        """
+        One request to provider. limits is (limiter_for, reserved tokens, provider
+        whose limiter the caller already acquired) or None
+        """
+        limiter_for, reserved_tokens, acquired = limits or (None, 0, None)
+        limiter = limiter_for(provider.name) if limiter_for else None
+        if limiter and provider is not acquired:
+            # Raises RateLimitExceeded, which fails over like any other error
+            limiter.acquire(reserved_tokens)
+        
+        started = time.perf_counter()
+        try:
+            text, used_tokens, timing = provider.complete(prompt, temperature, max_output_tokens, stream, cancel)
+        except RequestCancelled:
+            # It was still running when the other request won: a lower bound on its latency
+            self.trackers[provider.name].record(time.perf_counter() - started, True)
+            raise
+        except Exception as e:
+            self.trackers[provider.name].record(time.perf_counter() - started, False)
+            if limiter and is_throttling_error(e):
+                limiter.throttled()
+            raise
+        self.trackers[provider.name].record(time.perf_counter() - started, True)
+        if limiter:
+            if used_tokens is None and timing['cutoff']:
+                # Usage is only reported with the last chunk of a stream
+                from prompt_builder import estimate_tokens
+                used_tokens = estimate_tokens(prompt) + estimate_tokens(text)
+            limiter.settle(reserved_tokens, used_tokens)
+        return text, used_tokens, {**timing, 'provider': provider.name}
+    
+    def _count(self, name):
+        with self._stats_lock:
+            self.hedge_stats[name] += 1
+    
+    def complete(self, prompt, temperature, max_output_tokens, stream=False, first=None, limiter_for=None,
+                 reserved_tokens=0):
+        """
+        Return (text, used tokens, timing) from the first provider to answer.
+        first (from first_choice) is tried first, its limiter already acquired by
+        the caller for reserved_tokens; other attempts acquire their own
+        """
+        ranked = self._ranked()
+        if first is not None:
+            ranked = [first] + [provider for provider in ranked if provider is not first]
+        limits = (limiter_for, reserved_tokens, first)
+        if not self.hedging or len(ranked) < 2:
+            return self._complete_with_failover(ranked, prompt, temperature, max_output_tokens, stream, limits)
+        
+        primary, secondary = ranked[0], ranked[1]
+        # A streamed loser stops between chunks; without streaming its answer is just dropped
+        cancels = {primary.name: threading.Event(), secondary.name: threading.Event()}
+        futures = {self._executor.submit(
+            self._attempt, primary, prompt, temperature, max_output_tokens, stream, cancels[primary.name], limits
+        ): primary}
+        done, _ = wait(futures, timeout=self._hedge_delay(primary))
+        if not done:
+            self._count('hedged')
+            log.info("Primary slower than its p95, hedging", primary=primary.name, secondary=secondary.name)
+            futures[self._executor.submit(
+                self._attempt, secondary, prompt, temperature, max_output_tokens, stream, cancels[secondary.name],
+                limits
+            )] = secondary
+        
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    log.warning("Error generating reply", provider=futures[future].name, error=str(e))
+                    continue
+                for other in pending:
+                    cancels[futures[other].name].set()
+                if futures[future] is not primary:
+                    self._count('hedge_wins')
+                return result
+            if not pending and len(futures) == 1:
+                # The primary failed before the hedge fired: fail over to the rest
+                self._count('failovers')
+                return self._complete_with_failover(ranked[1:], prompt, temperature, max_output_tokens, stream,
+                                                    limits)
+        raise error
+    
+    def _complete_with_failover(self, providers, prompt, temperature, max_output_tokens, stream, limits=None):
+        error = None
+        for index, provider in enumerate(providers):
+            try:
+                return self._attempt(provider, prompt, temperature, max_output_tokens, stream, limits=limits)
+            except Exception as e:
+                error = e
+                log.warning("Error generating reply", provider=provider.name, error=str(e))
+                if index + 1 < len(providers):
+                    self._count('failovers')
+        raise error
+    
+    def stats(self):
+        return {
+            **{name: tracker.snapshot() for name, tracker in self.trackers.items()},
+            **self.hedge_stats
+        }
+
+def create_router(names=None):
+    """Router over the providers named in LLM_PROVIDERS (comma-separated, preferred first)"""
+    names = names or config.LLM_PROVIDERS
+    unknown = [name for name in names if name not in PROVIDERS]
+    if unknown:
+        raise Exception(f"Unknown LLM providers: {unknown}")
+    return LLMRouter([PROVIDERS[name]() for name in names])
@@ -1,60 +1,175 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import config
-import google.generativeai as genai
+from llm_providers import create_router
+from metrics import metrics
+from prompt_builder import PromptBuilder, estimate_tokens, prompt_budget_for, truncate_to_tokens
+from rate_limiter import RateLimiter
+from reply_cache import depersonalize, personalize, reply_cache_key
+from structured_log import get_logger
+
+MAX_OUTPUT_TOKENS = 1000
+TEMPERATURE = 0.7
+
+log = get_logger(__name__)
 
 class LLMService:
-    """Service for generating email replies using Google Gemini API"""
+    """Service for generating email replies with the configured LLM providers (Gemini by default)"""
     
     def __init__(self):
-        # Configure Gemini API
-        genai.configure(api_key=config.GEMINI_API_KEY)
-        self.model = genai.GenerativeModel(config.GEMINI_MODEL)
+        # Providers in LLM_PROVIDERS order, with latency tracking and hedging; sizes the prompt builder
+        self.router = create_router()
+        # Optional ReplyCache; entry points wire in a backend (see create_reply_cache)
+        self.reply_cache = None
+        # Gemini's requests/minute and tokens/minute budgets; entry points may add a shared counter
+        self.rate_limiter = RateLimiter()
+        # Runs the blocking parts of generate_reply_async, one thread per concurrent reply
+        self._executor = ThreadPoolExecutor(max_workers=config.PROCESS_CONCURRENCY, thread_name_prefix='llm')
+    
+    @property
+    def router(self):
+        return self._router
     
-    def generate_reply(self, email_subject, email_body, sender_email, thread_history=""):
-        """Generate a reply to an email using Gemini"""
+    @router.setter
+    def router(self, router):
+        self._router = router
+        # Any of the router's providers may answer (hedging, failover): fit the smallest budget
+        self.prompt_builder = PromptBuilder(budget_tokens=prompt_budget_for(
+            [provider.model for provider in router.providers]
+        ))
+    
+    def generate_reply(self, email_subject, email_body, sender_email, thread_history="", metadata=None,
+                       sender_name=None):
+        """
+        Generate a reply to an email with the LLM router. thread_history is a list of
+        history entries (oldest first) or a formatted string; pass a dict as
+        metadata to receive the prompt budget report. With a reply cache, an
+        identical earlier inquiry is answered from the cache, addressed to sender_name.
+        Waits for the first provider's rate limiter before calling the LLM.
+        """
+        cached, cache_key, prompt = self._prepare(
+            email_subject, email_body, sender_email, thread_history, metadata, sender_name
+        )
+        if cached is not None:
+            return cached
+        
+        reserved = self._reserved_tokens(prompt)
+        first = self.router.first_choice()
+        limiter = self._limiter_for(first.name)
+        waited = limiter.acquire(reserved) if limiter else 0.0
+        self._record_wait(waited, metadata)
+        return self._generate(prompt, reserved, cache_key, sender_name, first, metadata=metadata)
+    
+    async def generate_reply_async(self, email_subject, email_body, sender_email, thread_history="", metadata=None,
+                                   sender_name=None):
+        """
+        Async variant of generate_reply. Rate limiting waits on the event loop;
+        the blocking cache and LLM calls run on a worker thread: Gemini's
+        grpc.aio client is bound to the loop that created it, and every
+        invocation runs its own loop.
+        """
+        loop = asyncio.get_running_loop()
+        cached, cache_key, prompt = await loop.run_in_executor(self._executor, functools.partial(
+            self._prepare, email_subject, email_body, sender_email, thread_history, metadata, sender_name
+        ))
+        if cached is not None:
+            return cached
         
-        prompt = self._create_prompt(email_subject, email_body, sender_email, thread_history)
+        reserved = self._reserved_tokens(prompt)
+        first = self.router.first_choice()
+        limiter = self._limiter_for(first.name)
+        waited = await limiter.acquire_async(reserved) if limiter else 0.0
+        self._record_wait(waited, metadata)
+        return await loop.run_in_executor(self._executor, functools.partial(
+            self._generate, prompt, reserved, cache_key, sender_name, first, metadata=metadata
+        ))
+    
+    def _prepare(self, email_subject, email_body, sender_email, thread_history, metadata, sender_name):
+        """Return (cached reply or None, cache key, prompt)"""
+        cache_key = None
+        if self.reply_cache:
+            # Model and prompt limits version the key: a change to either makes earlier replies stale
+            prompt_version = (f"{self.router.primary.name}:{self.router.primary.model}:"
+                              f"{self.prompt_builder.budget_tokens}:{config.HISTORY_ENTRY_MAX_CHARS}")
+            cache_key = reply_cache_key(
+                self.prompt_builder.template, prompt_version, email_subject, email_body, thread_history, sender_name
+            )
+            cached = self.reply_cache.lookup(cache_key)
+            metrics.increment('reply_cache.hits' if cached is not None else 'reply_cache.misses')
+            if metadata is not None:
+                metadata['reply_cache'] = 'hit' if cached is not None else 'miss'
+            if cached is not None:
+                log.info("Reply cache hit", **self.reply_cache.stats())
+                return personalize(cached, sender_name), cache_key, None
         
-        # Log the full prompt for debugging
-        print("\n" + "="*30 + " FULL PROMPT TO GEMINI " + "="*30)
-        print(prompt)
-        print("="*83 + "\n")
+        prompt, prompt_metadata = self._create_prompt(email_subject, email_body, sender_email, thread_history)
+        if metadata is not None:
+            metadata.update(prompt_metadata)
         
+        # Full prompts contain customer mail: only a sampled fraction is logged (LOG_CAPTURE_PROMPTS_RATE)
+        if log.should_capture(prompt):
+            log.capture("Full prompt", prompt=prompt)
+        log.info("Prompt built", estimated_tokens=prompt_metadata.get('estimated_tokens'),
+                 budget_tokens=prompt_metadata.get('budget_tokens'),
+                 history_dropped=len(prompt_metadata.get('history_dropped') or []),
+                 history_truncated=len(prompt_metadata.get('history_truncated') or []),
+                 body_truncated=prompt_metadata.get('body_truncated'))
+        return None, cache_key, prompt
+    
+    def _limiter_for(self, provider_name):
+        """The rate limiter of a provider: only Gemini's budget is enforced here"""
+        return self.rate_limiter if provider_name == 'gemini' else None
+    
+    def _record_wait(self, waited, metadata):
+        metrics.record('llm.rate_limit_wait', round(waited * 1000, 2), 'Milliseconds')
+        if metadata is not None:
+            metadata['rate_limit_wait'] = round(waited, 3)
+    
+    def _reserved_tokens(self, prompt):
+        """Tokens to reserve for a request: the estimated prompt plus the longest possible reply"""
+        return estimate_tokens(prompt) + MAX_OUTPUT_TOKENS
+    
+    def _generate(self, prompt, reserved_tokens, cache_key, sender_name, first, metadata=None):
+        """
+        Call the LLM through the router, first provider's rate limiter already
+        acquired; the router settles it and limits hedges and failovers itself
+        """
         try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config={
-                    'temperature': 0.7,
-                    'max_output_tokens': 1000,
-                }
-            )
-            
-            return response.text
-            
+            with metrics.span('llm.generate'):
+                text, _, timing = self.router.complete(
+                    prompt, TEMPERATURE, MAX_OUTPUT_TOKENS, stream=config.LLM_STREAMING,
+                    first=first, limiter_for=self._limiter_for, reserved_tokens=reserved_tokens
+                )
         except Exception as e:
-            print(f"Error generating reply with Gemini: {str(e)}")
+            metrics.increment('llm.errors')
+            log.error("Error generating reply", error=str(e))
             raise
+        
+        metrics.record('llm.ttft', timing['ttft_ms'], 'Milliseconds')
+        metrics.record('llm.prompt_tokens', estimate_tokens(prompt))
+        metrics.record('llm.response_tokens', estimate_tokens(text))
+        log.info("Reply generated", chars=len(text), **timing)
+        if metadata is not None:
+            metadata.update(timing)
+        if cache_key:
+            self.reply_cache.store(cache_key, depersonalize(text, sender_name))
+        return text
     
     def _create_prompt(self, subject, body, sender, thread_history=""):
-        """Create a prompt for Gemini"""
+        """Create a prompt for the LLM within the token budget; returns (prompt, metadata)"""
         try:
-            from prompts.email_reply import EMAIL_REPLY_PROMPT
-            
-            # Fill in the template
-            return EMAIL_REPLY_PROMPT.format(
-                sender=sender,
-                subject=subject,
-                body=body,
-                thread_history=thread_history if thread_history else "No previous conversation."
-            )
+            return self.prompt_builder.build(subject, body, sender, thread_history)
         except Exception as e:
-            print(f"Error creating prompt: {e}")
+            log.error("Error creating prompt", error=str(e))
             # Fallback prompt just in case
             return f"""
             You are an AI assistant. Please draft a reply to this email:
             From: {sender}
             Subject: {subject}
-            Body: {body}
-            """
+            Body: {truncate_to_tokens(body or '', self.prompt_builder.budget_tokens)}
+            """, {'fallback': True}
 
 # Singleton instance
 llm_service = LLMService()
@@ -0,0 +1,153 @@
+"""
+Per-stage timings and counters, emitted in CloudWatch Embedded Metric Format.
+
+Modules time their stages with metrics.span('graph.get_message') and
+record sizes and counts with metrics.record(); values accumulate until
+the end of the invocation (or worker batch), when flush() writes them as
+one EMF document to the configured sink. In the Lambda that is a log
+line CloudWatch turns into metrics; scripts/server.py appends to a file;
+the null sink drops everything.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# EMF allows at most 100 metrics per document and 100 values per metric
+MAX_METRICS_PER_DOCUMENT = 100
+MAX_VALUES_PER_METRIC = 100
+
+class NullSink:
+    """Drops metrics"""
+    
+    def write(self, document):
+        pass
+
+class StdoutSink:
+    """One JSON line per document on stdout, where the Lambda log agent picks up EMF"""
+    
+    def write(self, document):
+        print(json.dumps(document), flush=True)
+
+class FileSink:
+    """Appends one JSON line per document to a local file"""
+    
+    def __init__(self, path=None):
+        self.path = path or config.METRICS_FILE
+        self._lock = threading.Lock()
+    
+    def write(self, document):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(document) + '\n')
+
+def create_metrics_sink(default_backend):
+    """Sink for METRICS_SINK ('stdout', 'file' or 'none'), else default_backend"""
+    backend = config.METRICS_SINK or default_backend
+    if backend == 'none':
+        return NullSink()
+    if backend == 'stdout':
+        return StdoutSink()
+    if backend == 'file':
+        return FileSink()
+    raise Exception(f"Unknown metrics sink: {backend}")
+
+class Metrics:
+    """
+    Collects metric values from any thread until flush(). The buffer is shared,
+    so with several workers a flush carries whatever all of them recorded
+    """
+    
+    def __init__(self, sink=None, namespace=None, service=None):
+        self.sink = sink or NullSink()
+        self.namespace = namespace or config.METRICS_NAMESPACE
+        self.service = service or config.METRICS_SERVICE
+        self._lock = threading.Lock()
+        # Held for a whole flush, and by callers deriving metrics just before one
+        self._flush_lock = threading.RLock()
+        self._values = {}
+        self._units = {}
+        self._properties = {}
+    
+    def record(self, name, value, unit='Count'):
+        """Add one value to a metric (units as CloudWatch names them: Milliseconds, Bytes, Count)"""
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+            self._units[name] = unit
+    
+    def increment(self, name, value=1):
+        self.record(name, value, 'Count')
+    
+    def add(self, name, value, unit='Count'):
+        """Add value to a single running total instead of appending a value"""
+        with self._lock:
+            values = self._values.setdefault(name, [0])
+            values[-1] += value
+            self._units[name] = unit
+    
+    def total(self, name):
+        """Sum of the values recorded for name since the last flush"""
+        with self._lock:
+            return sum(self._values.get(name, []))
+    
+    def set_property(self, name, value):
+        """Attach a value to the document that is searchable in the logs but is not a metric"""
+        with self._lock:
+            self._properties[name] = value
+    
+    @contextmanager
+    def span(self, name):
+        """Time the block as name (in milliseconds), including when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, round((time.perf_counter() - started) * 1000, 2), 'Milliseconds')
+    
+    @contextmanager
+    def flushing(self):
+        """
+        Keep other threads from flushing during the block, so metrics derived from
+        the totals (record_log_volume) are flushed with the values they came from
+        """
+        with self._flush_lock:
+            yield
+    
+    def flush(self, **properties):
+        """Write everything recorded so far to the sink and start over"""
+        with self._flush_lock:
+            with self._lock:
+                values, units = self._values, self._units
+                properties = {**self._properties, **properties}
+                self._values, self._units, self._properties = {}, {}, {}
+            if not values:
+                return
+            names = sorted(values)
+            try:
+                for start in range(0, len(names), MAX_METRICS_PER_DOCUMENT):
+                    self.sink.write(self._document(names[start:start + MAX_METRICS_PER_DOCUMENT], values, units,
+                                                   properties))
+            except Exception as e:
+                print(f"Warning: Failed to write metrics: {e}")
+    
+    def _document(self, names, values, units, properties):
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in names]
+                }]
+            },
+            'Service': self.service,
+            **properties
+        }
+        for name in names:
+            metric_values = values[name][-MAX_VALUES_PER_METRIC:]
+            document[name] = metric_values[0] if len(metric_values) == 1 else metric_values
+        return document
+
+# Singleton instance (entry points choose the sink)
+metrics = Metrics()
@@ -0,0 +1,239 @@
+"""
+Encrypted resource data of rich change notifications.
+
+With RICH_NOTIFICATIONS on, the inbox subscription asks Graph to include
+the new message (the MESSAGE_SELECT_FIELDS) in each notification,
+encrypted with our certificate, so processing can skip get_message.
+Graph encrypts the message with a fresh AES key and sends with it:
+
+- dataKey: that key, encrypted with our public key (RSA-OAEP, SHA-1)
+- dataSignature: HMAC-SHA256 of the encrypted data under that key
+- data: the message JSON, AES-256-CBC with the first 16 key bytes as IV
+
+The certificate and private key come from PEM environment variables in
+the Lambda (NOTIFICATION_CERTIFICATE, NOTIFICATION_PRIVATE_KEY) or PEM
+files locally; scripts/create_notification_cert.py generates a pair.
+
+The HMAC only proves the data was not changed after whoever sent it
+picked the key, so content is only used when the payload's
+validationTokens verify: JWTs signed with Microsoft's published keys,
+issued to our app (CLIENT_ID) for the Graph change-notification service.
+Without that, or when content cannot be decrypted, the message is fetched.
+"""
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# Application ID Graph change notifications are issued by (the azp claim)
+GRAPH_NOTIFICATION_APP_ID = '0bf30f3b-4a52-48df-9a82-234910c4a086'
+JWKS_URL = 'https://login.microsoftonline.com/common/discovery/v2.0/keys'
+# Refetch Microsoft's signing keys at most this often, unless a token names an unknown one
+JWKS_CACHE_SECONDS = 24 * 3600
+# Clock skew tolerated on exp/nbf
+TOKEN_LEEWAY_SECONDS = 300
+
+def _read_pem(value, path):
+    if value:
+        return value.encode('utf-8')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    return None
+
+class NotificationKeys:
+    """Our notification certificate and private key, identified by certificate_id"""
+    
+    def __init__(self, certificate_pem, private_key_pem, certificate_id=None):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import serialization
+        
+        self.certificate = x509.load_pem_x509_certificate(certificate_pem)
+        self.private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+        self.certificate_id = certificate_id or config.NOTIFICATION_CERTIFICATE_ID
+    
+    @property
+    def encryption_certificate(self):
+        """Base64 DER certificate, as a subscription's encryptionCertificate"""
+        from cryptography.hazmat.primitives import serialization
+        return base64.b64encode(self.certificate.public_bytes(serialization.Encoding.DER)).decode('ascii')
+    
+    def _oaep(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
+    
+    def decrypt(self, encrypted_content):
+        """The resource in a notification's encryptedContent; raises if it is not ours or was tampered with"""
+        from cryptography.hazmat.primitives import padding as symmetric_padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        
+        certificate_id = encrypted_content.get('encryptionCertificateId')
+        if certificate_id != self.certificate_id:
+            raise Exception(f"Notification encrypted for unknown certificate {certificate_id}")
+        
+        key = self.private_key.decrypt(base64.b64decode(encrypted_content['dataKey']), self._oaep())
+        data = base64.b64decode(encrypted_content['data'])
+        signature = hmac.new(key, data, hashlib.sha256).digest()
+        if not hmac.compare_digest(signature, base64.b64decode(encrypted_content['dataSignature'])):
+            raise Exception("Notification data signature does not match")
+        
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).decryptor()
+        unpadder = symmetric_padding.PKCS7(128).unpadder()
+        padded = decryptor.update(data) + decryptor.finalize()
+        return json.loads(unpadder.update(padded) + unpadder.finalize())
+    
+    def encrypt(self, resource):
+        """encryptedContent for resource the way Graph builds it (for offline tests)"""
+        from cryptography.hazmat.primitives import padding as symmetric_padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        
+        key = os.urandom(32)
+        padder = symmetric_padding.PKCS7(128).padder()
+        padded = padder.update(json.dumps(resource).encode('utf-8')) + padder.finalize()
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(key[:16])).encryptor()
+        data = encryptor.update(padded) + encryptor.finalize()
+        return {
+            'data': base64.b64encode(data).decode('ascii'),
+            'dataSignature': base64.b64encode(hmac.new(key, data, hashlib.sha256).digest()).decode('ascii'),
+            'dataKey': base64.b64encode(self.certificate.public_key().encrypt(key, self._oaep())).decode('ascii'),
+            'encryptionCertificateId': self.certificate_id
+        }
+
+def _b64url(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def _fetch_jwks():
+    import requests
+    response = requests.get(JWKS_URL, timeout=10)
+    response.raise_for_status()
+    return response.json()['keys']
+
+class ValidationTokenVerifier:
+    """Checks the validationTokens of rich notification payloads (RS256 JWTs from Microsoft identity)"""
+    
+    def __init__(self, app_id=None, tenant_id=None, fetch_keys=None, clock=time.time):
+        self.app_id = app_id or config.CLIENT_ID
+        self.tenant_id = tenant_id or config.TENANT_ID
+        self.fetch_keys = fetch_keys or _fetch_jwks
+        self.clock = clock
+        self._keys = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+    
+    def _public_key(self, kid):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        
+        with self._lock:
+            stale = self.clock() - self._fetched_at > JWKS_CACHE_SECONDS
+            if stale or kid not in self._keys:
+                self._keys = {key['kid']: key for key in self.fetch_keys() if key.get('kty') == 'RSA'}
+                self._fetched_at = self.clock()
+            jwk = self._keys.get(kid)
+        if not jwk:
+            raise Exception(f"Unknown signing key {kid}")
+        exponent, modulus = (int.from_bytes(_b64url(jwk[name]), 'big') for name in ('e', 'n'))
+        return rsa.RSAPublicNumbers(exponent, modulus).public_key()
+    
+    def verify(self, token):
+        """Claims of a valid token; raises otherwise"""
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        
+        header_b64, claims_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64url(header_b64))
+        if header.get('alg') != 'RS256':
+            raise Exception(f"Unexpected token algorithm {header.get('alg')}")
+        self._public_key(header.get('kid')).verify(
+            _b64url(signature_b64), f'{header_b64}.{claims_b64}'.encode('ascii'),
+            padding.PKCS1v15(), hashes.SHA256()
+        )
+        
+        claims = json.loads(_b64url(claims_b64))
+        now = self.clock()
+        if not self.app_id or claims.get('aud') != self.app_id:
+            raise Exception("Token audience is not this app")
+        if claims.get('azp', claims.get('appid')) != GRAPH_NOTIFICATION_APP_ID:
+            raise Exception("Token was not issued to Graph change notifications")
+        issuer = claims.get('iss', '')
+        if not issuer.startswith(('https://sts.windows.net/', 'https://login.microsoftonline.com/')):
+            raise Exception(f"Unexpected token issuer {issuer}")
+        if self.tenant_id not in ('common', 'organizations', 'consumers') and self.tenant_id not in issuer:
+            raise Exception("Token issued for another tenant")
+        if claims.get('exp', 0) < now - TOKEN_LEEWAY_SECONDS or claims.get('nbf', 0) > now + TOKEN_LEEWAY_SECONDS:
+            raise Exception("Token expired or not yet valid")
+        return claims
+    
+    def verify_all(self, tokens):
+        """Whether there are tokens and every one of them is valid"""
+        if not tokens:
+            return False
+        try:
+            for token in tokens:
+                self.verify(token)
+            return True
+        except Exception as e:
+            log.warning("Invalid notification validation token", error=str(e))
+            return False
+
+validation_token_verifier = ValidationTokenVerifier()
+
+@functools.lru_cache(maxsize=None)
+def load_notification_keys():
+    """NotificationKeys from the configured PEMs, or None when rich notifications are off or unconfigured"""
+    if not config.RICH_NOTIFICATIONS:
+        return None
+    certificate = _read_pem(config.NOTIFICATION_CERTIFICATE, config.NOTIFICATION_CERTIFICATE_FILE)
+    private_key = _read_pem(config.NOTIFICATION_PRIVATE_KEY, config.NOTIFICATION_PRIVATE_KEY_FILE)
+    if not certificate or not private_key:
+        log.warning("RICH_NOTIFICATIONS is on but no notification certificate is configured")
+        return None
+    return NotificationKeys(certificate, private_key)
+
+def notification_message(notification, keys=None):
+    """
+    The message carried by a rich notification, or None (basic notification,
+    rich notifications off, or content we cannot decrypt) so it gets fetched.
+    Only use it once the payload's validation tokens verified (notification_messages)
+    """
+    encrypted_content = notification.get('encryptedContent')
+    keys = keys or load_notification_keys()
+    if not encrypted_content or not keys:
+        return None
+    try:
+        message = keys.decrypt(encrypted_content)
+    except Exception as e:
+        log.warning("Could not decrypt notification content", error=str(e))
+        return None
+    if message.get('id') != (notification.get('resourceData') or {}).get('id'):
+        log.warning("Notification content is for another message")
+        return None
+    return message
+
+def notification_messages(payload, notifications, keys=None, verifier=None):
+    """
+    {message_id: message} carried by notifications (those of payload that passed
+    the clientState check), or {} unless payload's validationTokens prove Graph sent them
+    """
+    if not any(notification.get('encryptedContent') for notification in notifications):
+        return {}
+    keys = keys or load_notification_keys()
+    if not keys:
+        return {}
+    if not (verifier or validation_token_verifier).verify_all(payload.get('validationTokens')):
+        return {}
+    messages = {}
+    for notification in notifications:
+        message = notification_message(notification, keys)
+        if message:
+            messages[message['id']] = message
+    return messages
@@ -0,0 +1,126 @@
+"""
+Token-budgeted prompt assembly for reply generation.
+
+Tokens are estimated locally (no countTokens call): roughly one token per
+four characters of Latin text and one per Hangul/CJK character, which errs
+on the high side for Gemini. The budget is filled newest-first: the current
+message, then thread history from the most recent message backwards. A
+message that no longer fits whole is cut down to an excerpt; everything
+older is dropped and reported in the metadata.
+"""
+import math
+import re
+
+import config
+from prompts.email_reply import EMAIL_REPLY_PROMPT
+
+CHARS_PER_TOKEN = 4
+# A history excerpt shorter than this is not worth including
+MIN_EXCERPT_TOKENS = 40
+NO_HISTORY = "No previous conversation."
+
+# Hangul, kana and CJK ideographs are roughly a token each
+_CJK_RE = re.compile(r'[\u1100-\u11ff\u3040-\u30ff\u3130-\u318f\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+def estimate_tokens(text):
+    """Estimate the token count of text without calling the model"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / CHARS_PER_TOKEN)
+
+def truncate_to_tokens(text, max_tokens, marker='...'):
+    """Longest prefix of text (plus marker) that fits in max_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - estimate_tokens(marker)
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low].rstrip() + marker
+
+def prompt_budget_for(models):
+    """Token budget for a prompt any of models may answer: PROMPT_TOKEN_BUDGET, else the smallest per-model budget"""
+    if config.PROMPT_TOKEN_BUDGET:
+        return config.PROMPT_TOKEN_BUDGET
+    return min(config.PROMPT_TOKEN_BUDGETS.get(model, config.DEFAULT_PROMPT_TOKEN_BUDGET) for model in models)
+
+class PromptBuilder:
+    """Builds EMAIL_REPLY_PROMPT within a total token budget"""
+    
+    def __init__(self, template=EMAIL_REPLY_PROMPT, budget_tokens=None):
+        self.template = template
+        self.budget_tokens = budget_tokens or prompt_budget_for([config.GEMINI_MODEL])
+    
+    def build(self, subject, body, sender, thread_history=None):
+        """
+        Return (prompt, metadata). thread_history is a list of entries
+        ({'id', 'sender', 'received', 'content'}, oldest first) or an already
+        formatted string, which is treated as a single history block.
+        """
+        entries = self._history_entries(thread_history)
+        # Everything but the body and history, with the placeholder used when history is empty
+        overhead = estimate_tokens(
+            self.template.format(sender=sender, subject=subject, body='', thread_history=NO_HISTORY)
+        )
+        remaining = self.budget_tokens - overhead
+        
+        # 1. Current message
+        body = body or ''
+        body_tokens = estimate_tokens(body)
+        kept_body = truncate_to_tokens(body, max(remaining, 0))
+        remaining -= estimate_tokens(kept_body)
+        
+        # 2. History, newest first
+        included, truncated, dropped = [], [], []
+        separator = estimate_tokens('\n\n')
+        for entry in reversed(entries):
+            block = self._format_entry(entry)
+            tokens = estimate_tokens(block) + separator
+            if not dropped and tokens <= remaining:
+                included.append(block)
+                remaining -= tokens
+            elif not dropped and remaining - separator >= MIN_EXCERPT_TOKENS:
+                block = truncate_to_tokens(block, remaining - separator)
+                included.append(block)
+                truncated.append(self._describe(entry, tokens))
+                remaining = 0
+            else:
+                dropped.append(self._describe(entry, tokens))
+        
+        history_text = "\n\n".join(reversed(included)) or NO_HISTORY
+        prompt = self.template.format(sender=sender, subject=subject, body=kept_body, thread_history=history_text)
+        
+        metadata = {
+            'budget_tokens': self.budget_tokens,
+            'estimated_tokens': estimate_tokens(prompt),
+            'body_tokens': body_tokens,
+            'body_truncated': kept_body != body,
+            'history_messages': len(entries),
+            'history_included': len(included),
+            'history_truncated': truncated,
+            'history_dropped': dropped,
+            'dropped_tokens': sum(item['tokens'] for item in dropped)
+        }
+        return prompt, metadata
+    
+    def _history_entries(self, thread_history):
+        if not thread_history:
+            return []
+        if isinstance(thread_history, str):
+            return [{'id': None, 'sender': None, 'received': '', 'content': thread_history}]
+        return list(thread_history)
+    
+    def _format_entry(self, entry):
+        """One history message as shown to the model"""
+        if entry.get('sender') is None:
+            return entry['content']
+        date = entry.get('received', '').split('T')[0]
+        return f"--- Message from {entry['sender']} on {date} ---\n{entry['content']}"
+    
+    def _describe(self, entry, tokens):
+        return {'id': entry.get('id'), 'received': entry.get('received', ''), 'tokens': tokens}
@@ -0,0 +1,66 @@
+# Templated replies for intents handled without the LLM (see intent_classifier.py).
+# None means no draft is created at all.
+
+SHIPPING_DELAY_REPLY = """<p>Dear {sender_name},</p>
+<p>Thank you for contacting K Glowing, and we are sorry that your order has not reached you yet.</p>
+<p>Please contact your local DHL office with the tracking number we sent you when your order shipped;
+they can tell you exactly where the parcel is and when it will be delivered.
+In the meantime, we will also let the brand know so they can follow up on their side.</p>
+<p>If you cannot find the tracking number, just reply to this email and we will send it again.</p>
+<p>Best regards,<br>K Glowing Customer Support</p>
+"""
+
+ORDER_STATUS_REPLY = """<p>Dear {sender_name},</p>
+<p>Thank you for your message. We have received your inquiry about the status of your order
+and are checking it with our warehouse now.</p>
+<p>We will get back to you with the shipping details and tracking number as soon as we have them.</p>
+<p>Best regards,<br>K Glowing Customer Support</p>
+"""
+
+RETURN_ADDRESS_REPLY = """<p>Dear {sender_name},</p>
+<p>Thank you for your message. Before sending anything back, please reply with your order number
+and the items you would like to return, and we will send you the return address and instructions
+for your region.</p>
+<p>Best regards,<br>K Glowing Customer Support</p>
+"""
+
+INTENT_REPLIES = {
+    'shipping_delay': SHIPPING_DELAY_REPLY,
+    'order_status': ORDER_STATUS_REPLY,
+    'return_address': RETURN_ADDRESS_REPLY,
+    'out_of_office': None,
+    'newsletter': None,
+}
+
+# Korean mail gets Korean replies (intent_classifier.reply_language)
+
+SHIPPING_DELAY_REPLY_KO = """<p>{sender_name}님, 안녕하세요.</p>
+<p>K Glowing에 문의해 주셔서 감사합니다. 주문하신 상품이 아직 도착하지 않아 불편을 드려 죄송합니다.</p>
+<p>발송 시 안내해 드린 운송장 번호로 DHL 현지 지점에 문의하시면 현재 위치와 배송 예정일을
+정확히 확인하실 수 있습니다. 저희도 브랜드 측에 상황을 전달하여 함께 확인하겠습니다.</p>
+<p>운송장 번호를 찾지 못하셨다면 이 메일에 회신해 주세요. 다시 보내 드리겠습니다.</p>
+<p>감사합니다.<br>K Glowing 고객지원팀 드림</p>
+"""
+
+ORDER_STATUS_REPLY_KO = """<p>{sender_name}님, 안녕하세요.</p>
+<p>문의해 주셔서 감사합니다. 주문 상태에 대한 문의를 접수하였으며, 지금 창고와 확인하고 있습니다.</p>
+<p>배송 정보와 운송장 번호가 확인되는 대로 바로 안내해 드리겠습니다.</p>
+<p>감사합니다.<br>K Glowing 고객지원팀 드림</p>
+"""
+
+RETURN_ADDRESS_REPLY_KO = """<p>{sender_name}님, 안녕하세요.</p>
+<p>문의해 주셔서 감사합니다. 상품을 보내시기 전에 주문 번호와 반품하실 상품을 회신해 주시면
+지역에 맞는 반품 주소와 절차를 안내해 드리겠습니다.</p>
+<p>감사합니다.<br>K Glowing 고객지원팀 드림</p>
+"""
+
+INTENT_REPLIES_KO = {
+    **INTENT_REPLIES,
+    'shipping_delay': SHIPPING_DELAY_REPLY_KO,
+    'order_status': ORDER_STATUS_REPLY_KO,
+    'return_address': RETURN_ADDRESS_REPLY_KO,
+}
+
+INTENT_REPLIES_BY_LANGUAGE = {'en': INTENT_REPLIES, 'ko': INTENT_REPLIES_KO}
+# How a sender without a display name is addressed
+UNKNOWN_SENDER_NAME = {'en': 'Customer', 'ko': '고객'}
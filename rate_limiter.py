@@ -0,0 +1,235 @@
+"""
+Client-side rate limiting for the Gemini API.
+
+Two token buckets, one for requests per minute and one for tokens per
+minute, refill continuously. A caller reserves from both at once and
+then sleeps until the reservation is covered, so callers are served in
+the order they arrived instead of failing on a burst. A caller that
+would wait longer than max_wait_seconds is rejected instead.
+
+The buckets are per process. With RATE_LIMIT_SHARED_BACKEND=dynamodb,
+Lambda containers additionally count requests and tokens per minute in
+a shared DynamoDB item and wait for the next minute when it is full.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import config
+
+class RateLimitExceeded(Exception):
+    """Raised when a request would have to wait longer than max_wait_seconds"""
+
+class TokenBucket:
+    """Continuously refilling bucket that can go into debt for reservations"""
+    
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, amount, now):
+        """Seconds until amount would be covered, without reserving it"""
+        self._refill(now)
+        # A single request larger than the bucket only waits for a full bucket
+        shortfall = min(amount, self.capacity) - self.level
+        return max(0.0, shortfall / self.rate)
+    
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+    
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+    
+    def drain(self):
+        """Empty the bucket (the API told us we are over the limit)"""
+        self.level = min(self.level, 0.0)
+
+class RateCounter:
+    """Per-minute request and token counts shared between processes"""
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+    
+    def try_consume(self, tokens):
+        """Count one request of tokens in the current minute; return 0, or seconds until the next minute"""
+        window = int(time.time() // 60)
+        if self.increment(window, tokens):
+            return 0.0
+        return (window + 1) * 60 - time.time()
+    
+    def increment(self, window, tokens):
+        """Add one request and tokens to window if both stay within the limits; return whether it did"""
+        raise NotImplementedError
+
+class MemoryRateCounter(RateCounter):
+    """In-process stand-in for the shared counter (tests and single-process runs)"""
+    
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._windows = {}
+        self._lock = threading.Lock()
+    
+    def increment(self, window, tokens):
+        with self._lock:
+            for old in [key for key in self._windows if key < window]:
+                del self._windows[old]
+            requests, used = self._windows.get(window, (0, 0))
+            if requests >= self.requests_per_minute or used + tokens > self.tokens_per_minute:
+                return False
+            self._windows[window] = (requests + 1, used + tokens)
+            return True
+
+class DynamoDBRateCounter(RateCounter):
+    """
+    ratelimit_<minute> items in the bot's DynamoDB table, incremented with a
+    conditional ADD so concurrent containers cannot overshoot the limits.
+    Items expire through the table's expires_at TTL.
+    """
+    
+    def __init__(self, table, *args):
+        super().__init__(*args)
+        self.table = table
+    
+    def increment(self, window, tokens):
+        from botocore.exceptions import ClientError
+        
+        try:
+            self.table.update_item(
+                Key={'token_id': f'ratelimit_{window}'},
+                UpdateExpression='ADD requests :one, tokens :tokens SET expires_at = :expires_at',
+                ConditionExpression='attribute_not_exists(requests) OR (requests < :rpm AND tokens <= :room)',
+                ExpressionAttributeValues={
+                    ':one': 1,
+                    ':tokens': tokens,
+                    ':rpm': self.requests_per_minute,
+                    ':room': self.tokens_per_minute - tokens,
+                    ':expires_at': (window + 2) * 60
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+class RateLimiter:
+    """Requests/minute and tokens/minute limits with FIFO waiting, for sync and async callers"""
+    
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_wait_seconds=None, shared=None):
+        self.requests_per_minute = requests_per_minute or config.GEMINI_RPM
+        self.tokens_per_minute = tokens_per_minute or config.GEMINI_TPM
+        self.max_wait_seconds = max_wait_seconds if max_wait_seconds is not None else config.RATE_LIMIT_MAX_WAIT_SECONDS
+        self.requests = TokenBucket(self.requests_per_minute, self.requests_per_minute)
+        self.tokens = TokenBucket(self.tokens_per_minute, self.tokens_per_minute)
+        # Optional RateCounter shared with other containers (see create_rate_counter)
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=500)
+        self._stats = {'acquired': 0, 'waited': 0, 'rejected': 0, 'shared_waits': 0, 'throttled': 0,
+                       'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0}
+    
+    def _reserve(self, tokens):
+        """Reserve one request and tokens locally; return the seconds to wait for them"""
+        with self._lock:
+            now = time.monotonic()
+            delay = max(self.requests.delay(1, now), self.tokens.delay(tokens, now))
+            if delay > self.max_wait_seconds:
+                self._stats['rejected'] += 1
+                raise RateLimitExceeded(
+                    f"Gemini rate limit: request would wait {delay:.1f}s (max {self.max_wait_seconds}s)"
+                )
+            self.requests.reserve(1, now)
+            self.tokens.reserve(tokens, now)
+            return delay
+    
+    def _shared_delay(self, tokens, waited):
+        """Seconds to wait for the shared counter, or 0 once it has counted this request"""
+        delay = self.shared.try_consume(tokens)
+        if delay and waited + delay > self.max_wait_seconds:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise RateLimitExceeded(f"Gemini rate limit: shared per-minute budget is used up for {delay:.1f}s")
+        if delay:
+            with self._lock:
+                self._stats['shared_waits'] += 1
+        return delay
+    
+    def acquire(self, tokens=0):
+        """Block until a request of tokens fits the limits; return the seconds waited"""
+        started = time.monotonic()
+        delay = self._reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        while self.shared:
+            delay = self._shared_delay(tokens, time.monotonic() - started)
+            if not delay:
+                break
+            time.sleep(delay)
+        return self._record(time.monotonic() - started)
+    
+    async def acquire_async(self, tokens=0):
+        """Async variant of acquire; waits without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        delay = self._reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+        while self.shared:
+            delay = await loop.run_in_executor(None, self._shared_delay, tokens, time.monotonic() - started)
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+        return self._record(time.monotonic() - started)
+    
+    def settle(self, reserved_tokens, used_tokens):
+        """Give back the part of a token reservation the request did not use (local buckets only)"""
+        if used_tokens is not None and used_tokens < reserved_tokens:
+            with self._lock:
+                self.tokens.refund(reserved_tokens - used_tokens)
+    
+    def throttled(self):
+        """The API answered 429 anyway: stop local requests until the bucket refills"""
+        with self._lock:
+            self.requests.drain()
+            self._stats['throttled'] += 1
+    
+    def _record(self, waited):
+        with self._lock:
+            self._stats['acquired'] += 1
+            if waited >= 0.001:
+                self._stats['waited'] += 1
+                self._stats['wait_seconds_total'] += waited
+                self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+            self._waits.append(waited)
+        return waited
+    
+    def stats(self):
+        """Counters plus wait-time percentiles over the last 500 requests"""
+        with self._lock:
+            stats = dict(self._stats)
+            waits = sorted(self._waits)
+        for name, fraction in (('wait_seconds_p50', 0.5), ('wait_seconds_p95', 0.95)):
+            stats[name] = round(waits[min(len(waits) - 1, int(fraction * len(waits)))], 3) if waits else 0
+        stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 3)
+        stats['wait_seconds_max'] = round(stats['wait_seconds_max'], 3)
+        return stats
+
+def create_rate_counter(table=None):
+    """Shared counter for RATE_LIMIT_SHARED_BACKEND ('dynamodb', 'memory' or 'none')"""
+    backend = config.RATE_LIMIT_SHARED_BACKEND
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return MemoryRateCounter(config.GEMINI_RPM, config.GEMINI_TPM)
+    if backend == 'dynamodb':
+        return DynamoDBRateCounter(table, config.GEMINI_RPM, config.GEMINI_TPM)
+    raise Exception(f"Unknown rate limit backend: {backend}")
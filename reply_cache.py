@@ -0,0 +1,222 @@
+"""
+Content-addressed cache of generated replies.
+
+Many inquiries are near-identical ("my package hasn't arrived"), so the
+reply is cached under a hash of everything that shaped it: the prompt
+template, the model, and the normalised subject, body and thread history.
+The sender's name is taken out of the inputs before hashing and out of the
+stored reply, then put back for whoever the cached reply is sent to.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+NAME_PLACEHOLDER = '{{sender_name}}'
+FIRST_NAME_PLACEHOLDER = '{{sender_first_name}}'
+
+_SUBJECT_PREFIX_RE = re.compile(r'^\s*(re|fw|fwd|aw|답장|회신|전달)\s*:\s*', re.I)
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+def _name_parts(sender_name):
+    """(full name, first name) worth substituting, skipping placeholders like 'Unknown'"""
+    if not sender_name or sender_name == 'Unknown':
+        return None, None
+    first = sender_name.split()[0]
+    return sender_name, first if first != sender_name and len(first) > 1 else None
+
+def _normalize(text, sender_name=None):
+    text = text or ''
+    for name in _name_parts(sender_name):
+        if name:
+            text = re.sub(re.escape(name), ' ', text, flags=re.I)
+    return ' '.join(_PUNCTUATION_RE.sub(' ', text.lower()).split())
+
+def _normalize_subject(subject):
+    subject = subject or ''
+    while _SUBJECT_PREFIX_RE.match(subject):
+        subject = _SUBJECT_PREFIX_RE.sub('', subject, count=1)
+    return _normalize(subject)
+
+def _condense_history(thread_history, sender_name=None):
+    if not thread_history:
+        return ''
+    if isinstance(thread_history, str):
+        return _normalize(thread_history, sender_name)
+    return '\n'.join(_normalize(entry.get('content'), sender_name) for entry in thread_history)
+
+def reply_cache_key(template, model, subject, body, thread_history=None, sender_name=None):
+    """Hash of the normalised inputs of one reply (the template text itself versions the key)"""
+    parts = [
+        template, model, _normalize_subject(subject),
+        _normalize(body, sender_name), _condense_history(thread_history, sender_name)
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def depersonalize(reply, sender_name):
+    """Swap the sender's name in a reply for placeholders"""
+    full, first = _name_parts(sender_name)
+    if full:
+        reply = reply.replace(full, NAME_PLACEHOLDER)
+    if first:
+        reply = re.sub(r'\b%s\b' % re.escape(first), FIRST_NAME_PLACEHOLDER, reply)
+    return reply
+
+def personalize(reply, sender_name):
+    """Fill the name placeholders of a cached reply for a new sender"""
+    full, first = _name_parts(sender_name)
+    # Without a usable name, fall back to a neutral greeting word
+    reply = reply.replace(NAME_PLACEHOLDER, full or 'Customer')
+    return reply.replace(FIRST_NAME_PLACEHOLDER, first or full or 'Customer')
+
+class ReplyCache:
+    """Base class: TTL'd replies by key, with hit/miss counters"""
+    
+    def __init__(self, ttl_seconds=None, max_entries=None):
+        self.ttl_seconds = ttl_seconds or config.REPLY_CACHE_TTL_SECONDS
+        self.max_entries = max_entries or config.REPLY_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+    
+    def lookup(self, key):
+        """Cached reply for key, or None; updates the counters"""
+        try:
+            reply = self.get(key)
+        except Exception as e:
+            log.warning("Failed to read reply cache", error=str(e))
+            reply = None
+        if reply is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return reply
+    
+    def store(self, key, reply):
+        try:
+            self.put(key, reply)
+        except Exception as e:
+            log.warning("Failed to write reply cache", error=str(e))
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / total, 3) if total else 0}
+    
+    def get(self, key):
+        raise NotImplementedError
+    
+    def put(self, key, reply):
+        raise NotImplementedError
+    
+    def _expires_at(self):
+        return int(time.time() + self.ttl_seconds)
+
+class MemoryReplyCache(ReplyCache):
+    """In-process LRU; lives as long as the container or server process"""
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            reply, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return reply
+    
+    def put(self, key, reply):
+        with self._lock:
+            self._entries[key] = (reply, self._expires_at())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SQLiteReplyCache(ReplyCache):
+    """Reply cache in a local SQLite file (used by scripts/server.py)"""
+    
+    def __init__(self, db_path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.db_path = db_path or config.REPLY_CACHE_DB
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS replies ('
+                ' key TEXT PRIMARY KEY,'
+                ' reply TEXT NOT NULL,'
+                ' expires_at INTEGER NOT NULL,'
+                ' used_at REAL NOT NULL)'
+            )
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT reply, expires_at FROM replies WHERE key = ?', (key,)).fetchone()
+            if not row or row[1] < now:
+                return None
+            conn.execute('UPDATE replies SET used_at = ? WHERE key = ?', (now, key))
+        return row[0]
+    
+    def put(self, key, reply):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)', (key, reply, self._expires_at(), now))
+            # TTL and size eviction: drop expired rows, then least recently used ones
+            conn.execute('DELETE FROM replies WHERE expires_at < ?', (now,))
+            conn.execute(
+                'DELETE FROM replies WHERE key NOT IN ('
+                ' SELECT key FROM replies ORDER BY used_at DESC LIMIT ?)',
+                (self.max_entries,)
+            )
+
+class DynamoDBReplyCache(ReplyCache):
+    """
+    Reply cache in the bot's DynamoDB table (used by the Lambda). Items are
+    stored as reply_<hash> with an expires_at TTL attribute; DynamoDB TTL
+    does the eviction, so max_entries does not apply.
+    """
+    
+    def __init__(self, table, **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+    
+    def _key(self, key):
+        return {'token_id': f'reply_{key}'}
+    
+    def get(self, key):
+        item = self.table.get_item(Key=self._key(key)).get('Item')
+        # DynamoDB TTL deletes lazily, so check expiry ourselves as well
+        if not item or int(item.get('expires_at', 0)) < time.time():
+            return None
+        return item['reply']
+    
+    def put(self, key, reply):
+        self.table.put_item(Item={**self._key(key), 'reply': reply, 'expires_at': self._expires_at()})
+
+def create_reply_cache(default_backend, table=None):
+    """Reply cache for REPLY_CACHE_BACKEND ('memory', 'sqlite', 'dynamodb' or 'none'), else default_backend"""
+    backend = config.REPLY_CACHE_BACKEND or default_backend
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return MemoryReplyCache()
+    if backend == 'sqlite':
+        return SQLiteReplyCache()
+    if backend == 'dynamodb':
+        return DynamoDBReplyCache(table)
+    raise Exception(f"Unknown reply cache backend: {backend}")
@@ -0,0 +1,265 @@
+"""
+Draft replies for existing unreplied inbox messages, in bulk.
+
+Enumerates inbox messages received in a date range (plus an optional
+OData filter), a page at a time, and skips those whose conversation
+already has a later message: a sent reply or draft, or a newer email
+that will be answered instead. The rest go through EmailProcessor in
+batches on a bounded worker pool. Gemini calls wait on the LLM service's
+rate limiter and Graph calls are batched. --workers bounds the
+concurrency; Graph allows 4 concurrent requests per mailbox.
+
+Every finished message is appended to a checkpoint file. A rerun with
+the same checkpoint skips the messages recorded there, so an interrupted
+run resumes where it stopped; failed messages are retried. Messages are
+claimed in the same idempotency store as scripts/server.py, so the two
+never draft the same message twice.
+
+Usage: python scripts/backfill.py [--since 2024-05-01] [--until 2024-06-01] [--filter "importance eq 'high'"]
+                                  [--workers 4] [--batch-size 5] [--checkpoint backfill_checkpoint.jsonl]
+                                  [--restart] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from conversation_cache import SQLiteConversationCache
+from email_processor import email_processor
+from graph_client import graph_client
+from idempotency import Idempotency, SQLiteIdempotencyStore
+from llm_service import llm_service
+from metrics import create_metrics_sink, metrics
+from reply_cache import create_reply_cache
+
+# Outcomes that are final; anything else (failed) is retried by the next run
+DONE_STATUSES = {'drafted', 'skipped', 'duplicate', 'replied', 'superseded'}
+
+class Checkpoint:
+    """Outcome per message ID, appended to a JSON-lines file as messages finish"""
+    
+    def __init__(self, path, restart=False, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.done = set()
+        self._lock = threading.Lock()
+        if restart and not read_only and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry['status'] in DONE_STATUSES:
+                        self.done.add(entry['message_id'])
+                    else:
+                        self.done.discard(entry['message_id'])
+    
+    def record(self, message_id, status, error=None):
+        entry = {'message_id': message_id, 'status': status, 'at': time.time()}
+        if error:
+            entry['error'] = str(error)
+        with self._lock:
+            if status in DONE_STATUSES:
+                self.done.add(message_id)
+            if self.read_only:
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+class Progress:
+    """Counts outcomes and prints throughput and an ETA"""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total = None
+        self.counts = Counter()
+        self._lock = threading.Lock()
+    
+    def add(self, status, count=1):
+        with self._lock:
+            self.counts[status] += count
+    
+    def report(self):
+        with self._lock:
+            handled = sum(self.counts.values())
+            processed = sum(count for status, count in self.counts.items() if status != 'resumed')
+            elapsed = time.monotonic() - self.started
+            rate = processed / elapsed if elapsed else 0.0
+            line = f"{handled}" + (f"/{self.total}" if self.total is not None else '') + " messages"
+            line += f", {rate:.2f}/s"
+            if self.total is not None and rate > 0:
+                remaining = max(0, self.total - handled)
+                line += f", ETA {timedelta(seconds=round(remaining / rate))}"
+            details = ', '.join(f"{status} {count}" for status, count in sorted(self.counts.items()) if count)
+            print(f"[{timedelta(seconds=round(elapsed))}] {line} ({details})", flush=True)
+
+def iso_datetime(value):
+    """'2024-05-01' or a full ISO timestamp -> the UTC form Graph filters take"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def build_filter(args):
+    # receivedDateTime leads the filter because the listing is ordered by it
+    clauses = [f"receivedDateTime ge {iso_datetime(args.since)}"]
+    if args.until:
+        clauses.append(f"receivedDateTime lt {iso_datetime(args.until)}")
+    if args.filter:
+        clauses.append(f"({args.filter})")
+    return ' and '.join(clauses)
+
+def _own_message(message):
+    address = ((message.get('from') or {}).get('emailAddress') or {}).get('address') or ''
+    return message.get('isDraft') or (config.USER_EMAIL and address.lower() == config.USER_EMAIL.lower())
+
+def unreplied(messages, checkpoint, progress):
+    """
+    The messages of one page whose conversation has nothing newer: no sent reply
+    or draft, and no later email (which gets the reply instead). The rest are
+    recorded in the checkpoint.
+    """
+    latest = {}
+    for message in messages:
+        conversation_id = message['conversationId']
+        if conversation_id in latest:
+            # Oldest first: the earlier message in this page is superseded
+            checkpoint.record(latest[conversation_id]['id'], 'superseded')
+            progress.add('superseded')
+        latest[conversation_id] = message
+    
+    threads = graph_client.get_conversation_threads_batch(
+        list(latest), select='id,isDraft,from,receivedDateTime',
+        since={conversation_id: message['receivedDateTime'] for conversation_id, message in latest.items()}
+    )
+    pending = []
+    for conversation_id, message in latest.items():
+        later = threads.get(conversation_id)
+        if isinstance(later, Exception) or not later:
+            # If the check failed, let processing find out
+            pending.append(message)
+            continue
+        status = 'replied' if any(_own_message(reply) for reply in later) else 'superseded'
+        checkpoint.record(message['id'], status)
+        progress.add(status)
+    return pending
+
+def candidates(args, checkpoint, progress):
+    """Pages of unreplied messages in the range that the checkpoint does not have yet"""
+    pages = graph_client.iter_inbox_messages(build_filter(args), page_size=args.page_size)
+    for messages, total in pages:
+        progress.total = total
+        fresh = [message for message in messages if message['id'] not in checkpoint.done]
+        progress.add('resumed', len(messages) - len(fresh))
+        if fresh:
+            yield unreplied(fresh, checkpoint, progress)
+
+def status_of(result):
+    if not result['success']:
+        return 'failed'
+    if result.get('duplicate'):
+        return 'duplicate'
+    if result.get('skipped'):
+        return 'skipped'
+    return 'drafted'
+
+def process_chunk(message_ids, idempotency, checkpoint, progress):
+    claimed = idempotency.claim(message_ids)
+    for message_id in message_ids:
+        if message_id not in claimed:
+            checkpoint.record(message_id, 'duplicate')
+            progress.add('duplicate')
+    if not claimed:
+        return
+    
+    try:
+        results = email_processor.process_emails(claimed)
+    except Exception as e:
+        results = [{'success': False, 'message_id': message_id, 'error': str(e)} for message_id in claimed]
+    finally:
+        metrics.flush()
+    
+    failed = []
+    for result in results:
+        status = status_of(result)
+        if status == 'failed':
+            failed.append(result['message_id'])
+        checkpoint.record(result['message_id'], status, result.get('error'))
+        progress.add(status)
+    # Let the next run (or the server) pick failed messages up again
+    if failed:
+        idempotency.release(failed)
+    progress.report()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    default_since = (datetime.now(timezone.utc) - timedelta(days=7)).strftime('%Y-%m-%d')
+    parser.add_argument('--since', default=default_since, help='received on or after (ISO date or timestamp)')
+    parser.add_argument('--until', help='received before (ISO date or timestamp)')
+    parser.add_argument('--filter', help='extra OData filter on inbox messages')
+    parser.add_argument('--workers', type=int, default=4, help='batches processed at the same time')
+    parser.add_argument('--batch-size', type=int, default=config.PROCESS_CONCURRENCY, help='messages per batch')
+    parser.add_argument('--page-size', type=int, default=50, help='messages listed per Graph page')
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.jsonl', help='progress file to resume from')
+    parser.add_argument('--restart', action='store_true', help='discard the checkpoint and start over')
+    parser.add_argument('--dry-run', action='store_true', help='list the messages that would be processed')
+    args = parser.parse_args()
+    
+    # Same local wiring as scripts/server.py
+    idempotency = Idempotency(SQLiteIdempotencyStore())
+    email_processor.idempotency = idempotency
+    email_processor.conversation_cache = SQLiteConversationCache()
+    llm_service.reply_cache = create_reply_cache('sqlite')
+    metrics.sink = create_metrics_sink('file')
+    
+    checkpoint = Checkpoint(args.checkpoint, restart=args.restart, read_only=args.dry_run)
+    progress = Progress()
+    print(f"Backfilling inbox messages where {build_filter(args)}"
+          + (f" ({len(checkpoint.done)} already done)" if checkpoint.done else ''))
+    
+    if args.dry_run:
+        for page in candidates(args, checkpoint, progress):
+            for message in page:
+                print(f"{message['receivedDateTime']}  {message['id']}  {message.get('subject')}")
+        progress.report()
+        return
+    
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    in_flight = set()
+    try:
+        for page in candidates(args, checkpoint, progress):
+            message_ids = [message['id'] for message in page]
+            for start in range(0, len(message_ids), args.batch_size):
+                # Keep the listing only a little ahead of the workers
+                while len(in_flight) >= args.workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                in_flight.add(executor.submit(
+                    process_chunk, message_ids[start:start + args.batch_size], idempotency, checkpoint, progress
+                ))
+        for future in wait(in_flight).done:
+            future.result()
+    except KeyboardInterrupt:
+        print(f"\nInterrupted; finishing the batches in progress. Rerun to resume from {args.checkpoint}")
+        executor.shutdown(wait=True, cancel_futures=True)
+        progress.report()
+        sys.exit(130)
+    executor.shutdown()
+    
+    progress.report()
+    print(f"Rate limiter: {llm_service.rate_limiter.stats()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Create the certificate and private key for rich (encrypted) notifications.
+
+Writes a self-signed certificate and its RSA private key as PEM files
+(NOTIFICATION_CERTIFICATE_FILE and NOTIFICATION_PRIVATE_KEY_FILE) and
+checks that a notification encrypted the way Graph does it decrypts with
+them. Graph only uses the certificate's public key, so self-signed is
+fine. For the Lambda, put the two PEMs in the NOTIFICATION_CERTIFICATE
+and NOTIFICATION_PRIVATE_KEY environment variables, set
+RICH_NOTIFICATIONS=true and recreate the subscription.
+
+When rotating, give the new pair a new NOTIFICATION_CERTIFICATE_ID:
+notifications for the old ID are then fetched with get_message until the
+subscription has been recreated with the new certificate.
+
+Usage: python scripts/create_notification_cert.py [--days 365] [--force]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Add parent directory to path to import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+import config
+from notification_crypto import NotificationKeys
+
+def create_pair(days):
+    """(certificate PEM, private key PEM) of a new self-signed RSA certificate"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, config.NOTIFICATION_CERTIFICATE_ID)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .sign(key, hashes.SHA256())
+    )
+    return (
+        certificate.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                          serialization.NoEncryption())
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--days', type=int, default=365, help='certificate validity')
+    parser.add_argument('--force', action='store_true', help='overwrite existing files')
+    args = parser.parse_args()
+    
+    paths = [config.NOTIFICATION_CERTIFICATE_FILE, config.NOTIFICATION_PRIVATE_KEY_FILE]
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing and not args.force:
+        print(f"✗ {', '.join(existing)} already exists (use --force to replace)")
+        sys.exit(1)
+    
+    certificate_pem, private_key_pem = create_pair(args.days)
+    
+    # Round trip a notification before writing anything
+    keys = NotificationKeys(certificate_pem, private_key_pem)
+    sample = {'id': 'sample', 'subject': 'Round trip'}
+    if keys.decrypt(keys.encrypt(sample)) != sample:
+        print("✗ Encrypted sample did not decrypt")
+        sys.exit(1)
+    
+    with open(config.NOTIFICATION_CERTIFICATE_FILE, 'wb') as f:
+        f.write(certificate_pem)
+    with open(config.NOTIFICATION_PRIVATE_KEY_FILE, 'wb') as f:
+        f.write(private_key_pem)
+    os.chmod(config.NOTIFICATION_PRIVATE_KEY_FILE, 0o600)
+    
+    print(f"✓ Certificate written to {config.NOTIFICATION_CERTIFICATE_FILE}")
+    print(f"✓ Private key written to {config.NOTIFICATION_PRIVATE_KEY_FILE} (keep it out of git)")
+    print(f"  Certificate ID: {config.NOTIFICATION_CERTIFICATE_ID}, valid for {args.days} days")
+
+if __name__ == '__main__':
+    main()
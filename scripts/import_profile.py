@@ -0,0 +1,97 @@
+"""
+Cold-start import profile.
+
+Imports a module in a fresh interpreter under `python -X importtime`, sums
+the cost per top-level package and prints the most expensive ones. With
+--validation it also times a webhook validation request end to end in
+that cold interpreter (import plus lambda_handler), which is what Graph
+waits for when it creates a subscription.
+
+Usage: python scripts/import_profile.py [--module lambda_function] [--top 15] [--validation]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VALIDATION_SNIPPET = '''
+import json, time
+started = time.perf_counter()
+import {module}
+response = {module}.lambda_handler({{'queryStringParameters': {{'validationToken': 'profile'}}}}, None)
+print(json.dumps({{'ms': (time.perf_counter() - started) * 1000, 'status': response['statusCode']}}))
+'''
+
+def run_cold(code):
+    """Run code in a fresh interpreter with -X importtime; return (stdout, stderr)"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"Profiled import failed:\n{result.stderr[-2000:]}")
+    return result.stdout, result.stderr
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+def by_package(rows):
+    """Self time summed per top-level package, in milliseconds"""
+    totals = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        totals[name.split('.')[0]] += self_us
+    return {package: us / 1000 for package, us in totals.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--module', default='lambda_function', help='module to import cold')
+    parser.add_argument('--top', type=int, default=15, help='packages to show')
+    parser.add_argument('--validation', action='store_true',
+                        help='also time a webhook validation request (module must define lambda_handler)')
+    args = parser.parse_args()
+    
+    _, stderr = run_cold(f'import {args.module}')
+    rows = parse_importtime(stderr)
+    total_ms = sum(self_us for _, self_us, _, _ in rows) / 1000
+    target = [row for row in rows if row[0] == args.module]
+    
+    print(f"Cold import of {args.module}: {target[0][2] / 1000 if target else total_ms:.1f} ms "
+          f"({len(rows)} modules, {total_ms:.1f} ms including interpreter startup)\n")
+    print(f"{'package':<32}{'self ms':>10}{'share':>8}")
+    packages = sorted(by_package(rows).items(), key=lambda item: item[1], reverse=True)
+    for package, ms in packages[:args.top]:
+        print(f"{package:<32}{ms:>10.1f}{ms / total_ms:>8.0%}")
+    
+    # Direct imports of the profiled module, which is where lazy loading pays off
+    # (-X importtime lists a module's imports before the module itself)
+    if target:
+        index = rows.index(target[0])
+        children = []
+        for name, _, cumulative_us, depth in reversed(rows[:index]):
+            if depth <= target[0][3]:
+                break
+            if depth == target[0][3] + 1:
+                children.append((name, cumulative_us / 1000))
+        print(f"\n{'imported by ' + args.module:<32}{'cum ms':>10}")
+        for name, ms in sorted(children, key=lambda item: item[1], reverse=True):
+            print(f"{name:<32}{ms:>10.1f}")
+    
+    if args.validation:
+        stdout, _ = run_cold(VALIDATION_SNIPPET.format(module=args.module))
+        timing = json.loads(stdout.strip().splitlines()[-1])
+        print(f"\nValidation request from a cold interpreter: {timing['ms']:.1f} ms (status {timing['status']})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Score the local intent classifier against a labelled corpus.
+
+Each line of the corpus is a JSON object with subject, body and intent
+(use "other" for messages that should go to the LLM). Prints per-intent
+precision and recall at the configured thresholds, how much of the corpus
+the fast path would handle, and classification latency.
+
+Usage: python scripts/score_intents.py [--corpus benchmarks/fixtures/intents.jsonl] [--repeat 50] [--verbose]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from intent_classifier import intent_classifier
+
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--corpus', default=os.path.join(ROOT, 'benchmarks', 'fixtures', 'intents.jsonl'))
+    parser.add_argument('--repeat', type=int, default=50, help='classifications per message for timing')
+    parser.add_argument('--verbose', action='store_true', help='print every misclassified message')
+    args = parser.parse_args()
+    
+    corpus = load_corpus(args.corpus)
+    true_positives, predicted, actual = Counter(), Counter(), Counter()
+    latencies_us = []
+    mistakes = []
+    
+    for example in corpus:
+        label = example.get('intent') or 'other'
+        intent, confidence = intent_classifier.classify(example['subject'], example['body'])
+        intent = intent or 'other'
+        
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            intent_classifier.classify(example['subject'], example['body'])
+        latencies_us.append((time.perf_counter() - started) / args.repeat * 1e6)
+        
+        actual[label] += 1
+        predicted[intent] += 1
+        if intent == label:
+            true_positives[label] += 1
+        else:
+            mistakes.append((label, intent, confidence, example['subject']))
+    
+    print(f"{len(corpus)} messages from {args.corpus}\n")
+    print(f"{'intent':<18}{'threshold':>10}{'support':>9}{'precision':>11}{'recall':>8}")
+    for intent in intent_classifier.thresholds:
+        precision = true_positives[intent] / predicted[intent] if predicted[intent] else 0
+        recall = true_positives[intent] / actual[intent] if actual[intent] else 0
+        print(f"{intent:<18}{intent_classifier.thresholds[intent]:>10.2f}{actual[intent]:>9}"
+              f"{precision:>11.0%}{recall:>8.0%}")
+    
+    handled = len(corpus) - predicted['other']
+    wrong = sum(1 for label, intent, _, _ in mistakes if intent != 'other')
+    print(f"\nFast path: {handled}/{len(corpus)} messages ({handled / len(corpus):.0%}) handled without the LLM, "
+          f"{wrong} of them with the wrong intent")
+    print(f"Latency per message: p50 {percentile(latencies_us, 0.5):.0f} us, "
+          f"p95 {percentile(latencies_us, 0.95):.0f} us, max {max(latencies_us):.0f} us")
+    
+    if args.verbose and mistakes:
+        print("\nMisclassified:")
+        for label, intent, confidence, subject in mistakes:
+            print(f"  expected {label:<15} got {intent:<15} ({confidence:.2f})  {subject}")
+
+if __name__ == '__main__':
+    main()
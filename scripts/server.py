@@ -6,10 +6,66 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from flask import Flask, request, jsonify, redirect
 from auth_provider import auth_provider
 from email_processor import email_processor
+from conversation_cache import SQLiteConversationCache
+from work_queue import WorkQueue, WorkerPool
+from idempotency import Idempotency, SQLiteIdempotencyStore
+from llm_service import llm_service
+from reply_cache import create_reply_cache
+from metrics import create_metrics_sink, metrics
+from delta_sync import DeltaSync, create_delta_link_store
+from subscription_manager import SubscriptionManager, create_subscription_store
+from structured_log import record_log_volume
 import config
 
 app = Flask(__name__)
 
+# Cache cleaned thread history locally so replies only fetch new messages
+email_processor.conversation_cache = SQLiteConversationCache()
+
+# Repeated inquiries are answered from locally cached replies
+llm_service.reply_cache = create_reply_cache('sqlite')
+
+# Graph redelivers notifications; drop the ones already queued
+idempotency = Idempotency(SQLiteIdempotencyStore())
+email_processor.idempotency = idempotency
+
+# Notifications are persisted here and processed by worker threads,
+# so the webhook can answer Graph immediately
+work_queue = WorkQueue()
+
+# Per-stage metrics go to a local file (METRICS_FILE), one EMF document per batch
+metrics.sink = create_metrics_sink('file')
+
+def process_batch(message_ids):
+    try:
+        return email_processor.process_emails(message_ids)
+    finally:
+        # Workers share the metrics buffer: no other worker may flush between the two
+        with metrics.flushing():
+            record_log_volume()
+            metrics.flush()
+
+worker_pool = WorkerPool(work_queue, process_batch)
+
+def sync_inbox():
+    """Queue inbox messages that arrived since the last sync without a notification"""
+    from graph_client import graph_client
+    
+    queued = []
+    
+    def enqueue(message_ids):
+        new_ids = idempotency.claim(message_ids)
+        work_queue.enqueue(new_ids)
+        queued.extend(new_ids)
+    
+    stats = DeltaSync(graph_client, create_delta_link_store('file')).run(enqueue)
+    return {**stats, 'queued': len(queued)}
+
+def get_subscription_manager():
+    """The subscription scripts/setup_webhook.py created, tracked in subscription.json"""
+    from graph_client import graph_client
+    return SubscriptionManager(graph_client, create_subscription_store('file'), f"{config.WEBHOOK_URL}/webhook")
+
 # Store validation tokens for webhook verification
 validation_tokens = {}
 
@@ -99,6 +155,7 @@ def webhook():
             
             # Verify client state
             if data.get('value'):
+                message_ids = []
                 for notification in data['value']:
                     client_state = notification.get('clientState')
                     
@@ -107,20 +164,25 @@ def webhook():
                         print(f"Invalid client state: {client_state}")
                         continue
                     
+                    # Subscription lifecycle events: renew, recreate or catch up
+                    if notification.get('lifecycleEvent'):
+                        if get_subscription_manager().handle_lifecycle(notification) == 'missed':
+                            print(f"Missed notifications, syncing inbox: {sync_inbox()}")
+                        continue
+                    
                     # Get the resource data
                     resource_data = notification.get('resourceData', {})
                     message_id = resource_data.get('id')
                     
                     if message_id:
                         print(f"New email notification received: {message_id}")
-                        
-                        # Process the email asynchronously (in production, use a queue)
-                        result = email_processor.process_email(message_id)
-                        
-                        if result['success']:
-                            print(f"✓ Successfully processed email and created draft")
-                        else:
-                            print(f"✗ Failed to process email: {result.get('error')}")
+                        message_ids.append(message_id)
+                
+                # Workers pick these up in batches, so Graph calls are still batched
+                new_ids = idempotency.claim(message_ids)
+                if len(new_ids) < len(message_ids):
+                    print(f"Ignoring {len(message_ids) - len(new_ids)} duplicate notifications")
+                work_queue.enqueue(new_ids)
             
             # Always return 202 Accepted to acknowledge receipt
             return '', 202
@@ -135,7 +197,7 @@ def webhook():
 @app.route('/test/process/<message_id>')
 def test_process(message_id):
     """Test endpoint to manually process an email"""
-    result = email_processor.process_email(message_id)
+    result = process_batch([message_id])[0]
     return jsonify(result)
 
 @app.route('/test/latest')
@@ -152,15 +214,27 @@ def test_latest():
     print(f"Processing latest email: {message['subject']} ({message['id']})")
     
     # Process it
-    result = email_processor.process_email(message['id'])
+    result = process_batch([message['id']])[0]
     return jsonify(result)
 
+@app.route('/test/sync')
+def test_sync():
+    """Queue inbox messages that arrived since the last sync without a notification"""
+    return jsonify(sync_inbox())
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
+    from graph_client import graph_client
+    
     return jsonify({
         'status': 'healthy',
-        'authenticated': auth_provider.is_authenticated()
+        'authenticated': auth_provider.is_authenticated(),
+        'graph_connections': graph_client.connection_stats.snapshot(),
+        'queue': work_queue.stats(),
+        'reply_cache': llm_service.reply_cache.stats() if llm_service.reply_cache else None,
+        'rate_limiter': llm_service.rate_limiter.stats(),
+        'llm_providers': llm_service.router.stats()
     })
 
 if __name__ == '__main__':
@@ -173,4 +247,8 @@ if __name__ == '__main__':
     else:
         print("\n✓ Authenticated and ready!")
     
+    # debug=True re-runs this file in a reloader child process, which is the one serving requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        worker_pool.start()
+    
     app.run(host='0.0.0.0', port=config.PORT, debug=True)
@@ -3,7 +3,6 @@ Setup script to register webhook subscription with Microsoft Graph API
 Run this after authenticating to start receiving email notifications
 """
 
-from datetime import datetime, timedelta
 import sys
 import os
 # Add parent directory to path to import modules
@@ -16,9 +15,8 @@ import json
 def setup_subscription():
     """Create a webhook subscription for new emails"""
     
-    # Subscription expires in 3 days (max for personal accounts)
-    expiration = datetime.utcnow() + timedelta(days=3)
-    expiration_str = expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+    # Subscription expires in 3 days (max for personal accounts; under a day with RICH_NOTIFICATIONS)
+    expiration_str = graph_client.subscription_expiration(days=3)
     
     notification_url = f"{config.WEBHOOK_URL}/webhook"
     
@@ -29,7 +27,9 @@ def setup_subscription():
     try:
         subscription = graph_client.subscribe_to_inbox(
             notification_url=notification_url,
-            expiration_datetime=expiration_str
+            expiration_datetime=expiration_str,
+            # reauthorizationRequired / subscriptionRemoved / missed events go to the same webhook
+            lifecycle_notification_url=notification_url
         )
         
         print("\n✓ Subscription created successfully!")
@@ -38,11 +38,11 @@ def setup_subscription():
         print(f"Change Type: {subscription['changeType']}")
         print(f"Expires: {subscription['expirationDateTime']}")
         
-        # Save subscription info
-        with open('subscription.json', 'w') as f:
+        # Save subscription info (the server's lifecycle handling keeps it up to date)
+        with open(config.SUBSCRIPTION_STATE_FILE, 'w') as f:
             json.dump(subscription, f, indent=2)
         
-        print("\nSubscription details saved to subscription.json")
+        print(f"\nSubscription details saved to {config.SUBSCRIPTION_STATE_FILE}")
         print("\n⚠ Remember to renew the subscription before it expires!")
         
         return subscription
@@ -58,8 +58,7 @@ def setup_subscription():
 def renew_subscription(subscription_id):
     """Renew an existing subscription"""
     
-    expiration = datetime.utcnow() + timedelta(days=3)
-    expiration_str = expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+    expiration_str = graph_client.subscription_expiration(days=3)
     
     print(f"Renewing subscription: {subscription_id}")
     
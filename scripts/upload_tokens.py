@@ -35,6 +35,8 @@ def upload_tokens():
             'access_token': tokens.get('access_token'),
             'refresh_token': tokens.get('refresh_token'),
             'expires_in': tokens.get('expires_in'),
+            # Not expires_at: that is the table's TTL attribute (tokens.json files from before used it)
+            'access_token_expires_at': tokens.get('access_token_expires_at') or tokens.get('expires_at'),
             'id_token': tokens.get('id_token'),
             'scope': tokens.get('scope')
         }
@@ -0,0 +1,141 @@
+"""
+Structured JSON logging with sampling, size caps and redaction.
+
+Every line is one JSON object: timestamp, level, logger, message and
+whatever fields the caller passes. Before it is written:
+
+- lines below LOG_LEVEL are dropped, and the rest are sampled per level
+  (LOG_SAMPLE_RATES; sampled lines carry their sample_rate)
+- fields that hold message content (bodies, prompts, replies, raw
+  events) are replaced by their length, and email addresses anywhere
+  are masked to their first letter and domain
+- long values are truncated with a marker, and the whole line is capped
+
+Full prompts are only logged with capture(), for the fraction of
+messages LOG_CAPTURE_PROMPTS_RATE selects. Bytes written are counted in
+the log.bytes metric.
+"""
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+import config
+from metrics import metrics
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+# Fields that carry customer content; only their size is logged
+CONTENT_FIELDS = {'body', 'content', 'prompt', 'reply', 'html', 'event', 'thread_history'}
+
+_EMAIL_RE = re.compile(r'([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9.-]+\.[A-Za-z]{2,})')
+_write_lock = threading.Lock()
+
+def mask_emails(text):
+    """emily@carterbeauty.com -> e***@carterbeauty.com"""
+    return _EMAIL_RE.sub(r'\1***@\2', text)
+
+def truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}...[truncated {len(text) - max_chars} chars]"
+
+def _clean(name, value, max_chars):
+    """Redact and cap one field value, keeping numbers and flags as they are"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if name in CONTENT_FIELDS:
+        size = len(value) if isinstance(value, (str, list, dict)) else None
+        return f"[redacted: {size} {'chars' if isinstance(value, str) else 'items'}]"
+    if isinstance(value, dict):
+        return {key: _clean(key, item, max_chars) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clean(name, item, max_chars) for item in value[:20]]
+    return truncate(mask_emails(str(value)), max_chars)
+
+class StructuredLogger:
+    """JSON-lines logger for one module"""
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def debug(self, message, **fields):
+        self._log('debug', message, fields)
+    
+    def info(self, message, **fields):
+        self._log('info', message, fields)
+    
+    def warning(self, message, **fields):
+        self._log('warning', message, fields)
+    
+    def error(self, message, **fields):
+        self._log('error', message, fields)
+    
+    def should_capture(self, key):
+        """
+        Whether to log full content for key (e.g. a prompt). The choice is a hash
+        of the key, so retries of the same message are captured consistently.
+        """
+        rate = config.LOG_CAPTURE_PROMPTS_RATE
+        if rate <= 0:
+            return False
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < rate
+    
+    def capture(self, message, **fields):
+        """Log fields unredacted (up to LOG_CAPTURE_MAX_CHARS each); check should_capture first"""
+        record = self._record('debug', message)
+        record.update({name: truncate(str(value), config.LOG_CAPTURE_MAX_CHARS) for name, value in fields.items()})
+        record['captured'] = True
+        self._write(record)
+    
+    def _log(self, level, message, fields):
+        if LEVELS[level] < LEVELS.get(config.LOG_LEVEL, 20):
+            return
+        sample_rate = config.LOG_SAMPLE_RATES.get(level, 1.0)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return
+        
+        record = self._record(level, mask_emails(message))
+        for name, value in fields.items():
+            record[name] = _clean(name, value, config.LOG_MAX_FIELD_CHARS)
+        if sample_rate < 1.0:
+            record['sample_rate'] = sample_rate
+        self._write(record)
+    
+    def _record(self, level, message):
+        return {
+            'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'level': level,
+            'logger': self.name,
+            'message': message,
+        }
+    
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        if len(line) > config.LOG_MAX_LINE_CHARS:
+            # Fall back to the message alone rather than cutting the JSON in half
+            line = json.dumps({**self._record(record['level'], truncate(record['message'], 1000)),
+                               'truncated_line_chars': len(line)}, ensure_ascii=False)
+        data = line + '\n'
+        with _write_lock:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        metrics.add('log.bytes', len(data.encode('utf-8')), 'Bytes')
+
+_loggers = {}
+
+def get_logger(name):
+    """Shared StructuredLogger for a module name"""
+    if name not in _loggers:
+        _loggers[name] = StructuredLogger(name)
+    return _loggers[name]
+
+def record_log_volume():
+    """Add log.bytes_per_email (log bytes over emails processed since the last flush) to the metrics"""
+    emails = metrics.total('email.processed')
+    if emails:
+        metrics.record('log.bytes_per_email', round(metrics.total('log.bytes') / emails), 'Bytes')
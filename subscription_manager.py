@@ -0,0 +1,209 @@
+"""
+The inbox subscription, kept alive without listing subscriptions each run.
+
+The subscription's ID, expiry and settings are stored (DynamoDB for the
+Lambda, subscription.json locally), so a scheduled run only reads the
+store unless the subscription expires within the renewal window. Then
+it is renewed with one PATCH; only when Graph no longer knows it (404)
+or its settings changed are subscriptions listed, and a matching one is
+renewed or a new one created. Lifecycle notifications are handled here
+too: reauthorizationRequired renews, subscriptionRemoved recreates and
+missed is left to the caller's catch-up sync.
+"""
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+def expires_at(subscription):
+    """expirationDateTime ('2024-05-03T10:00:00.0000000Z') as epoch seconds"""
+    expiration = datetime.strptime(subscription['expirationDateTime'][:19], '%Y-%m-%dT%H:%M:%S')
+    return int(expiration.replace(tzinfo=timezone.utc).timestamp())
+
+def _state(subscription):
+    """The parts of a Graph subscription worth keeping"""
+    return {
+        'id': subscription['id'],
+        'expirationDateTime': subscription['expirationDateTime'],
+        'expires_at': expires_at(subscription),
+        'notificationUrl': subscription.get('notificationUrl'),
+        'lifecycleNotificationUrl': subscription.get('lifecycleNotificationUrl'),
+        'includeResourceData': bool(subscription.get('includeResourceData'))
+    }
+
+class SubscriptionStore:
+    """Where the current subscription's state is kept"""
+    
+    def load(self):
+        raise NotImplementedError
+    
+    def save(self, state):
+        raise NotImplementedError
+    
+    def clear(self):
+        raise NotImplementedError
+
+class MemorySubscriptionStore(SubscriptionStore):
+    """Subscription state for tests; lost with the process"""
+    
+    def __init__(self):
+        self.state = None
+    
+    def load(self):
+        return self.state
+    
+    def save(self, state):
+        self.state = state
+    
+    def clear(self):
+        self.state = None
+
+class FileSubscriptionStore(SubscriptionStore):
+    """Subscription state in a local JSON file (subscription.json, as scripts/setup_webhook.py writes it)"""
+    
+    def __init__(self, path=None):
+        self.path = path or config.SUBSCRIPTION_STATE_FILE
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            subscription = json.load(f)
+        return _state(subscription) if subscription.get('id') else None
+    
+    def save(self, state):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+    
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DynamoDBSubscriptionStore(SubscriptionStore):
+    """subscription_inbox item in the bot's DynamoDB table"""
+    
+    KEY = {'token_id': 'subscription_inbox'}
+    
+    def __init__(self, table):
+        self.table = table
+    
+    def load(self):
+        item = self.table.get_item(Key=self.KEY).get('Item')
+        if not item:
+            return None
+        state = {key: value for key, value in item.items() if key != 'token_id'}
+        state['expires_at'] = int(state['expires_at'])
+        return state
+    
+    def save(self, state):
+        # DynamoDB rejects None attribute values
+        self.table.put_item(Item={**self.KEY, **{key: value for key, value in state.items() if value is not None}})
+    
+    def clear(self):
+        self.table.delete_item(Key=self.KEY)
+
+def create_subscription_store(default_backend, table=None):
+    """Subscription store for SUBSCRIPTION_STATE_BACKEND ('memory', 'file' or 'dynamodb'), else default_backend"""
+    backend = config.SUBSCRIPTION_STATE_BACKEND or default_backend
+    if backend == 'memory':
+        return MemorySubscriptionStore()
+    if backend == 'file':
+        return FileSubscriptionStore()
+    if backend == 'dynamodb':
+        return DynamoDBSubscriptionStore(table)
+    raise Exception(f"Unknown subscription state backend: {backend}")
+
+def _not_found(error):
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 404
+
+class SubscriptionManager:
+    """Renews, recreates and reports on the inbox subscription for one notification URL"""
+    
+    def __init__(self, graph_client, store, notification_url, lifecycle_notification_url=None,
+                 lifetime_days=None, renewal_window_hours=None):
+        self.graph_client = graph_client
+        self.store = store
+        self.notification_url = notification_url
+        self.lifecycle_notification_url = (lifecycle_notification_url or config.LIFECYCLE_NOTIFICATION_URL
+                                           or notification_url)
+        self.lifetime_days = lifetime_days or config.SUBSCRIPTION_LIFETIME_DAYS
+        self.renewal_window_hours = renewal_window_hours or config.SUBSCRIPTION_RENEWAL_WINDOW_HOURS
+    
+    def _matches(self, subscription):
+        """Whether a subscription has the settings we would create it with (they cannot be changed by renewing)"""
+        from notification_crypto import load_notification_keys
+        # subscribe_to_inbox only asks for resource data when a certificate is configured
+        rich = bool(config.RICH_NOTIFICATIONS and load_notification_keys())
+        return (subscription.get('notificationUrl') == self.notification_url
+                and subscription.get('lifecycleNotificationUrl') == self.lifecycle_notification_url
+                and bool(subscription.get('includeResourceData')) == rich)
+    
+    def ensure(self, force=False):
+        """
+        Make sure the subscription exists and outlives the renewal window.
+        Returns (action, state), action being 'current', 'renewed' or 'created'
+        """
+        state = self.store.load()
+        if state and self._matches(state):
+            if not force and state['expires_at'] - time.time() > self.renewal_window_hours * 3600:
+                return 'current', state
+            try:
+                return 'renewed', self._renew(state['id'])
+            except Exception as e:
+                if not _not_found(e):
+                    raise
+                log.warning("Stored subscription no longer exists", subscription_id=state['id'])
+        return self._recover()
+    
+    def _renew(self, subscription_id):
+        expiration = self.graph_client.subscription_expiration(days=self.lifetime_days)
+        subscription = self.graph_client.renew_subscription(subscription_id, expiration)
+        # Only the expiry changes; keep the settings we already know
+        state = {**(self.store.load() or {}), 'id': subscription_id,
+                 'expirationDateTime': subscription['expirationDateTime'], 'expires_at': expires_at(subscription)}
+        self.store.save(state)
+        log.info("Subscription renewed", subscription_id=subscription_id, expires=state['expirationDateTime'])
+        return state
+    
+    def _recover(self):
+        """Renew a matching subscription Graph still has, replacing outdated ones, or create one"""
+        for subscription in self.graph_client.list_subscriptions():
+            if subscription.get('notificationUrl') != self.notification_url:
+                continue
+            if self._matches(subscription):
+                self.store.save(_state(subscription))
+                return 'renewed', self._renew(subscription['id'])
+            log.info("Replacing subscription with outdated settings", subscription_id=subscription['id'])
+            self.graph_client.delete_subscription(subscription['id'])
+        
+        subscription = self.graph_client.subscribe_to_inbox(
+            self.notification_url, self.graph_client.subscription_expiration(days=self.lifetime_days),
+            lifecycle_notification_url=self.lifecycle_notification_url
+        )
+        state = _state(subscription)
+        self.store.save(state)
+        log.info("Subscription created", subscription_id=state['id'], expires=state['expirationDateTime'])
+        return 'created', state
+    
+    def handle_lifecycle(self, notification):
+        """
+        React to one lifecycle notification. Returns the event, so the caller can
+        run a catch-up sync for 'missed'
+        """
+        event = notification.get('lifecycleEvent')
+        subscription_id = notification.get('subscriptionId')
+        log.info("Lifecycle notification", lifecycle_event=event, subscription_id=subscription_id)
+        if event == 'reauthorizationRequired':
+            # Renewing also reauthorizes the subscription
+            self.ensure(force=True)
+        elif event == 'subscriptionRemoved':
+            state = self.store.load()
+            if state and state['id'] == subscription_id:
+                self.store.clear()
+            self.ensure()
+        return event
@@ -0,0 +1,72 @@
+"""
+Deferred messages must outlive the container: the Lambda only defers to SQS,
+and without DEFERRAL_QUEUE_URL it releases the messages instead of queueing
+them in memory and invoking a drain that would find nothing.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import lambda_function
+from deferral import InMemoryDeferralQueue, SQSDeferralQueue
+
+class LambdaDeferralTest(unittest.TestCase):
+    
+    def setUp(self):
+        lambda_function.get_deferral_queue.cache_clear()
+        self.addCleanup(lambda_function.get_deferral_queue.cache_clear)
+    
+    def test_without_queue_url_nothing_is_deferred(self):
+        with mock.patch.object(config, 'DEFERRAL_QUEUE_URL', None), \
+                mock.patch.object(config, 'DEFERRAL_BACKEND', 'memory'), \
+                mock.patch.object(lambda_function, 'release_locks') as release_locks, \
+                mock.patch.object(lambda_function, 'trigger_drain') as trigger_drain:
+            self.assertIsNone(lambda_function.get_deferral_queue())
+            lambda_function.defer(['m1', 'm2'], context=object())
+        release_locks.assert_called_once_with(['m1', 'm2'])
+        trigger_drain.assert_not_called()
+    
+    def test_queue_url_defers_to_sqs(self):
+        with mock.patch.object(config, 'DEFERRAL_QUEUE_URL', 'https://sqs.example/queue'), \
+                mock.patch.object(config, 'DEFERRAL_SELF_INVOKE', True), \
+                mock.patch.object(SQSDeferralQueue, 'send') as send, \
+                mock.patch.object(lambda_function, 'release_locks'), \
+                mock.patch.object(lambda_function, 'trigger_drain') as trigger_drain:
+            self.assertIsInstance(lambda_function.get_deferral_queue(), SQSDeferralQueue)
+            lambda_function.defer(['m1'], context=object())
+        send.assert_called_once_with(['m1'])
+        trigger_drain.assert_called_once()
+
+class FakeContext:
+    invoked_function_arn = 'arn:aws:lambda:ap-northeast-2:000000000000:function:email-bot'
+    
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+    
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+class DrainDeferredTest(unittest.TestCase):
+    
+    def test_spent_budget_leaves_messages_visible(self):
+        queue = InMemoryDeferralQueue()
+        queue.send(['m1', 'm2'])
+        queue.receive = mock.Mock(wraps=queue.receive)
+        with mock.patch.object(lambda_function, 'get_deferral_queue', return_value=queue), \
+                mock.patch.object(config, 'DEFERRAL_SELF_INVOKE', True), \
+                mock.patch.object(lambda_function, 'log_llm_stats'), \
+                mock.patch.object(lambda_function, 'trigger_drain') as trigger_drain:
+            # Less than the safety margin left: not even one chunk fits
+            response = lambda_function.drain_deferred(FakeContext(remaining_ms=config.LAMBDA_SAFETY_MARGIN_MS))
+        self.assertEqual(response['body'], "Drained: 0")
+        # Nothing was received, so the triggered drain finds both messages
+        queue.receive.assert_not_called()
+        trigger_drain.assert_called_once()
+        self.assertEqual(len(queue.receive(10)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
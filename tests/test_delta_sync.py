@@ -0,0 +1,77 @@
+"""
+The deltaLink may only move past messages that were processed or durably
+deferred, and a sync triggers at most one drain however many pages it defers.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import lambda_function
+from delta_sync import DeltaSync, MemoryDeltaLinkStore
+
+class FakeGraphClient:
+    def __init__(self, pages):
+        self.pages = pages
+    
+    def iter_inbox_delta(self, delta_link, received_since=None, page_size=None):
+        for index, message_ids in enumerate(self.pages):
+            last = index == len(self.pages) - 1
+            yield [{'id': message_id} for message_id in message_ids], 'NEW_LINK' if last else None
+
+def delta_sync(pages):
+    store = MemoryDeltaLinkStore()
+    store.save('OLD_LINK')
+    return DeltaSync(FakeGraphClient(pages), store)
+
+class DeltaSyncTest(unittest.TestCase):
+    
+    def test_link_saved_when_every_page_is_kept(self):
+        sync = delta_sync([['m1'], ['m2']])
+        stats = sync.run(lambda message_ids: None)
+        self.assertTrue(stats['complete'])
+        self.assertEqual(sync.store.load(), 'NEW_LINK')
+    
+    def test_link_kept_when_a_page_is_not(self):
+        sync = delta_sync([['m1'], ['m2'], ['m3']])
+        seen = []
+        stats = sync.run(lambda message_ids: seen.extend(message_ids) or False)
+        self.assertFalse(stats['complete'])
+        self.assertEqual(seen, ['m1'])
+        self.assertEqual(sync.store.load(), 'OLD_LINK')
+
+class LambdaSyncInboxTest(unittest.TestCase):
+    
+    def run_sync(self, queue):
+        sync = delta_sync([['m1'], ['m2'], ['m3']])
+        patches = [
+            mock.patch.object(config, 'DEFERRAL_SELF_INVOKE', True),
+            mock.patch.object(lambda_function, 'get_delta_sync', return_value=sync),
+            mock.patch.object(lambda_function, 'get_deferral_queue', return_value=queue),
+            mock.patch.object(lambda_function, 'claim_messages', side_effect=lambda message_ids: message_ids),
+            mock.patch.object(lambda_function, 'release_locks'),
+            # No time left: every page is deferred
+            mock.patch.object(lambda_function.TimeBudget, 'can_start', return_value=False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        with mock.patch.object(lambda_function, 'trigger_drain') as trigger_drain:
+            lambda_function.sync_inbox(context=object())
+        return sync, trigger_drain
+    
+    def test_one_drain_per_sync(self):
+        sync, trigger_drain = self.run_sync(mock.Mock())
+        trigger_drain.assert_called_once()
+        self.assertEqual(sync.store.load(), 'NEW_LINK')
+    
+    def test_link_kept_without_durable_queue(self):
+        sync, trigger_drain = self.run_sync(None)
+        trigger_drain.assert_not_called()
+        self.assertEqual(sync.store.load(), 'OLD_LINK')
+
+if __name__ == '__main__':
+    unittest.main()
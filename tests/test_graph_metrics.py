@@ -0,0 +1,31 @@
+"""
+Each new Graph connection is recorded as graph.handshakes and graph.handshake_ms
+metrics where it opens, so they reach the EMF output of whichever worker flushes.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from urllib3.connection import HTTPSConnection
+
+from graph_client import _TimedHTTPSConnection, connection_stats
+from metrics import metrics
+
+class HandshakeMetricsTest(unittest.TestCase):
+    
+    def test_connect_records_handshake_metrics(self):
+        metrics.flush()
+        before = connection_stats.snapshot()['handshakes']
+        with mock.patch.object(HTTPSConnection, 'connect'):
+            _TimedHTTPSConnection('graph.microsoft.com').connect()
+            _TimedHTTPSConnection('graph.microsoft.com').connect()
+        self.assertEqual(metrics.total('graph.handshakes'), 2)
+        self.assertGreaterEqual(metrics.total('graph.handshake_ms'), 0)
+        self.assertEqual(connection_stats.snapshot()['handshakes'], before + 2)
+        metrics.flush()
+
+if __name__ == '__main__':
+    unittest.main()
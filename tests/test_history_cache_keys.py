@@ -0,0 +1,58 @@
+"""
+History entries and replies depend on HISTORY_ENTRY_MAX_CHARS, so changing it
+must not serve entries or replies cached under the old limit.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from conversation_cache import ConversationCache
+from email_processor import EmailProcessor
+from llm_service import LLMService
+
+class DictConversationCache(ConversationCache):
+    def __init__(self):
+        super().__init__()
+        self.items = {}
+    
+    def get(self, conversation_id):
+        return self.items.get(conversation_id)
+    
+    def put(self, conversation_id, entries, high_water):
+        self.items[conversation_id] = {'entries': entries, 'high_water': high_water}
+
+class RecordingReplyCache:
+    def __init__(self):
+        self.keys = []
+    
+    def lookup(self, key):
+        self.keys.append(key)
+        return None
+
+MESSAGE = {'id': 'm1', 'from': {'emailAddress': {'name': 'Kim'}}, 'receivedDateTime': '2024-05-01T10:00:00Z',
+           'body': {'contentType': 'text', 'content': 'x' * 100}}
+
+class HistoryCacheKeyTest(unittest.TestCase):
+    
+    def test_conversation_cache_is_per_entry_limit(self):
+        processor = EmailProcessor(conversation_cache=DictConversationCache())
+        with mock.patch.object(config, 'HISTORY_ENTRY_MAX_CHARS', 50):
+            processor._update_history('c1', None, [MESSAGE])
+            self.assertIsNotNone(processor._cached_history('c1'))
+        with mock.patch.object(config, 'HISTORY_ENTRY_MAX_CHARS', 80):
+            self.assertIsNone(processor._cached_history('c1'))
+    
+    def test_reply_cache_key_includes_entry_limit(self):
+        service = LLMService()
+        service.reply_cache = RecordingReplyCache()
+        for max_chars in (50, 80):
+            with mock.patch.object(config, 'HISTORY_ENTRY_MAX_CHARS', max_chars):
+                service._prepare('Subject', 'Body', 'kim@example.com', [], None, 'Kim')
+        self.assertNotEqual(*service.reply_cache.keys)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+"""
+The max_chars budget of html_to_text counts text, not the break placeholders
+and whitespace of empty blocks, which collapse away.
+"""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_text import html_to_text
+
+class HtmlToTextBudgetTest(unittest.TestCase):
+    
+    def test_empty_blocks_do_not_fill_the_budget(self):
+        markup = '<div></div>' * 3000 + '<p>' + 'hello world ' * 200 + '</p>'
+        text = html_to_text(markup, max_chars=1001)
+        self.assertEqual(len(text), 1001)
+        self.assertTrue(text.startswith('hello world'))
+        self.assertEqual(text, html_to_text(markup)[:1001])
+    
+    def test_outlook_spacer_markup(self):
+        spacer = '<table><tr><td>&nbsp;</td></tr></table><div><br></div>\n    ' * 2000
+        markup = f'<html><body>{spacer}<p>Where is my order?</p></body></html>'
+        self.assertEqual(html_to_text(markup, max_chars=500), 'Where is my order?')
+
+if __name__ == '__main__':
+    unittest.main()
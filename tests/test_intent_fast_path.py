@@ -0,0 +1,52 @@
+"""
+Templated replies answer in the customer's language, and mail that only
+reads like a newsletter is not skipped unless it was sent in bulk.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from email_processor import EmailProcessor
+
+def details(subject, body, sender='kim@example.com', bulk=False):
+    return {'subject': subject, 'body': body, 'sender': sender, 'sender_name': 'Kim', 'bulk': bulk}
+
+class FastPathTest(unittest.TestCase):
+    
+    def setUp(self):
+        patch = mock.patch.object(config, 'INTENT_FAST_PATH', True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.processor = EmailProcessor()
+    
+    def fast_path(self, message_details):
+        return self.processor._fast_path(message_details, message_details['body'], [])
+    
+    def test_korean_inquiry_gets_korean_template(self):
+        message = details('배송 문의', '안녕하세요. 지난주에 주문한 크림이 아직 도착하지 않았습니다. 언제 도착하나요?')
+        reply = self.fast_path(message)
+        self.assertEqual(message['intent'], 'shipping_delay')
+        self.assertIn('Kim님', reply)
+        self.assertIn('고객지원팀', reply)
+    
+    def test_english_inquiry_gets_english_template(self):
+        message = details('Where is my order?', "Where is my order? It still hasn't arrived.")
+        self.assertIn('Dear Kim', self.fast_path(message))
+    
+    def test_unsubscribe_request_from_customer_is_answered(self):
+        message = details('Please unsubscribe me', 'Please unsubscribe me from your newsletter, thank you.')
+        self.assertIsNone(self.fast_path(message))
+        self.assertNotIn('intent', message)
+    
+    def test_bulk_newsletter_is_skipped(self):
+        message = details('Spring sale', 'View this email in your browser. Unsubscribe | Manage preferences',
+                          sender='news@brand.example', bulk=True)
+        self.assertIsNone(self.fast_path(message))
+        self.assertEqual(message['intent'], 'newsletter')
+
+if __name__ == '__main__':
+    unittest.main()
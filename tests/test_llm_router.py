@@ -0,0 +1,91 @@
+"""
+Hedged and failed-over requests keep the caller's streaming mode, and each
+attempt is charged to the rate limiter of the provider it actually goes to.
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from llm_providers import LLMProvider, LLMRouter
+
+REPLY = "<p>Thanks, we are on it.</p><p>Best regards,</p><p>Support</p><p>P.S. more text</p>"
+
+class StubProvider(LLMProvider):
+    def __init__(self, name, delay=0.0, fail=False):
+        super().__init__(model=name)
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.streamed = []
+    
+    def complete(self, prompt, temperature, max_output_tokens, stream=False, cancel=None):
+        self.streamed.append(stream)
+        return super().complete(prompt, temperature, max_output_tokens, stream, cancel)
+    
+    def generate(self, prompt, temperature, max_output_tokens):
+        time.sleep(self.delay)
+        if self.fail:
+            raise Exception("503 unavailable")
+        return REPLY, 10
+    
+    def stream(self, prompt, temperature, max_output_tokens, usage):
+        time.sleep(self.delay)
+        yield REPLY
+
+class RecordingLimiter:
+    def __init__(self):
+        self.acquired = []
+        self.settled = []
+    
+    def acquire(self, tokens=0):
+        self.acquired.append(tokens)
+        return 0.0
+    
+    def settle(self, reserved_tokens, used_tokens):
+        self.settled.append((reserved_tokens, used_tokens))
+    
+    def throttled(self):
+        pass
+
+class LLMRouterTest(unittest.TestCase):
+    
+    def setUp(self):
+        patch = mock.patch.object(config, 'LLM_HEDGE_DEFAULT_DELAY_SECONDS', 0.01)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.limiter = RecordingLimiter()
+    
+    def limiter_for(self, name):
+        return self.limiter if name == 'gemini' else None
+    
+    def test_hedge_keeps_non_streaming_reply_whole(self):
+        gemini, openai = StubProvider('gemini', delay=0.2), StubProvider('openai')
+        router = LLMRouter([gemini, openai], hedging=True)
+        text, _, timing = router.complete('prompt', 0.7, 100, stream=False)
+        self.assertEqual(timing['provider'], 'openai')
+        self.assertEqual(text, REPLY)
+        self.assertEqual(gemini.streamed + openai.streamed, [False, False])
+    
+    def test_hedge_to_other_provider_skips_gemini_limiter(self):
+        gemini, openai = StubProvider('gemini', delay=0.2), StubProvider('openai')
+        router = LLMRouter([gemini, openai], hedging=True)
+        router.complete('prompt', 0.7, 100, first=gemini, limiter_for=self.limiter_for, reserved_tokens=500)
+        # Gemini's reservation was made by the caller; the OpenAI hedge takes none
+        self.assertEqual(self.limiter.acquired, [])
+    
+    def test_failover_to_gemini_acquires_its_limiter(self):
+        openai, gemini = StubProvider('openai', fail=True), StubProvider('gemini')
+        router = LLMRouter([openai, gemini], hedging=False)
+        text, _, timing = router.complete('prompt', 0.7, 100, first=openai, limiter_for=self.limiter_for,
+                                          reserved_tokens=500)
+        self.assertEqual(timing['provider'], 'gemini')
+        self.assertEqual(self.limiter.acquired, [500])
+        self.assertEqual(self.limiter.settled, [(500, 10)])
+
+if __name__ == '__main__':
+    unittest.main()
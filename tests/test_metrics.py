@@ -0,0 +1,56 @@
+"""
+Worker threads share one metrics buffer: concurrent records and flushes must
+write every value exactly once. The Lambda's payload size is the body's
+byte length, also when a direct invocation passes it already parsed.
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lambda_function import payload_bytes
+from metrics import Metrics
+
+class ListSink:
+    def __init__(self):
+        self.documents = []
+    
+    def write(self, document):
+        self.documents.append(document)
+
+class MetricsTest(unittest.TestCase):
+    
+    def test_concurrent_flushes_write_each_value_once(self):
+        sink = ListSink()
+        metrics = Metrics(sink=sink)
+        
+        def worker():
+            for _ in range(50):
+                for _ in range(10):
+                    metrics.increment('email.processed')
+                with metrics.flushing():
+                    metrics.flush()
+        
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.flush()
+        
+        written = 0
+        for document in sink.documents:
+            value = document['email.processed']
+            written += len(value) if isinstance(value, list) else 1
+        self.assertEqual(written, 8 * 50 * 10)
+    
+    def test_payload_bytes(self):
+        body = '{"value": "배송"}'
+        self.assertEqual(payload_bytes({'body': body}), len(body.encode('utf-8')))
+        self.assertEqual(payload_bytes({'body': {'value': [1, 2, 3]}}), len('{"value": [1, 2, 3]}'))
+        self.assertEqual(payload_bytes({}), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Rich notification content is only used when the payload's validationTokens
+are Microsoft-signed JWTs for our app; anything else falls back to get_message.
+"""
+import base64
+import json
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from notification_crypto import (GRAPH_NOTIFICATION_APP_ID, NotificationKeys, ValidationTokenVerifier,
+                                 notification_messages)
+from scripts.create_notification_cert import create_pair
+
+APP_ID = 'app-id'
+TENANT_ID = 'tenant-id'
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _int(value):
+    return _b64url(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+class Signer:
+    """Stands in for Microsoft identity: a signing key and its JWKS"""
+    
+    def __init__(self, kid='key-1'):
+        self.kid = kid
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    
+    def jwks(self):
+        numbers = self.key.public_key().public_numbers()
+        return [{'kty': 'RSA', 'kid': self.kid, 'n': _int(numbers.n), 'e': _int(numbers.e)}]
+    
+    def token(self, **overrides):
+        now = int(time.time())
+        claims = {'aud': APP_ID, 'azp': GRAPH_NOTIFICATION_APP_ID, 'iss': f'https://sts.windows.net/{TENANT_ID}/',
+                  'nbf': now - 60, 'exp': now + 3600, **overrides}
+        header = _b64url(json.dumps({'alg': 'RS256', 'kid': self.kid}).encode())
+        body = _b64url(json.dumps(claims).encode())
+        signature = self.key.sign(f'{header}.{body}'.encode(), padding.PKCS1v15(), hashes.SHA256())
+        return f'{header}.{body}.{_b64url(signature)}'
+
+class ValidationTokenTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = NotificationKeys(*create_pair(1))
+        cls.microsoft = Signer()
+    
+    def verifier(self):
+        return ValidationTokenVerifier(APP_ID, TENANT_ID, fetch_keys=self.microsoft.jwks)
+    
+    def payload(self, tokens):
+        message = {'id': 'm1', 'subject': 'Hello'}
+        notification = {'resourceData': {'id': 'm1'}, 'encryptedContent': self.keys.encrypt(message)}
+        return {'value': [notification], 'validationTokens': tokens}, [notification]
+    
+    def test_valid_token_is_accepted(self):
+        self.assertTrue(self.verifier().verify_all([self.microsoft.token()]))
+    
+    def test_bad_tokens_are_rejected(self):
+        verifier = self.verifier()
+        self.assertFalse(verifier.verify_all(None))
+        self.assertFalse(verifier.verify_all([Signer().token()]))
+        self.assertFalse(verifier.verify_all([Signer(kid='other').token()]))
+        self.assertFalse(verifier.verify_all([self.microsoft.token(aud='someone-else')]))
+        self.assertFalse(verifier.verify_all([self.microsoft.token(iss='https://sts.windows.net/other-tenant/')]))
+        self.assertFalse(verifier.verify_all([self.microsoft.token(azp='another-app')]))
+        self.assertFalse(verifier.verify_all([self.microsoft.token(exp=int(time.time()) - 3600)]))
+    
+    def test_content_used_only_with_valid_tokens(self):
+        payload, notifications = self.payload([self.microsoft.token()])
+        messages = notification_messages(payload, notifications, self.keys, self.verifier())
+        self.assertEqual(messages, {'m1': {'id': 'm1', 'subject': 'Hello'}})
+        
+        # Anyone can encrypt to our public certificate: without Microsoft's signature it is fetched instead
+        for tokens in (None, [], [Signer().token()]):
+            payload, notifications = self.payload(tokens)
+            self.assertEqual(notification_messages(payload, notifications, self.keys, self.verifier()), {})
+    
+    def test_content_for_another_message_is_dropped(self):
+        payload, notifications = self.payload([self.microsoft.token()])
+        notifications[0]['resourceData']['id'] = 'm2'
+        self.assertEqual(notification_messages(payload, notifications, self.keys, self.verifier()), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+The prompt is sized for the providers the router actually sends it to, not
+for GEMINI_MODEL: hedging and failover may hand it to any of them.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from llm_providers import AnthropicProvider, GeminiProvider, LLMRouter, OpenAIProvider
+from llm_service import LLMService
+
+class PromptBudgetTest(unittest.TestCase):
+    
+    def budget_for(self, *providers):
+        service = LLMService()
+        service.router = LLMRouter(list(providers))
+        return service.prompt_builder.budget_tokens
+    
+    def test_budget_follows_the_primary_model(self):
+        with mock.patch.object(config, 'PROMPT_TOKEN_BUDGET', None):
+            self.assertEqual(self.budget_for(OpenAIProvider('gpt-4o')), 12000)
+            self.assertEqual(self.budget_for(AnthropicProvider('claude-3-haiku-20240307')), 6000)
+    
+    def test_budget_fits_the_smallest_fallback(self):
+        with mock.patch.object(config, 'PROMPT_TOKEN_BUDGET', None):
+            budget = self.budget_for(GeminiProvider('gemini-1.5-pro'), OpenAIProvider('gpt-4o-mini'))
+        self.assertEqual(budget, 6000)
+    
+    def test_unknown_model_gets_the_default(self):
+        with mock.patch.object(config, 'PROMPT_TOKEN_BUDGET', None):
+            self.assertEqual(self.budget_for(OpenAIProvider('o1-preview')), config.DEFAULT_PROMPT_TOKEN_BUDGET)
+    
+    def test_override_wins(self):
+        with mock.patch.object(config, 'PROMPT_TOKEN_BUDGET', 3000):
+            self.assertEqual(self.budget_for(GeminiProvider('gemini-1.5-pro')), 3000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+The token buckets refill while a caller waits, and the shared per-minute
+DynamoDB counter turns a failed conditional update into a wait for the
+next minute instead of an error.
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botocore.exceptions import ClientError
+
+from rate_limiter import DynamoDBRateCounter, RateLimiter, RateLimitExceeded, TokenBucket
+
+class StubTable:
+    """update_item with the counter's condition evaluated on an in-memory item"""
+    
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+    
+    def update_item(self, Key, ConditionExpression, ExpressionAttributeValues, **kwargs):
+        self.calls.append(Key['token_id'])
+        values = ExpressionAttributeValues
+        item = self.items.setdefault(Key['token_id'], {})
+        if 'requests' in item and not (item['requests'] < values[':rpm'] and item['tokens'] <= values[':room']):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}},
+                              'UpdateItem')
+        item['requests'] = item.get('requests', 0) + values[':one']
+        item['tokens'] = item.get('tokens', 0) + values[':tokens']
+
+class TokenBucketTest(unittest.TestCase):
+    
+    def test_refills_after_waiting(self):
+        bucket = TokenBucket(capacity=60, per_minute=60)
+        now = bucket.updated
+        bucket.reserve(60, now)
+        self.assertAlmostEqual(bucket.delay(30, now), 30.0)
+        # Half a minute later the 30 tokens are there
+        self.assertAlmostEqual(bucket.delay(30, now + 30), 0.0)
+        # and the bucket never refills past its capacity
+        self.assertEqual(bucket.delay(60, now + 600), 0.0)
+        self.assertEqual(bucket.level, 60)
+    
+    def test_limiter_waits_for_refill_then_rejects_long_waits(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000, max_wait_seconds=2)
+        with mock.patch('rate_limiter.time.sleep') as sleep:
+            for _ in range(60):
+                limiter.acquire(10)
+            sleep.assert_not_called()
+            # The request bucket is empty: callers queue a second apart for the refill
+            limiter.acquire(10)
+            self.assertAlmostEqual(sleep.call_args[0][0], 1.0, delta=0.1)
+            limiter.acquire(10)
+            self.assertAlmostEqual(sleep.call_args[0][0], 2.0, delta=0.1)
+            # until the wait would pass max_wait_seconds
+            self.assertRaises(RateLimitExceeded, limiter.acquire, 10)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+class DynamoDBRateCounterTest(unittest.TestCase):
+    
+    def test_conditional_update_rejection_waits_for_next_minute(self):
+        table = StubTable()
+        counter = DynamoDBRateCounter(table, 2, 1000)
+        self.assertEqual(counter.try_consume(100), 0.0)
+        self.assertEqual(counter.try_consume(100), 0.0)
+        # Third request in the minute fails the condition: wait until the minute is over
+        delay = counter.try_consume(100)
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, 60)
+        self.assertEqual(len(set(table.calls)), 1)
+    
+    def test_token_limit_rejects(self):
+        counter = DynamoDBRateCounter(StubTable(), 100, 250)
+        window = int(time.time() // 60)
+        self.assertTrue(counter.increment(window, 200))
+        self.assertFalse(counter.increment(window, 100))
+    
+    def test_other_errors_propagate(self):
+        table = mock.Mock()
+        table.update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'}}, 'UpdateItem'
+        )
+        self.assertRaises(ClientError, DynamoDBRateCounter(table, 10, 1000).increment, 1, 10)
+
+if __name__ == '__main__':
+    unittest.main()
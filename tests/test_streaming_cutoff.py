@@ -0,0 +1,51 @@
+"""
+A streamed reply stops at its sign-off block (or LLM_STREAM_MAX_CHARS) instead
+of waiting for the filler the model keeps generating, and reports time to
+first token and total generation time.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from fake_llm import DEFAULT_REPLY, DEFAULT_TRAILER
+from llm_providers import FakeProvider
+
+class StreamingCutoffTest(unittest.TestCase):
+    
+    def provider(self):
+        return FakeProvider(first_token_seconds=0.05, chars_per_second=20000, chunk_chars=60)
+    
+    def test_stream_stops_at_sign_off(self):
+        provider = self.provider()
+        text, used_tokens, timing = provider.complete('prompt', 0.7, 1000, stream=True)
+        self.assertEqual(timing['cutoff'], 'closing')
+        self.assertIn('K Glowing Customer Support', text)
+        self.assertNotIn('P.S.', text)
+        # Generation stopped early: the trailer was never produced, so no usage was reported
+        self.assertLess(provider.client.chars_generated, len(DEFAULT_REPLY + DEFAULT_TRAILER))
+        self.assertIsNone(used_tokens)
+    
+    def test_stream_reports_ttft_and_total_time(self):
+        text, _, timing = self.provider().complete('prompt', 0.7, 1000, stream=True)
+        self.assertGreaterEqual(timing['ttft_ms'], 50)
+        self.assertGreaterEqual(timing['generation_ms'], timing['ttft_ms'])
+    
+    def test_stream_stops_at_max_chars(self):
+        with mock.patch.object(config, 'LLM_STREAM_MAX_CHARS', 100):
+            text, _, timing = self.provider().complete('prompt', 0.7, 1000, stream=True)
+        self.assertEqual(timing['cutoff'], 'length')
+        self.assertLessEqual(len(text), 100)
+    
+    def test_without_streaming_the_whole_reply_arrives_at_once(self):
+        text, used_tokens, timing = self.provider().complete('prompt', 0.7, 1000, stream=False)
+        self.assertEqual(text, DEFAULT_REPLY + DEFAULT_TRAILER)
+        self.assertIsNone(timing['cutoff'])
+        self.assertEqual(timing['ttft_ms'], timing['generation_ms'])
+        self.assertIsNotNone(used_tokens)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""
+With RICH_NOTIFICATIONS on but no certificate, subscriptions are created
+without resource data; the stored one must still count as matching instead
+of being deleted and recreated on every run.
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import notification_crypto
+from subscription_manager import MemorySubscriptionStore, SubscriptionManager
+
+URL = 'https://bot.example/webhook'
+
+class SubscriptionMatchTest(unittest.TestCase):
+    
+    def manager(self):
+        store = MemorySubscriptionStore()
+        store.save({'id': 'sub-1', 'expirationDateTime': '2099-01-01T00:00:00Z', 'expires_at': time.time() + 7 * 86400,
+                    'notificationUrl': URL, 'lifecycleNotificationUrl': URL, 'includeResourceData': False})
+        return SubscriptionManager(mock.Mock(), store, URL, lifecycle_notification_url=URL)
+    
+    def test_rich_without_certificate_keeps_basic_subscription(self):
+        manager = self.manager()
+        with mock.patch.object(config, 'RICH_NOTIFICATIONS', True), \
+                mock.patch.object(notification_crypto, 'load_notification_keys', return_value=None):
+            action, state = manager.ensure()
+        self.assertEqual((action, state['id']), ('current', 'sub-1'))
+        manager.graph_client.delete_subscription.assert_not_called()
+    
+    def test_rich_with_certificate_replaces_basic_subscription(self):
+        manager = self.manager()
+        with mock.patch.object(config, 'RICH_NOTIFICATIONS', True), \
+                mock.patch.object(notification_crypto, 'load_notification_keys', return_value=object()):
+            self.assertFalse(manager._matches(manager.store.load()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+A token Graph rejected with 401 must not come back from storage: the
+retry in GraphClient._request has to carry a freshly refreshed token.
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth_provider_aws import AWSAuthProvider
+from graph_client import GraphClient
+from token_manager import TokenManager
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = b'{}'
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+    
+    def json(self):
+        return {}
+
+class FakeSession:
+    """Rejects the OLD token once and accepts anything else"""
+    
+    def __init__(self):
+        self.tokens = []
+    
+    def request(self, method, url, headers=None, **kwargs):
+        token = headers['Authorization'].split(' ', 1)[1]
+        self.tokens.append(token)
+        return FakeResponse(401 if token == 'OLD' else 200)
+
+def stored_provider(refreshed):
+    """AWS auth provider whose DynamoDB copy still holds OLD with a future expiry"""
+    provider = AWSAuthProvider()
+    provider.token_cache = {'access_token': 'OLD', 'refresh_token': 'refresh',
+                            'access_token_expires_at': time.time() + 3600}
+    
+    def refresh():
+        refreshed.append(True)
+        provider.token_cache = {**provider.token_cache, 'access_token': 'NEW',
+                                'access_token_expires_at': time.time() + 3600}
+        return {'access_token': 'NEW', 'expires_in': 3600}
+    
+    provider.token_manager = TokenManager(refresh)
+    return provider
+
+class TokenRefreshTest(unittest.TestCase):
+    
+    def test_seed_refuses_invalidated_token(self):
+        manager = TokenManager(lambda: {'access_token': 'NEW', 'expires_in': 3600})
+        manager.seed('OLD', time.time() + 3600)
+        manager.invalidate('OLD')
+        manager.seed('OLD', time.time() + 3600)
+        self.assertEqual(manager.get_token(), 'NEW')
+        self.assertEqual(manager.refresh_count, 1)
+    
+    def test_only_last_rejected_token_is_kept(self):
+        tokens = iter(['NEW1', 'NEW2'])
+        manager = TokenManager(lambda: {'access_token': next(tokens), 'expires_in': 3600})
+        manager.seed('OLD', time.time() + 3600)
+        manager.invalidate('OLD')
+        manager.get_token()
+        manager.invalidate('NEW1')
+        self.assertEqual(manager._rejected, 'NEW1')
+    
+    def test_provider_refreshes_after_invalidate(self):
+        refreshed = []
+        provider = stored_provider(refreshed)
+        self.assertEqual(provider.get_access_token(), 'OLD')
+        provider.invalidate_access_token('OLD')
+        self.assertEqual(provider.get_access_token(), 'NEW')
+        self.assertEqual(refreshed, [True])
+    
+    def test_graph_request_retries_with_refreshed_token(self):
+        refreshed = []
+        client = GraphClient()
+        client.auth_provider = stored_provider(refreshed)
+        client.session = FakeSession()
+        client._request('GET', f'{client.BASE_URL}/me/messages/1', operation='get_message')
+        self.assertEqual(client.session.tokens, ['OLD', 'NEW'])
+        self.assertEqual(refreshed, [True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+expires_at is the TTL attribute of the shared EmailBot_Tokens table (idempotency
+markers, caches, rate counters). The token item must never carry it, or
+DynamoDB deletes the refresh token soon after each access token expires.
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth_provider_aws import AWSAuthProvider
+
+class FakeTable:
+    def __init__(self):
+        self.items = {}
+    
+    def put_item(self, Item):
+        self.items[Item['token_id']] = Item
+    
+    def get_item(self, Key):
+        item = self.items.get(Key['token_id'])
+        return {'Item': item} if item else {}
+
+class TokenStorageTest(unittest.TestCase):
+    
+    def provider(self):
+        provider = AWSAuthProvider()
+        provider._table = FakeTable()
+        return provider
+    
+    def test_token_item_has_no_ttl_attribute(self):
+        provider = self.provider()
+        provider.save_tokens({'access_token': 'AT', 'refresh_token': 'RT', 'expires_in': 3600})
+        item = provider.table.items['default']
+        self.assertNotIn('expires_at', item)
+        self.assertAlmostEqual(item['access_token_expires_at'], time.time() + 3600, delta=5)
+    
+    def test_stored_token_is_reused_until_it_expires(self):
+        provider = self.provider()
+        provider.save_tokens({'access_token': 'AT', 'refresh_token': 'RT', 'expires_in': 3600})
+        provider.token_cache = None
+        provider._refresh_access_token = lambda: self.fail("stored token should be reused")
+        provider.token_manager.refresh_func = provider._refresh_access_token
+        self.assertEqual(provider.get_access_token(), 'AT')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Removes quoted replies and repeated signatures from email thread text.
+
+Outlook and Gmail replies carry the whole previous thread ("From: ... Sent: ...",
+"-----Original Message-----", "On ... wrote:", "> " prefixes). Every message in
+the thread is already fetched on its own, so only the new content of each
+message is kept.
+"""
+import re
+
+# Lines that start the quoted part of a reply; everything from there on is dropped
+_QUOTE_HEADER_RES = [
+    re.compile(r'^[ \t]*-{2,}\s*(Original Message|원본 메시지)\s*-{2,}\s*$', re.I | re.M),
+    # Outlook header block: "From: ..." followed by "Sent:" / "Date:" (optionally after a ____ separator)
+    re.compile(r'^[ \t]*(From|보낸 사람|보낸사람|발신)\s*:[^\n]*\n[ \t]*(Sent|Date|보낸 날짜|날짜|발신 일시)\s*:', re.I | re.M),
+    # Gmail / Apple Mail: "On Mon, 3 Mar 2025 at 10:12, Name <x@y> wrote:" (may wrap onto a second line)
+    re.compile(r'^[ \t]*On\b[^\n]{0,200}(\n[^\n]{0,200})?\bwrote:\s*$', re.M),
+    re.compile(r'^[^\n]{0,200}님이 작성:\s*$', re.M),
+]
+_OUTLOOK_SEPARATOR_RE = re.compile(r'\n[ \t]*_{10,}[ \t]*\Z')
+_QUOTED_LINE_RE = re.compile(r'^[ \t]*>.*(\n|$)', re.M)
+_PARAGRAPH_SPLIT_RE = re.compile(r'\n[ \t]*(?:\n[ \t]*)+')
+# Standard "-- " signature delimiter
+_SIGNATURE_DELIMITER_RE = re.compile(r'^-- ?$', re.M)
+# Client boilerplate appended to the end of a message
+_MOBILE_FOOTER_RE = re.compile(
+    r'^[ \t]*(Sent from my \w+|Sent from Outlook for \w+|Get Outlook for \w+|'
+    r'iPhone에서 보냄|Android용 Outlook 받기|Outlook for (iOS|Android)에서 보냄)[^\n]*\s*\Z',
+    re.I | re.M
+)
+
+# Paragraphs shorter than this are too generic to count as duplicates ("Thanks,")
+MIN_DUPLICATE_PARAGRAPH = 40
+# A trailing block must be at least this long to be treated as a repeated signature
+MIN_SIGNATURE_CHARS = 15
+
+def strip_quoted(text):
+    """Return only the new content of one message (quoted thread and client footers removed)"""
+    if not text:
+        return text
+    
+    cut = len(text)
+    for pattern in _QUOTE_HEADER_RES:
+        match = pattern.search(text)
+        if match and match.start() < cut:
+            cut = match.start()
+    new_content = text[:cut]
+    # Drop an Outlook "______" separator left just above the quote header
+    new_content = _OUTLOOK_SEPARATOR_RE.sub('', new_content.rstrip())
+    
+    delimiter = _SIGNATURE_DELIMITER_RE.search(new_content)
+    if delimiter:
+        new_content = new_content[:delimiter.start()]
+    
+    new_content = _QUOTED_LINE_RE.sub('', new_content)
+    new_content = _MOBILE_FOOTER_RE.sub('', new_content).strip()
+    
+    # A message that was nothing but a quote keeps its text rather than vanishing
+    return new_content or text.strip()
+
+def _normalize(paragraph):
+    return ' '.join(paragraph.split()).lower()
+
+def _common_suffix(a, b):
+    """Longest list of trailing lines shared by two line lists"""
+    size = 0
+    while size < min(len(a), len(b)) and a[-1 - size].strip() == b[-1 - size].strip():
+        size += 1
+    return a[len(a) - size:] if size else []
+
+def dedupe_conversation(messages):
+    """
+    Remove content repeated across a conversation.
+    
+    messages is a list of (sender, text) tuples, oldest first. Returns the list
+    of texts with paragraphs already seen in an earlier message removed and
+    each sender's recurring signature block dropped.
+    """
+    texts = [text or '' for _, text in messages]
+    
+    # 1. Repeated signatures: trailing lines shared by two messages of the same sender
+    by_sender = {}
+    for index, (sender, _) in enumerate(messages):
+        by_sender.setdefault(sender, []).append(index)
+    
+    for indexes in by_sender.values():
+        if len(indexes) < 2:
+            continue
+        lines = {index: texts[index].rstrip().split('\n') for index in indexes}
+        signature = []
+        for position, first in enumerate(indexes):
+            for second in indexes[position + 1:]:
+                suffix = _common_suffix(lines[first], lines[second])
+                if len(suffix) > len(signature):
+                    signature = suffix
+        if len('\n'.join(signature).strip()) < MIN_SIGNATURE_CHARS:
+            continue
+        
+        signature_lines = [line.strip() for line in signature]
+        for index in indexes:
+            body = lines[index]
+            tail = [line.strip() for line in body[-len(signature):]]
+            if len(body) > len(signature) and tail == signature_lines:
+                texts[index] = '\n'.join(body[:-len(signature)]).rstrip()
+    
+    # 2. Paragraphs quoted again in a later message without a header
+    seen = set()
+    for index, text in enumerate(texts):
+        kept = []
+        for paragraph in _PARAGRAPH_SPLIT_RE.split(text):
+            key = _normalize(paragraph)
+            if len(key) >= MIN_DUPLICATE_PARAGRAPH and key in seen:
+                continue
+            kept.append(paragraph)
+        for paragraph in kept:
+            seen.add(_normalize(paragraph))
+        texts[index] = '\n\n'.join(kept).strip() or text
+    
+    return texts
@@ -0,0 +1,70 @@
+import math
+import threading
+import time
+
+import config
+
+class CostEstimator:
+    """
+    Exponentially weighted moving average of how long one message takes.
+    Lives at module level, so a warm Lambda container keeps learning from
+    earlier invocations.
+    """
+    
+    def __init__(self, initial_seconds=None, alpha=None):
+        self.estimate = initial_seconds or config.MESSAGE_COST_INITIAL_SECONDS
+        self.alpha = alpha or config.MESSAGE_COST_EWMA_ALPHA
+        self.samples = 0
+        self._lock = threading.Lock()
+    
+    def record(self, seconds):
+        with self._lock:
+            self.estimate = self.alpha * seconds + (1 - self.alpha) * self.estimate
+            self.samples += 1
+    
+    def chunk_seconds(self, count, concurrency=None):
+        """Expected wall time for count messages processed concurrency at a time"""
+        concurrency = concurrency or config.PROCESS_CONCURRENCY
+        return self.estimate * math.ceil(count / concurrency)
+
+class TimeBudget:
+    """Remaining invocation time, with a safety margin kept back for deferring leftovers"""
+    
+    def __init__(self, context=None, estimator=None, safety_margin_ms=None):
+        # context is the Lambda context; without one (local runs) the budget is unlimited
+        self.context = context
+        self.estimator = estimator or cost_estimator
+        self.safety_margin_ms = safety_margin_ms or config.LAMBDA_SAFETY_MARGIN_MS
+    
+    def remaining_seconds(self):
+        if self.context is None:
+            return float('inf')
+        return (self.context.get_remaining_time_in_millis() - self.safety_margin_ms) / 1000
+    
+    def can_start(self, count):
+        """True if count more messages should finish before the margin is reached"""
+        return self.estimator.chunk_seconds(count) <= self.remaining_seconds()
+    
+    def timed(self, count):
+        """Context manager that records the per-message cost of processing count messages"""
+        return _Timer(self.estimator, count)
+
+class _Timer:
+    def __init__(self, estimator, count):
+        self.estimator = estimator
+        self.count = count
+    
+    def __enter__(self):
+        self.started = time.time()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if not self.count:
+            return False
+        elapsed = time.time() - self.started
+        rounds = math.ceil(self.count / config.PROCESS_CONCURRENCY) or 1
+        self.estimator.record(elapsed / rounds)
+        return False
+
+# Singleton instance
+cost_estimator = CostEstimator()
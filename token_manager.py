@@ -0,0 +1,80 @@
+import threading
+import time
+
+import config
+from metrics import metrics
+
+class TokenManager:
+    """Caches an access token in memory and refreshes it shortly before it expires"""
+
+    def __init__(self, refresh_func, margin_seconds=None, clock=time.time):
+        # refresh_func must return an MSAL-style token response
+        # ({'access_token': ..., 'expires_in': ...} or with an absolute 'access_token_expires_at')
+        self.refresh_func = refresh_func
+        if margin_seconds is None:
+            margin_seconds = config.TOKEN_REFRESH_MARGIN_SECONDS
+        self.margin_seconds = margin_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+        # The last token Graph rejected; storage may still hold it with a future expiry
+        self._rejected = None
+        self.refresh_count = 0
+
+    @staticmethod
+    def expires_at_from(token_response, now):
+        """Work out the absolute expiry time (epoch seconds) of a token response"""
+        if token_response.get('access_token_expires_at'):
+            return float(token_response['access_token_expires_at'])
+        if token_response.get('expires_in'):
+            return now + float(token_response['expires_in'])
+        return 0
+
+    def _is_fresh(self):
+        return bool(self._access_token) and self.clock() < self._expires_at - self.margin_seconds
+
+    def seed(self, access_token, expires_at):
+        """Prime the manager with a token loaded from storage (e.g. on a cold start)"""
+        if not access_token or not expires_at:
+            return
+        with self._lock:
+            if access_token == self._rejected:
+                return
+            if float(expires_at) > self._expires_at:
+                self._access_token = access_token
+                self._expires_at = float(expires_at)
+
+    def get_token(self):
+        """Return a cached token, refreshing it once it enters the safety margin"""
+        if self._is_fresh():
+            return self._access_token
+
+        # Single-flight: concurrent callers queue on the lock and reuse the
+        # token fetched by whichever caller got there first
+        with self._lock:
+            if self._is_fresh():
+                return self._access_token
+
+            with metrics.span('auth.token_refresh'):
+                result = self.refresh_func()
+            self.refresh_count += 1
+            self._access_token = result['access_token']
+            self._expires_at = self.expires_at_from(result, self.clock())
+            return self._access_token
+
+    def invalidate(self, access_token=None):
+        """
+        Drop the cached token (only if it is still the one the caller saw rejected)
+        and never seed it again, so the next get_token() refreshes
+        """
+        with self._lock:
+            if access_token is None or access_token == self._access_token:
+                if self._access_token:
+                    self._rejected = self._access_token
+                self._access_token = None
+                self._expires_at = 0
+
+    @property
+    def expires_at(self):
+        return self._expires_at
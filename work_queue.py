@@ -0,0 +1,182 @@
+import sqlite3
+import threading
+import time
+
+import config
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+class WorkQueue:
+    """
+    Durable queue of message IDs in a local SQLite file (used by scripts/server.py).
+    
+    Delivery is at-least-once: claim() hides jobs for a visibility timeout
+    instead of deleting them, so a job whose worker dies reappears once the
+    timeout passes. Jobs that keep failing are moved to the dead_letters table.
+    """
+    
+    def __init__(self, db_path=None, visibility_timeout=None, max_attempts=None):
+        self.db_path = db_path or config.WORK_QUEUE_DB
+        self.visibility_timeout = visibility_timeout or config.WORK_QUEUE_VISIBILITY_TIMEOUT
+        self.max_attempts = max_attempts or config.WORK_QUEUE_MAX_ATTEMPTS
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' message_id TEXT NOT NULL,'
+                ' enqueued_at REAL NOT NULL,'
+                ' available_at REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' last_error TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_available ON jobs (available_at)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS dead_letters ('
+                ' id INTEGER PRIMARY KEY,'
+                ' message_id TEXT NOT NULL,'
+                ' enqueued_at REAL NOT NULL,'
+                ' failed_at REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL,'
+                ' last_error TEXT)'
+            )
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def enqueue(self, message_ids):
+        """Persist one job per message ID"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                'INSERT INTO jobs (message_id, enqueued_at, available_at) VALUES (?, ?, ?)',
+                [(message_id, now, now) for message_id in message_ids]
+            )
+    
+    def claim(self, limit=1):
+        """
+        Take up to limit visible jobs, hiding them for the visibility timeout.
+        Returns [{'id', 'message_id', 'attempts', 'enqueued_at'}]
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            # Jobs that timed out on every attempt (e.g. a crash loop) go straight to dead letters
+            self._dead_letter(conn, 'attempts >= ? AND available_at <= ?', (self.max_attempts, now),
+                              'visibility timeout expired on last attempt')
+            rows = conn.execute(
+                'SELECT id, message_id, attempts, enqueued_at FROM jobs'
+                ' WHERE available_at <= ? ORDER BY id LIMIT ?',
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE jobs SET available_at = ?, attempts = attempts + 1 WHERE id = ?',
+                [(now + self.visibility_timeout, row[0]) for row in rows]
+            )
+        
+        return [{'id': row[0], 'message_id': row[1], 'attempts': row[2] + 1, 'enqueued_at': row[3]}
+                for row in rows]
+    
+    def ack(self, job_ids):
+        """Delete finished jobs"""
+        with self._lock, self._connect() as conn:
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in job_ids])
+    
+    def fail(self, job, error):
+        """Make a failed job visible again after a backoff, or dead-letter it after max_attempts"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            if job['attempts'] >= self.max_attempts:
+                self._dead_letter(conn, 'id = ?', (job['id'],), str(error))
+                log.warning("Moved to dead letters", message_id=job['message_id'], attempts=job['attempts'])
+                return
+            
+            # Exponential backoff, capped at the visibility timeout
+            delay = min(2 ** job['attempts'], self.visibility_timeout)
+            conn.execute(
+                'UPDATE jobs SET available_at = ?, last_error = ? WHERE id = ?',
+                (now + delay, str(error), job['id'])
+            )
+    
+    def _dead_letter(self, conn, where, params, error):
+        conn.execute(
+            'INSERT INTO dead_letters (id, message_id, enqueued_at, failed_at, attempts, last_error)'
+            f' SELECT id, message_id, enqueued_at, ?, attempts, COALESCE(?, last_error) FROM jobs WHERE {where}',
+            (time.time(), error) + params
+        )
+        conn.execute(f'DELETE FROM jobs WHERE {where}', params)
+    
+    def stats(self):
+        """Queue depth and age for /health"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            depth, oldest = conn.execute('SELECT COUNT(*), MIN(enqueued_at) FROM jobs').fetchone()
+            in_flight = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE attempts > 0 AND available_at > ?', (now,)
+            ).fetchone()[0]
+            dead_letters = conn.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+        
+        return {
+            'depth': depth,
+            'in_flight': in_flight,
+            'oldest_age_seconds': round(now - oldest, 1) if oldest else 0,
+            'dead_letters': dead_letters
+        }
+
+class WorkerPool:
+    """Worker threads that drain a WorkQueue through a batch handler"""
+    
+    def __init__(self, queue, handler, workers=None, batch_size=None, poll_interval=None):
+        # handler takes a list of message IDs and returns one result dict per ID
+        # (the EmailProcessor.process_emails contract)
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers or config.WORK_QUEUE_WORKERS
+        self.batch_size = batch_size or config.WORK_QUEUE_BATCH_SIZE
+        self.poll_interval = poll_interval or config.WORK_QUEUE_POLL_INTERVAL
+        self._stop = threading.Event()
+        self._threads = []
+    
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'queue-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log.info("Started queue workers", workers=self.workers)
+    
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+    
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                jobs = self.queue.claim(self.batch_size)
+            except Exception as e:
+                log.error("Error claiming jobs", error=str(e))
+                jobs = []
+            
+            if not jobs:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.process(jobs)
+    
+    def process(self, jobs):
+        """Run one claimed batch through the handler and ack or fail each job"""
+        try:
+            results = self.handler([job['message_id'] for job in jobs])
+            by_message = {result['message_id']: result for result in results}
+        except Exception as e:
+            by_message = {job['message_id']: {'success': False, 'error': str(e)} for job in jobs}
+        
+        done = []
+        for job in jobs:
+            result = by_message.get(job['message_id'], {'success': False, 'error': 'No result'})
+            if result['success']:
+                log.info("Processed email", message_id=job['message_id'])
+                done.append(job['id'])
+            else:
+                log.warning("Failed to process email", message_id=job['message_id'], error=result.get('error'))
+                self.queue.fail(job, result.get('error'))
+        self.queue.ack(done)